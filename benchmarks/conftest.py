@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+"""
+Shared fixtures for the pytest-benchmark suite.
+
+The benchmarks always run against the offline stand-in SPECCHIO client, so
+no server or JVM is needed. See run_benchmarks.sh.
+"""
+
+import os
+
+import pytest
+
+os.environ['SPECCHIO_CLIENT_BACKEND'] = 'fake'
+os.environ.setdefault('SPECCHIO_FAKE_LATENCY', '0')
+
+import pyspecchio.ancildata_parser as adp
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DATADIR = os.path.join(ROOT, 'test', 'DATA', '')
+PICO_DIR = os.path.join(ROOT, 'test', 'PICO_testdata', '')
+PLOT_SCALE_DIR = os.path.join(
+    DATADIR, 'ES', 'field_scale', 'ES_F1_2017', 'plot_scale_data', '')
+
+
+@pytest.fixture
+def clear_dataframes():
+    """Empties the module-level dataframe store between rounds, otherwise
+    the parsers skip (and warn about) files they have already seen."""
+    def clear():
+        adp.dataframes.clear()
+    clear()
+    yield clear
+    clear()
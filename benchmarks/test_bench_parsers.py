@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for the spectra and ancillary data parsers.
+"""
+
+import warnings
+
+import pyspecchio.ancildata_parser as adp
+from pyspecchio.spectra_parser import SpectraFile
+
+from conftest import DATADIR, PICO_DIR, PLOT_SCALE_DIR
+
+PICO_FILE = "QEP1USB1_b000000_s000002_light.pico"
+PRN_FILE = PLOT_SCALE_DIR + "LAI/20170714_LAI.PRN"
+EXCEL_FILE = PLOT_SCALE_DIR + "SPAD/20170516_SPAD.xlsx"
+
+
+def read_all_pico(spectrafile):
+    """Reads pixels and metadata for all four spectra, as the uploader does
+    """
+    for i in range(0, 4):
+        spectrafile.get_spectra_pixels(i)
+        spectrafile.get_spectra_metadata(i)
+
+
+def test_spectrafile_read_json(benchmark):
+    sf = SpectraFile(PICO_FILE, PICO_DIR)
+    benchmark(sf.read_json)
+
+
+def test_spectrafile_all_pixels_and_metadata(benchmark):
+    sf = SpectraFile(PICO_FILE, PICO_DIR)
+    benchmark(read_all_pico, sf)
+
+
+def test_extract_PRN_format(benchmark, clear_dataframes):
+    def run():
+        clear_dataframes()
+        adp.extract_PRN_format(PRN_FILE, "BENCH_PRN")
+    benchmark(run)
+
+
+def test_extract_excel_format(benchmark, clear_dataframes):
+    def run():
+        clear_dataframes()
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            adp.extract_excel_format(EXCEL_FILE, "BENCH_SPAD")
+    benchmark(run)
+
+
+def test_extract_dataframes(benchmark, clear_dataframes):
+    def run():
+        clear_dataframes()
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            return adp.extract_dataframes(DATADIR)
+    dfs = benchmark.pedantic(run, rounds=3, iterations=1)
+    assert len(dfs) > 0
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for the NumPy to Java conversions and the PICO upload path,
+run against the offline stand-in client.
+"""
+
+import numpy as np
+
+import pyspecchio.specchio_db_interface as specchio
+from pyspecchio.spectra_parser import SpectraFile
+
+from conftest import PICO_DIR
+
+PICO_FILE = "QEP1USB1_b000000_s000002_light.pico"
+
+
+def test_to_java_float_list(benchmark):
+    wavelengths = np.linspace(1.0, 2048.0, 2048)
+    benchmark(specchio.to_java_float_list, wavelengths)
+
+
+def test_to_java_float_lists(benchmark):
+    spectra = np.random.RandomState(0).rand(4, 2048)
+    benchmark(specchio.to_java_float_lists, spectra)
+
+
+def test_upload_pico_spectra(benchmark):
+    db_interface = specchio.specchioDBinterface("Benchmark Campaign")
+    spectrafile = SpectraFile(PICO_FILE, PICO_DIR)
+    benchmark(db_interface.specchio_upload_pico_spectra, spectrafile)
+    assert db_interface.specchio_client.call_counts['insertSpectralFile'] > 0
@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+"""
+Snapshot of the ancillary data already ingested, for metadata-only updates.
+
+When a value is corrected in e.g. a Height or SPAD workbook, re-running the
+whole ancillary upload rebuilds and re-sends every row. Instead, the cells
+of every ingested ancillary dataframe are kept in a local SQLite file, one
+row per (campaign, dataframe, plot, column), and a new parse of the data
+is compared with them cell by cell:
+
+    changes = snapshot.diff(campaign_name, ancil_data, columns_of)
+
+gives a DataFrame of the cells that were changed, added or removed among
+the columns columns_of(dataframe name) of each dataframe. Only
+these are sent to the server, as EAV updates of the spectra of the rows
+they are in (specchioDBinterface.update_ancil_metadata), so a correction
+costs in proportion to its size. Cells are recorded once they are sent.
+
+The ids of the dummy spectra each row was uploaded as are kept alongside
+its cells, as the dummy file names (plot and date) are shared by every
+category measured on the same date.
+
+Values are kept as JSON text of their plain python values (see
+ancildata_parser.python_value), so a float32 cell compares equal to the
+value it was read as. Empty cells are null.
+"""
+
+import json
+import math
+import os
+import sqlite3
+
+import pandas as pd
+
+try:
+    from pyspecchio import metrics
+    from pyspecchio import ancildata_parser as ancilparser
+    from pyspecchio.file_cache import get_cache_dir
+except ImportError:
+    import metrics
+    import ancildata_parser as ancilparser
+    from file_cache import get_cache_dir
+
+DEFAULT_SNAPSHOT_NAME = 'ancil_snapshot.sqlite'
+
+CHANGE_COLUMNS = ('df_key', 'plot', 'column', 'old', 'new', 'change')
+
+
+def to_json(value):
+    """JSON text of a dataframe value (null if it is empty). Whole floats
+    are written as integers, as a column of integers is read as floats
+    once it has an empty cell."""
+    value = ancilparser.python_value(value)
+    if value is None or (isinstance(value, float) and math.isnan(value)) \
+            or value is pd.NaT:
+        return 'null'
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return json.dumps(value, default=str)
+
+
+def _from_json(value):
+    return None if pd.isnull(value) else json.loads(value)
+
+
+def dataframe_cells(df, columns):
+    """The cells of an ancillary dataframe's columns, keyed by plot (the
+    first column, as in the upload), as a DataFrame of plot, column and
+    value (JSON text)"""
+    columns = [column for column in columns
+               if column in df.columns and column != df.columns[0]]
+    if not columns or df.empty:
+        return pd.DataFrame(columns=['plot', 'column', 'value'])
+    # Plain python values of the typed columns, before a common object
+    # dtype would widen e.g. float32 values to float64
+    cells = pd.DataFrame(dict(
+        (column, pd.Series([ancilparser.python_value(value)
+                            for value in df[column].to_numpy()],
+                           index=df.index, dtype=object))
+        for column in [df.columns[0]] + columns),
+        columns=[df.columns[0]] + columns)
+    cells = cells.drop_duplicates(subset=df.columns[0], keep='last')
+    cells = cells.melt(id_vars=df.columns[0], var_name='column',
+                       value_name='value')
+    cells.columns = ['plot', 'column', 'value']
+    cells['plot'] = cells['plot'].astype(str)
+    cells['value'] = [to_json(value) for value in cells['value']]
+    return cells
+
+
+class AncilSnapshot(object):
+    """The ancillary data cells ingested into each campaign.
+
+    Args:
+        filename: the SQLite file, by default in PYSPECCHIO_CACHE_DIR,
+            or ':memory:' for a snapshot lasting only this run.
+    """
+
+    def __init__(self, filename=None):
+        if filename is None:
+            filename = os.path.join(get_cache_dir('ancil'),
+                                    DEFAULT_SNAPSHOT_NAME)
+        self.connection = sqlite3.connect(filename)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS ancil_cell ("
+            " campaign TEXT, df_key TEXT, plot TEXT, column TEXT,"
+            " value TEXT, PRIMARY KEY (campaign, df_key, plot, column))")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS ancil_spectrum ("
+            " campaign TEXT, df_key TEXT, plot TEXT, spectrum_id INTEGER,"
+            " PRIMARY KEY (campaign, df_key, plot, spectrum_id))")
+        self.connection.commit()
+
+    def _recorded(self, campaign, df_key):
+        return pd.read_sql_query(
+            "SELECT plot, column, value FROM ancil_cell"
+            " WHERE campaign = ? AND df_key = ?", self.connection,
+            params=(campaign, df_key))
+
+    def diff_dataframe(self, campaign, df_key, df, columns):
+        """The cells of one dataframe that differ from the snapshot.
+
+        Returns:
+            A DataFrame of CHANGE_COLUMNS, with the old and new values as
+            python values (None if empty) and change 'changed', 'added' or
+            'removed'
+        """
+        merged = self._recorded(campaign, df_key).merge(
+            dataframe_cells(df, columns), on=['plot', 'column'], how='outer',
+            suffixes=('_old', '_new'))
+        merged = merged[merged['value_old'] != merged['value_new']]
+        old_empty = merged['value_old'].isnull() | \
+            (merged['value_old'] == 'null')
+        new_empty = merged['value_new'].isnull() | \
+            (merged['value_new'] == 'null')
+        # A cell that was empty and is empty or missing is no change
+        keep = ~(old_empty & new_empty)
+        merged = merged[keep].copy()
+        merged['change'] = 'changed'
+        merged.loc[old_empty[keep], 'change'] = 'added'
+        merged.loc[new_empty[keep], 'change'] = 'removed'
+        changes = pd.DataFrame({
+            'df_key': df_key,
+            'plot': merged['plot'],
+            'column': merged['column'],
+            # object, so that empty values stay None rather than NaN
+            'old': pd.Series([_from_json(value) for value in
+                              merged['value_old']], index=merged.index,
+                             dtype=object),
+            'new': pd.Series([_from_json(value) for value in
+                              merged['value_new']], index=merged.index,
+                             dtype=object),
+            'change': merged['change']}, columns=CHANGE_COLUMNS)
+        return changes.sort_values(['plot', 'column']).reset_index(drop=True)
+
+    def diff(self, campaign, ancil_data, columns_of):
+        """The changed cells of all the dataframes (dictionary name ->
+        dataframe), comparing the columns columns_of(df_key) of each"""
+        with metrics.timer('delta.diff'):
+            changes = [self.diff_dataframe(campaign, df_key, df,
+                                           columns_of(df_key))
+                       for df_key, df in ancil_data.items()]
+        changes = [change for change in changes if len(change)] or \
+            [pd.DataFrame(columns=CHANGE_COLUMNS)]
+        changes = pd.concat(changes, ignore_index=True)
+        metrics.count('delta.cells_changed', len(changes))
+        return changes
+
+    def record_dataframe(self, campaign, df_key, df, columns,
+                         spectrum_ids=None):
+        """Records all the cells of a dataframe as ingested, and optionally
+        the spectrum ids of its rows (dictionary plot -> list of ids)"""
+        cells = dataframe_cells(df, columns)
+        with self.connection:
+            self.connection.execute(
+                "DELETE FROM ancil_cell WHERE campaign = ? AND df_key = ?",
+                (campaign, df_key))
+            self.connection.executemany(
+                "INSERT INTO ancil_cell VALUES (?, ?, ?, ?, ?)",
+                [(campaign, df_key, plot, column, value) for plot, column,
+                 value in cells.itertuples(index=False)])
+            if spectrum_ids is None:
+                return
+            self.connection.execute(
+                "DELETE FROM ancil_spectrum WHERE campaign = ? AND df_key = ?",
+                (campaign, df_key))
+            self.connection.executemany(
+                "INSERT OR IGNORE INTO ancil_spectrum VALUES (?, ?, ?, ?)",
+                [(campaign, df_key, str(plot), int(spectrum_id))
+                 for plot, ids in spectrum_ids.items()
+                 for spectrum_id in ids])
+
+    def spectrum_ids(self, campaign, df_key, plot):
+        """The ids of the spectra a row of a dataframe was uploaded as"""
+        return [spectrum_id for (spectrum_id,) in self.connection.execute(
+            "SELECT spectrum_id FROM ancil_spectrum WHERE campaign = ?"
+            " AND df_key = ? AND plot = ? ORDER BY spectrum_id",
+            (campaign, df_key, str(plot)))]
+
+    def record_changes(self, campaign, changes):
+        """Records the cells of changes (from diff) as ingested"""
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO ancil_cell VALUES (?, ?, ?, ?, ?)",
+                [(campaign, change.df_key, change.plot, change.column,
+                  json.dumps(change.new, default=str))
+                 for change in changes.itertuples(index=False)])
+
+    def close(self):
+        self.connection.close()
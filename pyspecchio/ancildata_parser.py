@@ -10,8 +10,16 @@ the database
 import os
 import re
 import warnings
+import numpy as np
 import pandas as pd
 
+try:
+    from pyspecchio import metrics
+    from pyspecchio.memory_budget import chunk_by_size, dataframe_bytes
+except ImportError:
+    import metrics
+    from memory_budget import chunk_by_size, dataframe_bytes
+
 
 dataframes = {}
 
@@ -21,7 +29,52 @@ SOILS_SUBTABLES = ('Moisture', 'ResinExtracts', 'pH', 'NitrateAmmonia')
 # Expected names of ancil data
 ANCIL_DATA_NAMES = ('Fluorescence', 'GS', 'Harvest', 'CN', 'HI', 'Height',
                     'LAI', 'SPAD', 'ThetaProbe',
-                    'NitrateAmmonia', 'ResinExtracts', 'Moisture', 'pH')
+                    'NitrateAmmonia', 'ResinExtracts', 'Moisture', 'pH',
+                    'UAV')
+
+# Columns of each category's dataframes and the dtype they are read as,
+# for the categories in specchioDBinterface.MAP_ANCIL_METADATA_SPECCHIONAME.
+# Plot IDs and fertiliser levels are categoricals, measurements float32.
+# Columns not declared keep the dtype pandas infers.
+COMMON_DTYPES = {
+    'Plot_(variety_and_plot_number)': 'category',
+    'Plot': 'category',
+    'Fertiliser_level': 'category'}
+
+ANCIL_DTYPES = {
+    'GS':         {'GS': 'category'},
+    'Harvest':    dict.fromkeys(('Yield_TonnesPerHectare', 'TGW',
+                                 'FreshWeightKg', 'DryMatter%', 'no_in15g'),
+                                'float32'),
+    'CN':         dict.fromkeys(('N%', 'C%'), 'float32'),
+    'HI':         dict.fromkeys(('StrawFreshWeight', 'StrawDryWeight',
+                                 'WholeEarWeight', 'GrainWeight',
+                                 'ChaffWeight', 'HI'), 'float32'),
+    'Height':     dict.fromkeys(('Height1', 'Height2', 'Height3', 'Height4',
+                                 'Height5', 'Plot_height'), 'float32'),
+    'SPAD':       dict.fromkeys(['SPAD{}'.format(i) for i in range(1, 11)] +
+                                ['Plot_Average'], 'float32'),
+    'ThetaProbe': dict.fromkeys(('Moisture1', 'Moisture2', 'Moisture3',
+                                 'Moisture4', 'Moisture5', 'Plot Moisture'),
+                                'float32'),
+    'NitrateAmmonia': dict.fromkeys(('NO2NO3mgperlN', 'AmmoniamgperlN'),
+                                    'float32'),
+    'ResinExtracts':  dict.fromkeys(('Ammonia_set1', 'Nitrate_set1'),
+                                    'float32'),
+    'Moisture':   {'Moisture%g/g': 'float32'},
+    'pH':         {'pH': 'float32'},
+    # LAI-2000 .PRN files; the time of day is combined with the file's date
+    'LAI':        dict([('Time', 'datetime'), ('Sample', 'int16')] + [
+        (column, 'float32') for column in ('Transmitted', 'Spread',
+                                           'Incident', 'Beam Frac', 'Zenith',
+                                           'LAI')]),
+    'UAV':        dict.fromkeys(['Band{}_{}'.format(band, statistic)
+                                 for band in range(1, 6)
+                                 for statistic in ('mean', 'median', 'std')],
+                                'float32')}
+
+PRN_COLUMNS = ('Time', 'Plot', 'Sample', 'Transmitted', 'Spread', 'Incident',
+               'Beam Frac', 'Zenith', 'LAI')
 
 
 def file_and_dict_name(datadir, curdirname, fname):
@@ -45,27 +98,198 @@ def sanitize_headers(dataframes):
             pass
     return dataframes
 
-def extract_dataframes(directory):
-    for (dirname, _, files) in os.walk(directory):
-        for fname in files:
-            # Only match "xlsx" files, exclude recovery/backup files
-            if re.match("^(?![~$]).*.xlsx$", fname):
-                # Could be try blocks here:
-                try:
-                    extract_excel_format(*file_and_dict_name(
-                        directory, dirname, fname))
-                except ImportError:
-                    print("You must have the xlrd python module installed"
-                          "...Skipping " + fname)
-            if re.match("^(?![~$]).*.PRN$", fname):
-                extract_PRN_format(*file_and_dict_name(
-                    directory, dirname, fname))
-    sanitized_dfs = sanitize_headers(dataframes)
-    return sanitized_dfs
+def column_dtype(category, column):
+    """The declared dtype of a column of a category's dataframes, or None"""
+    if not isinstance(column, str):  # e.g. the Fluorescence MultiIndex
+        return None
+    column = column.strip()
+    return ANCIL_DTYPES.get(category, {}).get(column,
+                                              COMMON_DTYPES.get(column))
+
+
+def read_dtypes(category, columns):
+    """The declared dtypes of the given columns (as they are named in the
+    file), to pass to pandas as it reads them. Times are left to
+    apply_dtypes, which needs the date in the dictionary name."""
+    dtypes = {}
+    for column in columns:
+        dtype = column_dtype(category, column)
+        if dtype is not None and dtype != 'datetime':
+            dtypes[column] = dtype
+    return dtypes
+
+
+def read_typed(read, category, columns):
+    """Reads a dataframe with read(dtype=...), typed as declared for the
+    category. If a measurement is not a number, only the categoricals are
+    typed as it is read, and apply_dtypes turns those values into NaN."""
+    dtypes = read_dtypes(category, columns)
+    try:
+        return read(dtype=dtypes)
+    except ValueError:
+        return read(dtype={column: dtype for column, dtype in dtypes.items()
+                           if dtype == 'category'})
+
+
+def apply_dtypes(df, dictname, category=None):
+    """Converts the columns of a dataframe to their declared dtypes (see
+    ANCIL_DTYPES), for the category in its dictionary name unless one is
+    given. Values that do not parse as numbers become NaN. Columns that
+    were already read as their declared dtype are left as they are.
+
+    Times are put on the date in the dictionary name; without one (e.g. a
+    name that is not a dataframe key), they are left as times of day."""
+    if category is None:
+        category = get_category_from_df_key(dictname)
+    for column in df.columns:
+        dtype = column_dtype(category, column)
+        if dtype is None:
+            continue
+        values = df[column]
+        if dtype == 'category':
+            if not isinstance(values.dtype, pd.CategoricalDtype):
+                df[column] = values.astype('category')
+        elif dtype == 'datetime':
+            if pd.api.types.is_datetime64_any_dtype(values):
+                continue
+            times = pd.to_timedelta(values.astype(str), errors='coerce')
+            parts = dictname.split('_')
+            day = pd.to_datetime(parts[2], format='%Y%m%d', errors='coerce') \
+                if len(parts) > 2 else pd.NaT
+            df[column] = times if pd.isnull(day) else day + times
+        elif values.dtype != np.dtype(dtype):
+            numbers = pd.to_numeric(values, errors='coerce')
+            if np.issubdtype(np.dtype(dtype), np.integer) and \
+                    numbers.isnull().any():
+                dtype = 'float32'  # integers with missing values
+            df[column] = numbers.astype(dtype)
+    return df
+
+
+def python_value(value):
+    """A dataframe value as a plain python value, for the SPECCHIO client.
+    float32 values are rounded to the digits they were read with."""
+    if isinstance(value, np.floating) and value.dtype.itemsize < 8:
+        return float(str(value))
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def extract_file(directory, dirname, fname, plots_file=None):
+    """Parses one ancillary data file, in dirname under the top-level data
+    directory, into the dataframes.
+
+    Returns:
+        The file's dictionary name, or None if it is not an ancillary data
+        file (or cannot be read without an optional module).
+    """
+    # Exclude recovery/backup files
+    if re.match("^[~$]", fname):
+        return None
+    if re.match(".*.xlsx$", fname):
+        try:
+            extract_excel_format(*file_and_dict_name(
+                directory, dirname, fname))
+        except ImportError:
+            print("You must have the xlrd python module installed"
+                  "...Skipping " + fname)
+            return None
+    elif re.match(".*.PRN$", fname):
+        # Typed as it is read
+        extract_PRN_format(*file_and_dict_name(directory, dirname, fname))
+        return file_and_dict_name(directory, dirname, fname)[1]
+    elif plots_file and re.match(".*.tif$", fname):
+        try:
+            from pyspecchio.ortho_zonal_stats import extract_ortho_format
+        except ImportError:
+            try:
+                from ortho_zonal_stats import extract_ortho_format
+            except ImportError:
+                print("You must have the rasterio python module"
+                      " installed...Skipping " + fname)
+                return None
+        extract_ortho_format(*file_and_dict_name(directory, dirname, fname),
+                             plots_file=plots_file)
+    else:
+        return None
+    dictname = file_and_dict_name(directory, dirname, fname)[1]
+    # Any column not typed as it was read (e.g. times, or a measurement
+    # that is not a number)
+    with metrics.timer('ancil.dtypes'):
+        apply_dtypes(dataframes[dictname], dictname)
+    return dictname
+
+
+def extract_dataframes(directory, plots_file=None, filenames=None):
+    """Parses all the ancillary data files under directory into dataframes.
+
+    If a GeoJSON file of plot polygons is given, UAV orthomosaics (.tif)
+    are also reduced to per-plot band statistics (see ortho_zonal_stats).
+
+    If a list of files (full paths, under directory) is given, only these
+    are parsed, and only their dataframes are returned.
+    """
+    if filenames is None:
+        for (dirname, _, files) in os.walk(directory):
+            for fname in files:
+                extract_file(directory, dirname, fname, plots_file)
+        return sanitize_headers(dataframes)
+    parsed = {}
+    for filename in filenames:
+        dirname, fname = os.path.split(filename)
+        dictname = extract_file(directory, dirname, fname, plots_file)
+        if dictname is not None:
+            parsed[dictname] = dataframes[dictname]
+    return sanitize_headers(parsed)
+
+
+def iter_dataframe_chunks(directory, memory_budget, plots_file=None,
+                          filenames=None):
+    """Parses the ancillary data files under directory (or only the given
+    files) like extract_dataframes, but a group at a time.
+
+    Each group of dataframes is at most memory_budget bytes (a dataframe
+    bigger than that is yielded on its own). The dataframes are taken out
+    of the module's dataframes dict as they are parsed, so they are
+    released once the caller has finished with their group.
+
+    Yields:
+        dicts of dictionary name -> dataframe
+    """
+    if filenames is None:
+        paths = ((dirname, fname)
+                 for dirname, _, files in os.walk(directory)
+                 for fname in files)
+    else:
+        paths = (os.path.split(filename) for filename in filenames)
+
+    def parsed():
+        for dirname, fname in paths:
+            dictname = extract_file(directory, dirname, fname, plots_file)
+            if dictname is not None:
+                yield dictname, sanitize_headers(
+                    {dictname: dataframes.pop(dictname)})[dictname]
+
+    for chunk in chunk_by_size(parsed(), lambda item: dataframe_bytes(
+            item[1]), memory_budget):
+        yield dict(chunk)
 
 
 def extract_excel_format(filefullname, dictname):
-    dataframes[dictname] = pd.read_excel(filefullname, skiprows=1)
+    if dictname in dataframes:
+        # Perhaps log as well if duplicate
+        warnings.warn("Duplicate Dictionary name", UserWarning)
+    category = get_category_from_df_key(dictname)
+    with metrics.timer('ancil.excel'), pd.ExcelFile(filefullname) as book:
+        # The header row first, to type the columns as they are read
+        columns = book.parse(skiprows=1, nrows=0).columns
+        dataframes[dictname] = read_typed(
+            lambda **kwargs: book.parse(skiprows=1, **kwargs),
+            category, columns)
+    metrics.count('ancil.excel_files')
+    metrics.count('ancil.bytes', os.path.getsize(filefullname))
+    metrics.count('ancil.rows', len(dataframes[dictname]))
     if 'Fluorescence' in dictname:
         upper_header = pd.MultiIndex.from_product(
             [['Sample1', 'Sample2',
@@ -73,11 +297,6 @@ def extract_excel_format(filefullname, dictname):
                 ['Fo', 'Fv', 'Fm', 'Fv/Fm', 'Fv/Fo']])
         new_header = dataframes[dictname].columns[0:3].union(upper_header)
         dataframes[dictname].columns = new_header
-    if dictname in dataframes:
-        # Perhaps log as well if duplicate
-        warnings.warn("Duplicate Dictionary name", UserWarning)
-    else:
-        dataframes[dictname] = pd.read_excel(filefullname, skiprows=1)
 
 
 def extract_csv_format(filefullname, dictname):
@@ -85,7 +304,10 @@ def extract_csv_format(filefullname, dictname):
         # Perhaps log as well if duplicate
         warnings.warn("Duplicate dictionary name", UserWarning)
     else:
-        dataframes[dictname] = pd.read_csv(filefullname, skiprows=1)
+        columns = pd.read_csv(filefullname, skiprows=1, nrows=0).columns
+        dataframes[dictname] = read_typed(
+            lambda **kwargs: pd.read_csv(filefullname, skiprows=1, **kwargs),
+            get_category_from_df_key(dictname), columns)
 
 
 def extract_PRN_format(filefullname, dictname):
@@ -94,17 +316,39 @@ def extract_PRN_format(filefullname, dictname):
         # Perhaps log as well if duplicate
         warnings.warn("always", UserWarning)
     else:
-        # Build dataframe manually using the generator.
-        PRN_dataframe = pd.DataFrame(columns=['Time', 'Plot', 'Sample',
-                                              'Transmitted', 'Spread',
-                                              'Incident',
-                                              'Beam Frac', 'Zenith',  'LAI'])
-        for i, line in enumerate(generate_goodPRNline(filefullname)):
-            PRN_dataframe.loc[i] = line.split()
-        PRN_dataframe = PRN_dataframe.apply(pd.to_numeric, errors='ignore')
+        # Build the dataframe a column at a time from the lines given by the
+        # generator, typed as declared for 'LAI' in ANCIL_DTYPES
+        with metrics.timer('ancil.prn'):
+            rows = [line.split() for line in generate_goodPRNline(
+                filefullname)]
+            columns = zip(*rows) if rows else [()] * len(PRN_COLUMNS)
+            PRN_dataframe = pd.DataFrame({
+                name: prn_column(name, values)
+                for name, values in zip(PRN_COLUMNS, columns)},
+                columns=PRN_COLUMNS)
+            del rows
+            # Times, and any measurement that is not a number
+            apply_dtypes(PRN_dataframe, dictname, 'LAI')
+        metrics.count('ancil.prn_files')
+        metrics.count('ancil.bytes', os.path.getsize(filefullname))
+        metrics.count('ancil.rows', len(PRN_dataframe))
         dataframes[dictname] = PRN_dataframe
 
 
+def prn_column(name, values):
+    """A column of a PRN file, from its values as text, as its declared
+    dtype where they all parse"""
+    if name == 'Plot':
+        return pd.Categorical(pd.to_numeric(values, errors='coerce'))
+    dtype = column_dtype('LAI', name)
+    if dtype in (None, 'datetime'):
+        return values
+    try:
+        return np.array(values, dtype=dtype)
+    except ValueError:
+        return values
+
+
 def generate_goodPRNline(filename):
     """Generator that yields a data line from the PRN file"""
     with open(filename) as f:
@@ -117,6 +361,10 @@ def get_date_from_df_key(df):
     return df.split('_')[2]
 
 
+def get_site_from_df_key(df):
+    return '_'.join(df.split('_')[:2])
+
+
 def get_category_from_df_key(df):
     return df.split('_')[-1]
 
@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+"""
+Simulates satellite bands (e.g. Sentinel-2, Landsat 8) from PICO spectra.
+
+Each band value is the spectrum weighted by the band's spectral response
+function (SRF). For a given instrument wavelength grid and sensor, the
+weights of every band form a sparse matrix (bands x pixels), so the bands of
+thousands of stacked spectra (see spectra_parser.stack_spectra) are computed
+with a single matrix multiply.
+
+Weight matrices are cached in memory and on disk (in PYSPECCHIO_CACHE_DIR,
+default ~/.cache/pyspecchio), keyed by a hash of the wavelength grid and the
+sensor's SRFs, so they are only computed once per instrument and sensor.
+
+The built-in sensors use Gaussian approximations of the SRFs from each
+band's centre wavelength and FWHM. For exact results, load the published
+SRF tables with Sensor.from_csv().
+"""
+
+import os
+from collections import OrderedDict
+
+import numpy as np
+
+try:
+    from scipy import sparse
+except ImportError:
+    sparse = None
+
+try:
+    from pyspecchio import metrics
+    from pyspecchio.file_cache import get_cache_dir, grid_hash
+except ImportError:
+    import metrics
+    from file_cache import get_cache_dir, grid_hash
+
+# Fraction of a band's SRF that must fall within the instrument's
+# wavelength range for the band to be simulated; otherwise it is NaN.
+DEFAULT_MIN_COVERAGE = 0.9
+
+# np.trapz is np.trapezoid from NumPy 2.0
+trapezoid = getattr(np, 'trapezoid', None) or np.trapz
+
+# FWHM = 2 * sqrt(2 * ln 2) * sigma
+FWHM_TO_SIGMA = 1.0 / 2.3548200450309493
+
+
+class Sensor(object):
+    """A sensor's bands and their tabulated spectral response functions.
+
+    Args:
+        name: e.g. 'Sentinel-2A'
+        band_names: list of band names
+        wavelengths: 1D array (nm) the responses are tabulated at
+        responses: 2D array (bands x wavelengths) of relative response
+    """
+
+    def __init__(self, name, band_names, wavelengths, responses):
+        self.name = name
+        self.band_names = list(band_names)
+        self.wavelengths = np.asarray(wavelengths, dtype='float64')
+        self.responses = np.asarray(responses, dtype='float64')
+
+    @classmethod
+    def from_gaussian(cls, name, bands, step=1.0):
+        """Approximates SRFs as Gaussians from {band: (centre, fwhm)}"""
+        band_names = list(bands)
+        centres = np.array([bands[band][0] for band in band_names])
+        sigmas = np.array([bands[band][1] for band in band_names]) * \
+            FWHM_TO_SIGMA
+        wavelengths = np.arange(np.floor(min(centres - 4 * sigmas)),
+                                np.ceil(max(centres + 4 * sigmas)) + step,
+                                step)
+        responses = np.exp(-0.5 * ((wavelengths[None, :] - centres[:, None]) /
+                                   sigmas[:, None]) ** 2)
+        return cls(name, band_names, wavelengths, responses)
+
+    @classmethod
+    def from_csv(cls, name, filename):
+        """Reads a table of SRFs: a header row, then one row per wavelength
+        (nm, first column) with the response of each band in the others"""
+        with open(filename) as f:
+            header = f.readline().strip().split(',')
+        table = np.loadtxt(filename, delimiter=',', skiprows=1, ndmin=2)
+        return cls(name, header[1:], table[:, 0], table[:, 1:].T)
+
+    def fingerprint(self):
+        return grid_hash(self.name, ','.join(self.band_names),
+                         self.wavelengths, self.responses)
+
+
+# Band centre and FWHM (nm)
+SENTINEL2A_BANDS = (
+    ('B1', (442.7, 21.0)), ('B2', (492.4, 66.0)), ('B3', (559.8, 36.0)),
+    ('B4', (664.6, 31.0)), ('B5', (704.1, 15.0)), ('B6', (740.5, 15.0)),
+    ('B7', (782.8, 20.0)), ('B8', (832.8, 106.0)), ('B8A', (864.7, 21.0)),
+    ('B9', (945.1, 20.0)), ('B10', (1373.5, 31.0)), ('B11', (1613.7, 91.0)),
+    ('B12', (2202.4, 175.0)))
+
+LANDSAT8_OLI_BANDS = (
+    ('B1', (443.0, 16.0)), ('B2', (482.0, 60.0)), ('B3', (561.4, 57.0)),
+    ('B4', (654.6, 38.0)), ('B5', (864.7, 28.0)), ('B6', (1608.9, 85.0)),
+    ('B7', (2200.7, 187.0)), ('B8', (589.5, 172.0)), ('B9', (1373.4, 21.0)))
+
+
+SENSORS = {
+    'Sentinel-2A': Sensor.from_gaussian('Sentinel-2A',
+                                        OrderedDict(SENTINEL2A_BANDS)),
+    'Landsat-8': Sensor.from_gaussian('Landsat-8',
+                                      OrderedDict(LANDSAT8_OLI_BANDS))}
+
+
+def get_sensor(sensor):
+    """Accepts a Sensor or the name of one of the built-in SENSORS"""
+    if isinstance(sensor, Sensor):
+        return sensor
+    try:
+        return SENSORS[sensor]
+    except KeyError:
+        raise ValueError("Unknown sensor: " + str(sensor) +
+                         ". Choose from: " + ', '.join(sorted(SENSORS)))
+
+
+def compute_weights(wavelengths, sensor, min_coverage=DEFAULT_MIN_COVERAGE):
+    """Computes the (bands x pixels) weight matrix for a wavelength grid.
+
+    Each pixel is weighted by the band's response at its wavelength times
+    the width of the pixel in nm, and each band's weights are normalised to
+    sum to one.
+
+    Returns:
+        (weights, valid): the dense weights, and a boolean array marking
+        the bands that are covered by the wavelength grid
+    """
+    wavelengths = np.asarray(wavelengths, dtype='float64')
+    pixel_widths = np.abs(np.gradient(wavelengths))
+    weights = np.zeros((len(sensor.band_names), len(wavelengths)))
+    valid = np.zeros(len(sensor.band_names), dtype=bool)
+    full_areas = trapezoid(sensor.responses, sensor.wavelengths, axis=1)
+    for band, response in enumerate(sensor.responses):
+        band_weights = np.interp(wavelengths, sensor.wavelengths, response,
+                                 left=0.0, right=0.0) * pixel_widths
+        if full_areas[band] > 0 and \
+                band_weights.sum() / full_areas[band] >= min_coverage:
+            # Drop negligible tails to keep the matrix sparse
+            band_weights[band_weights < 1e-6 * band_weights.max()] = 0.0
+            weights[band] = band_weights / band_weights.sum()
+            valid[band] = True
+    return weights, valid
+
+
+class BandSimulator(object):
+    """Applies cached SRF weight matrices to stacks of spectra.
+
+    Args:
+        cache_dir: where weight matrices are saved between runs, None for
+            the default, or False to only cache in memory.
+        min_coverage: see DEFAULT_MIN_COVERAGE
+    """
+
+    def __init__(self, cache_dir=None, min_coverage=DEFAULT_MIN_COVERAGE):
+        if cache_dir is None:
+            cache_dir = get_cache_dir('srf_weights')
+        self.cache_dir = cache_dir
+        self.min_coverage = min_coverage
+        self.weight_cache = {}
+
+    def _cache_file(self, key):
+        return os.path.join(self.cache_dir, key + '.npz')
+
+    def get_weights(self, wavelengths, sensor):
+        """Returns (weights, valid) for the grid and sensor, from the memory
+        or disk cache if they have already been computed"""
+        sensor = get_sensor(sensor)
+        wavelengths = np.asarray(wavelengths, dtype='float64')
+        key = grid_hash(wavelengths, sensor.fingerprint(), self.min_coverage)
+        if key in self.weight_cache:
+            return self.weight_cache[key]
+        if self.cache_dir and os.path.exists(self._cache_file(key)):
+            with np.load(self._cache_file(key)) as cached:
+                weights, valid = cached['weights'], cached['valid']
+            metrics.count('bands.weights_loaded')
+        else:
+            with metrics.timer('bands.compute_weights'):
+                weights, valid = compute_weights(
+                    wavelengths, sensor, self.min_coverage)
+            if self.cache_dir:
+                np.savez_compressed(self._cache_file(key), weights=weights,
+                                    valid=valid)
+        if sparse is not None:
+            weights = sparse.csr_matrix(weights)
+        self.weight_cache[key] = (weights, valid)
+        return self.weight_cache[key]
+
+    def simulate(self, spectra, wavelengths, sensor):
+        """Simulates the sensor's bands for a 2D array of spectra (one per
+        row) on the given wavelength grid.
+
+        Returns:
+            A (spectra x bands) array; bands outside the grid are NaN.
+        """
+        weights, valid = self.get_weights(wavelengths, sensor)
+        spectra = np.atleast_2d(np.asarray(spectra, dtype='float64'))
+        with metrics.timer('bands.simulate'):
+            bands = np.asarray((weights @ spectra.T).T)
+        bands[:, ~valid] = np.nan
+        metrics.count('bands.spectra', len(spectra))
+        return bands
+
+    def simulate_stack(self, stack, sensor):
+        """Simulates bands for a spectra_parser.SpectraStack.
+
+        Returns:
+            A pandas DataFrame, one row per spectrum and one column per band,
+            indexed by (file path, spectra number).
+        """
+        import pandas as pd
+        sensor = get_sensor(sensor)
+        bands = self.simulate(stack.spectra, stack.wavelengths, sensor)
+        return pd.DataFrame(
+            bands, columns=sensor.band_names,
+            index=pd.MultiIndex.from_tuples(
+                stack.sources, names=['file', 'spectra_number']))
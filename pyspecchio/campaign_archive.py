@@ -0,0 +1,387 @@
+# -*- coding: utf-8 -*-
+"""
+Exports whole campaigns to a chunked, compressed HDF5 or Zarr archive.
+
+Analysts can then slice months of spectra as arrays, without parsing the
+.pico JSON files or querying SPECCHIO. The archive is laid out by
+acquisition day (from each spectrum's Datetime), then by wavelength grid:
+
+    /20170530/grid_<hash>/wavelengths           (pixels,)
+    /20170530/grid_<hash>/spectra               (spectra, pixels) float32
+    /20170530/grid_<hash>/file                  (spectra,) source file path
+    /20170530/grid_<hash>/spectra_number        (spectra,) number in file
+    /20170530/grid_<hash>/metadata/<key>        (spectra,) one per key
+    /20170530/ancillary/<ES_F1_20170530_GS>/    plot-level data tables
+
+Spectra are appended along the first axis, in chunks of chunk_rows
+spectra. Exporting more files later appends to the existing days, and
+spectra that are already in the archive (same file path and spectra number)
+are skipped. File paths are stored relative to the spectra root given to
+export_campaign (absolute without one), as PICO file names repeat in every
+batch folder. Numeric metadata is stored as float64 (NaN where missing) and
+everything else as strings (lists as JSON).
+
+The .pico files are parsed in parallel worker processes. Zarr archives are
+written by one thread per day; HDF5 files can only be written serially.
+
+Needs h5py for HDF5 archives (.h5, .hdf5) or zarr (version 2) for Zarr
+archives (.zarr).
+"""
+
+import json
+import numbers
+import os
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+
+import numpy as np
+import pandas as pd
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+try:
+    import zarr
+    from numcodecs import Blosc, VLenUTF8
+except ImportError:
+    zarr = None
+
+try:
+    from pyspecchio import metrics
+    from pyspecchio import ancildata_parser as ancilparser
+    from pyspecchio.file_cache import grid_hash
+    from pyspecchio.spectra_parser import (
+        SpectraStack, wavelengths_from_coefficients)
+except ImportError:
+    import metrics
+    import ancildata_parser as ancilparser
+    from file_cache import grid_hash
+    from spectra_parser import SpectraStack, wavelengths_from_coefficients
+
+DEFAULT_CHUNK_ROWS = 256
+
+
+def acquisition_day(metadata):
+    """'20170530' from a Datetime of '2017-05-30T11:02:03.000000Z'"""
+    return str(metadata.get('Datetime') or 'unknown')[:10].replace('-', '')
+
+
+def source_path(spectrafile, root=None):
+    """The path a spectra file is archived under: relative to root, or
+    absolute without one ('/' separated either way)"""
+    path = os.path.abspath(spectrafile.spath + spectrafile.sfile)
+    if root is not None:
+        path = os.path.relpath(path, os.path.abspath(root))
+    return path.replace(os.sep, '/')
+
+
+def _parse_file(spectrafile, root=None):
+    """Reads one .pico file, in a worker process.
+
+    Returns:
+        A list of (day, calibration coefficients, pixels, metadata, source)
+    """
+    records = []
+    path = source_path(spectrafile, root)
+    for i, spectrum in enumerate(spectrafile.read_json()['Spectra']):
+        metadata = spectrum['Metadata']
+        records.append((
+            acquisition_day(metadata),
+            tuple(metadata['WavelengthCalibrationCoefficients']),
+            spectrum['Pixels'], metadata, (path, i)))
+    return records
+
+
+def stack_by_day(spectrafiles, workers=None, root=None):
+    """Parses the spectra files (in parallel when workers > 1) into
+    SpectraStacks per acquisition day and wavelength grid, with their
+    file paths relative to root.
+
+    Returns:
+        An OrderedDict of day -> list of SpectraStack
+    """
+    parse = partial(_parse_file, root=root)
+    with metrics.timer('archive.parse'):
+        if workers is not None and workers > 1:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                parsed = list(executor.map(parse, spectrafiles))
+        else:
+            parsed = [parse(spectrafile) for spectrafile in spectrafiles]
+    stacks = OrderedDict()
+    for records in parsed:
+        for day, coefficients, pixels, metadata, source in records:
+            key = (day, coefficients, len(pixels))
+            if key not in stacks:
+                stacks[key] = SpectraStack(wavelengths_from_coefficients(
+                    coefficients, len(pixels)))
+            stacks[key].add(pixels, metadata, source)
+    days = OrderedDict()
+    for key in sorted(stacks, key=lambda key: key[0]):
+        days.setdefault(key[0], []).append(stacks[key].finish())
+    return days
+
+
+def _is_numeric(value):
+    return isinstance(value, numbers.Real)
+
+
+def _to_string(value):
+    if value is None:
+        return ''
+    if isinstance(value, (list, tuple, dict)):
+        return json.dumps(value)
+    return str(value)
+
+
+def _column(values, numeric):
+    if numeric:
+        return np.array([float(v) if _is_numeric(v) else np.nan
+                         for v in values], dtype='float64')
+    return np.array([_to_string(v) for v in values], dtype=object)
+
+
+class _HDF5Store(object):
+
+    def __init__(self, path, mode):
+        if h5py is None:
+            raise ImportError("The h5py module is needed for HDF5 archives")
+        self.root = h5py.File(path, mode)
+        self.parallel = False
+
+    def append(self, group, name, values, chunk_rows):
+        if name in group:
+            dataset = group[name]
+            start = dataset.shape[0]
+            dataset.resize(start + len(values), axis=0)
+            dataset[start:] = values
+            return
+        dtype = h5py.string_dtype() if values.dtype == object \
+            else values.dtype
+        group.create_dataset(
+            name, data=values, dtype=dtype,
+            maxshape=(None,) + values.shape[1:],
+            chunks=(chunk_rows,) + values.shape[1:],
+            compression='gzip', compression_opts=4, shuffle=True)
+
+    @staticmethod
+    def read(dataset):
+        if dataset.dtype == object:
+            return np.array(dataset.asstr()[:], dtype=object)
+        return dataset[:]
+
+    def close(self):
+        self.root.close()
+
+
+class _ZarrStore(object):
+
+    def __init__(self, path, mode):
+        if zarr is None:
+            raise ImportError("The zarr module is needed for Zarr archives")
+        self.root = zarr.open_group(path, mode=mode)
+        self.parallel = True
+
+    def append(self, group, name, values, chunk_rows):
+        if name in group:
+            group[name].append(values)
+            return
+        options = {'object_codec': VLenUTF8()} if values.dtype == object \
+            else {'compressor': Blosc(cname='zstd', clevel=5,
+                                      shuffle=Blosc.BITSHUFFLE)}
+        group.create_dataset(
+            name, data=values, chunks=(chunk_rows,) + values.shape[1:],
+            **options)
+
+    @staticmethod
+    def read(dataset):
+        return dataset[:]
+
+    def close(self):
+        pass
+
+
+def open_store(path, mode='a'):
+    """Opens an archive: Zarr if the path ends in .zarr, otherwise HDF5"""
+    if path.rstrip(os.sep).endswith('.zarr'):
+        return _ZarrStore(path, mode)
+    return _HDF5Store(path, mode)
+
+
+def _append_stack(store, day_group, stack, chunk_rows):
+    """Appends the spectra of a SpectraStack that are not already in the
+    archive to its grid group. Returns the number appended."""
+    group = day_group.require_group('grid_' + grid_hash(stack.wavelengths))
+    if 'wavelengths' not in group:
+        group.create_dataset('wavelengths', data=stack.wavelengths)
+        group.attrs['wavelength_calibration'] = list(
+            stack.metadata[0]['WavelengthCalibrationCoefficients'])
+    existing_rows = group['spectra'].shape[0] if 'spectra' in group else 0
+    if existing_rows:
+        existing = set(zip(store.read(group['file']),
+                           store.read(group['spectra_number'])))
+        rows = [row for row, source in enumerate(stack.sources)
+                if source not in existing]
+    else:
+        rows = list(range(len(stack)))
+    if not rows:
+        return 0
+    metadata = [stack.metadata[row] for row in rows]
+    store.append(group, 'spectra',
+                 stack.spectra[rows].astype('float32'), chunk_rows)
+    store.append(group, 'file', _column(
+        [stack.sources[row][0] for row in rows], False), chunk_rows)
+    store.append(group, 'spectra_number', np.array(
+        [stack.sources[row][1] for row in rows], dtype='int64'), chunk_rows)
+
+    metadata_group = group.require_group('metadata')
+    keys = set(key for m in metadata for key in m) | set(metadata_group)
+    for key in sorted(keys):
+        values = [m.get(key) for m in metadata]
+        if key in metadata_group:
+            numeric = metadata_group[key].dtype != object
+        else:
+            numeric = all(_is_numeric(v) for v in values if v is not None)
+            if existing_rows:  # a key that earlier spectra did not have
+                store.append(metadata_group, key,
+                             _column([None] * existing_rows, numeric),
+                             chunk_rows)
+        store.append(metadata_group, key, _column(values, numeric),
+                     chunk_rows)
+    return len(rows)
+
+
+def _write_ancillary(store, day_group, dictname, dataframe):
+    """Writes (replacing) a plot-level data table. Column names are kept in
+    the 'columns' attribute, as they may contain '/'."""
+    ancil_group = day_group.require_group('ancillary')
+    if dictname in ancil_group:
+        del ancil_group[dictname]
+    group = ancil_group.require_group(dictname)
+    names = []
+    for i, column in enumerate(dataframe.columns):
+        series = dataframe.iloc[:, i]
+        names.append(' | '.join(str(c) for c in column)
+                     if isinstance(column, tuple) else str(column))
+        if isinstance(series.dtype, pd.CategoricalDtype):
+            series = series.astype(series.cat.categories.dtype)
+        if pd.api.types.is_numeric_dtype(series):
+            # float32 measurements stay float32, anything else is float64
+            values = series.to_numpy(
+                dtype=np.result_type(series.dtype, np.float32))
+        else:
+            values = _column([None if pd.isnull(v) else v for v in series],
+                             False)
+        store.append(group, 'col{:03d}'.format(i), values,
+                     max(len(values), 1))
+    group.attrs['columns'] = names
+
+
+def export_campaign(store_path, spectrafiles=(), ancil_dataframes=None,
+                    chunk_rows=DEFAULT_CHUNK_ROWS, workers=None,
+                    campaign_name=None, root=None):
+    """Exports (appends) spectra and plot-level data to an archive.
+
+    Args:
+        store_path: .h5/.hdf5 file or .zarr directory, created if needed
+        spectrafiles: SpectraFile objects of the .pico files
+        ancil_dataframes: dict of dictionary name (e.g. 'ES_F1_20170530_GS')
+            -> dataframe, e.g. from ancildata_parser.extract_dataframes
+        chunk_rows: spectra per chunk
+        workers: processes parsing the spectra files (and threads writing
+            Zarr days); None or 1 to do everything in this process
+        campaign_name: stored as an attribute of the archive
+        root: the top spectra directory, that file paths are stored
+            relative to (absolute paths are stored without one)
+
+    Returns:
+        The number of spectra appended
+    """
+    days = stack_by_day(list(spectrafiles), workers, root)
+    store = open_store(store_path)
+    try:
+        if campaign_name:
+            store.root.attrs['campaign'] = campaign_name
+        day_groups = dict((day, store.root.require_group(day))
+                          for day in days)
+
+        def write_day(day):
+            return sum(_append_stack(store, day_groups[day], stack,
+                                     chunk_rows) for stack in days[day])
+
+        with metrics.timer('archive.write'):
+            if store.parallel and workers is not None and workers > 1:
+                with ThreadPoolExecutor(max_workers=workers) as executor:
+                    appended = sum(executor.map(write_day, days))
+            else:
+                appended = sum(write_day(day) for day in days)
+            for dictname, dataframe in (ancil_dataframes or {}).items():
+                day = ancilparser.get_date_from_df_key(dictname)
+                _write_ancillary(store, store.root.require_group(day),
+                                 dictname, dataframe)
+    finally:
+        store.close()
+    metrics.count('archive.spectra', appended)
+    return appended
+
+
+def list_days(store_path):
+    store = open_store(store_path, 'r')
+    try:
+        return sorted(store.root.keys())
+    finally:
+        store.close()
+
+
+def read_spectra(store_path, day):
+    """Reads a day's spectra from an archive.
+
+    Returns:
+        A list, one per wavelength grid, of (wavelengths, spectra, metadata)
+        where metadata is a dataframe with the file, spectra number and
+        metadata of each spectrum
+    """
+    store = open_store(store_path, 'r')
+    try:
+        day_group = store.root[day]
+        grids = []
+        for name in sorted(day_group.keys()):
+            if not name.startswith('grid_'):
+                continue
+            group = day_group[name]
+            columns = OrderedDict([
+                ('file', store.read(group['file'])),
+                ('spectra_number', store.read(group['spectra_number']))])
+            for key in sorted(group['metadata'].keys()):
+                columns[key] = store.read(group['metadata'][key])
+            grids.append((store.read(group['wavelengths']),
+                          store.read(group['spectra']),
+                          pd.DataFrame(columns)))
+        return grids
+    finally:
+        store.close()
+
+
+def read_ancillary(store_path, day):
+    """Reads a day's plot-level data tables from an archive.
+
+    Returns:
+        A dict of dictionary name -> dataframe
+    """
+    store = open_store(store_path, 'r')
+    try:
+        tables = {}
+        if 'ancillary' not in store.root[day]:
+            return tables
+        ancil_group = store.root[day]['ancillary']
+        for dictname in sorted(ancil_group.keys()):
+            group = ancil_group[dictname]
+            names = list(group.attrs['columns'])
+            tables[dictname] = pd.DataFrame(OrderedDict(
+                (name, store.read(group['col{:03d}'.format(i)]))
+                for i, name in enumerate(names)))
+        return tables
+    finally:
+        store.close()
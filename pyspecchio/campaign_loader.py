@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+"""
+Runs SPECCHIO campaign data loaders without busy polling.
+
+A SpecchioCampaignDataLoader is a Java thread that loads the files of a
+campaign's directory on the server. Rather than polling isAlive() in a
+loop, each CampaignLoad waits in a watcher thread on the loader's
+join(timeout), which blocks in the JVM without using the CPU. Every
+`poll_seconds` it reads the loader's parsed and inserted file counters and
+reports them to a progress callback when they have changed:
+
+    def progress(campaign_name, parsed, inserted):
+        print(campaign_name, parsed, "parsed", inserted, "inserted")
+
+    results = campaign_loader.load_campaigns([18, 19], progress=progress)
+
+Several campaigns are loaded at once, each loader with its own client. In
+asyncio code, the loads can be awaited:
+
+    results = await campaign_loader.load_campaigns_async([18, 19])
+
+The progress callback is called from the watcher threads, or in the event
+loop's thread with load_campaigns_async.
+"""
+
+import asyncio
+import threading
+import time
+from concurrent.futures import Future
+
+try:
+    from pyspecchio import metrics
+    from pyspecchio import specchio_db_interface as specchio
+    from pyspecchio import spectra_download
+except ImportError:
+    import metrics
+    import specchio_db_interface as specchio
+    import spectra_download
+
+# Seconds between reads of a loader's counters
+DEFAULT_POLL_SECONDS = 1.0
+
+
+class CampaignLoad(object):
+    """One campaign data loader and the thread watching it.
+
+    Args:
+        loader: a SpecchioCampaignDataLoader with its campaign set
+        campaign_name: the name progress is reported under
+        progress: called with (campaign name, parsed files, inserted files)
+            when the counters change, or None
+    """
+
+    def __init__(self, loader, campaign_name, progress=None,
+                 poll_seconds=DEFAULT_POLL_SECONDS):
+        self.loader = loader
+        self.campaign_name = campaign_name
+        self.progress = progress
+        self.poll_seconds = poll_seconds
+        self.future = Future()
+        self._watcher = None
+
+    def counters(self):
+        """(parsed files, inserted files) so far"""
+        return (int(self.loader.getParsed_file_counter()),
+                int(self.loader.getSuccessful_file_counter()))
+
+    def start(self):
+        self.start_time = time.time()
+        self.loader.start()
+        self._watcher = threading.Thread(
+            target=self._watch, name='watch-' + str(self.campaign_name))
+        self._watcher.daemon = True
+        self._watcher.start()
+        return self
+
+    def _report(self, counters, last):
+        if counters != last and self.progress is not None:
+            self.progress(self.campaign_name, *counters)
+        return counters
+
+    def _watch(self):
+        try:
+            last = None
+            while self.loader.isAlive():
+                self.loader.join(max(1, int(self.poll_seconds * 1000)))
+                last = self._report(self.counters(), last)
+            parsed, inserted = self._report(self.counters(), last)
+        except Exception as exc:
+            self.future.set_exception(exc)
+            return
+        seconds = time.time() - self.start_time
+        metrics.count('campaign_load.files_parsed', parsed)
+        metrics.count('campaign_load.files_inserted', inserted)
+        self.future.set_result({'campaign': self.campaign_name,
+                                'parsed': parsed, 'inserted': inserted,
+                                'seconds': seconds})
+
+    def wait(self, timeout=None):
+        """Blocks until the load has finished, returning a dict of the
+        campaign, parsed and inserted file counts and seconds taken"""
+        return self.future.result(timeout)
+
+    def __await__(self):
+        return asyncio.wrap_future(self.future).__await__()
+
+
+def start_load(client, campaign_id, progress=None,
+               poll_seconds=DEFAULT_POLL_SECONDS):
+    """Starts loading a campaign's data on the server with a client"""
+    campaign = client.getCampaign(campaign_id)
+    loader = specchio.spreader_campaign.SpecchioCampaignDataLoader(client)
+    loader.set_campaign(campaign)
+    return CampaignLoad(loader, str(campaign.getName()), progress,
+                        poll_seconds).start()
+
+
+def _check_clients(clients, campaign_ids):
+    if len(clients) != len(campaign_ids):
+        raise ValueError("Loading {} campaigns needs a client each, but {}"
+                         " were given".format(len(campaign_ids),
+                                              len(clients)))
+
+
+def load_campaigns(campaign_ids, progress=None, clients=None,
+                   poll_seconds=DEFAULT_POLL_SECONDS):
+    """Loads the campaigns concurrently, one new client each unless a list
+    of a client per campaign is given, returning their results (see CampaignLoad.wait) in order"""
+    if clients is None:
+        clients = spectra_download.connect_clients(len(campaign_ids))
+    _check_clients(clients, campaign_ids)
+    with metrics.timer('campaign_load.total'):
+        loads = [start_load(client, campaign_id, progress, poll_seconds)
+                 for client, campaign_id in zip(clients, campaign_ids)]
+        return [load.wait() for load in loads]
+
+
+async def load_campaigns_async(campaign_ids, progress=None, clients=None,
+                               poll_seconds=DEFAULT_POLL_SECONDS):
+    """As load_campaigns, awaiting the loads in the running event loop,
+    with progress called in the loop's thread"""
+    loop = asyncio.get_running_loop()
+    if clients is None:
+        clients = await loop.run_in_executor(
+            None, spectra_download.connect_clients, len(campaign_ids))
+    _check_clients(clients, campaign_ids)
+    loop_progress = None if progress is None else (
+        lambda *counts: loop.call_soon_threadsafe(progress, *counts))
+    loads = [start_load(client, campaign_id, loop_progress, poll_seconds)
+             for client, campaign_id in zip(clients, campaign_ids)]
+    return list(await asyncio.gather(*loads))
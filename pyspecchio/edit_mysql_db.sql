@@ -74,6 +74,10 @@ INSERT INTO `specchio`.`attribute`(`name`, `category_id`, `default_storage_field
  VALUES ('name', (select category_id from `specchio`.category where name ='General'),
  'string_val', (select unit_id from `specchio`.unit where short_name = ''), 
  'name');
+INSERT INTO `specchio`.`attribute`(`name`, `category_id`, `default_storage_field`, `default_unit_id`, `description`)
+ VALUES ('Content Hash', (select category_id from `specchio`.category where name ='General'),
+ 'string_val', (select unit_id from `specchio`.unit where short_name = ''), 
+ 'Hash of the spectrum pixels and key metadata, for deduplication');
 
 
 -- Categories
@@ -91,6 +95,8 @@ INSERT INTO `specchio`.`category` (`category_id`, `name`, `string_val`) VALUES (
 INSERT INTO `specchio`.`category` (`category_id`, `name`, `string_val`) VALUES ('36', 'ResinExtracts', '');
 INSERT INTO `specchio`.`category` (`category_id`, `name`, `string_val`) VALUES ('37', 'Moisture', '');
 INSERT INTO `specchio`.`category` (`category_id`, `name`, `string_val`) VALUES ('38', 'pH', '');
+INSERT INTO `specchio`.`category` (`category_id`, `name`, `string_val`) VALUES ('39', 'UAV', '');
+INSERT INTO `specchio`.`category` (`category_id`, `name`, `string_val`) VALUES ('40', 'Vegetation Indices', '');
 
 -- Attributes METADATA FROM ANCIL DATA
 
@@ -149,3 +155,30 @@ INSERT INTO `specchio`.`attribute` (`attribute_id`, `name`, `description`, `cate
 INSERT INTO `specchio`.`attribute` (`attribute_id`, `name`, `description`, `category_id`, `default_storage_field`) VALUES ('454', 'Fertiliser_level', 'Fertiliser Level (pH)', '38', 'double_val');
 INSERT INTO `specchio`.`attribute` (`attribute_id`, `name`, `description`, `category_id`, `default_storage_field`) VALUES ('455', 'pH', 'pH', '38', 'double_val');
 
+-- Attributes METADATA FROM UAV ORTHOMOSAICS (per-plot band statistics)
+
+INSERT INTO `specchio`.`attribute` (`attribute_id`, `name`, `description`, `category_id`, `default_storage_field`) VALUES ('456', 'Band1_mean', 'UAV Band 1 Plot Mean', '39', 'double_val');
+INSERT INTO `specchio`.`attribute` (`attribute_id`, `name`, `description`, `category_id`, `default_storage_field`) VALUES ('457', 'Band1_median', 'UAV Band 1 Plot Median', '39', 'double_val');
+INSERT INTO `specchio`.`attribute` (`attribute_id`, `name`, `description`, `category_id`, `default_storage_field`) VALUES ('458', 'Band1_std', 'UAV Band 1 Plot Standard Deviation', '39', 'double_val');
+INSERT INTO `specchio`.`attribute` (`attribute_id`, `name`, `description`, `category_id`, `default_storage_field`) VALUES ('459', 'Band2_mean', 'UAV Band 2 Plot Mean', '39', 'double_val');
+INSERT INTO `specchio`.`attribute` (`attribute_id`, `name`, `description`, `category_id`, `default_storage_field`) VALUES ('460', 'Band2_median', 'UAV Band 2 Plot Median', '39', 'double_val');
+INSERT INTO `specchio`.`attribute` (`attribute_id`, `name`, `description`, `category_id`, `default_storage_field`) VALUES ('461', 'Band2_std', 'UAV Band 2 Plot Standard Deviation', '39', 'double_val');
+INSERT INTO `specchio`.`attribute` (`attribute_id`, `name`, `description`, `category_id`, `default_storage_field`) VALUES ('462', 'Band3_mean', 'UAV Band 3 Plot Mean', '39', 'double_val');
+INSERT INTO `specchio`.`attribute` (`attribute_id`, `name`, `description`, `category_id`, `default_storage_field`) VALUES ('463', 'Band3_median', 'UAV Band 3 Plot Median', '39', 'double_val');
+INSERT INTO `specchio`.`attribute` (`attribute_id`, `name`, `description`, `category_id`, `default_storage_field`) VALUES ('464', 'Band3_std', 'UAV Band 3 Plot Standard Deviation', '39', 'double_val');
+INSERT INTO `specchio`.`attribute` (`attribute_id`, `name`, `description`, `category_id`, `default_storage_field`) VALUES ('465', 'Band4_mean', 'UAV Band 4 Plot Mean', '39', 'double_val');
+INSERT INTO `specchio`.`attribute` (`attribute_id`, `name`, `description`, `category_id`, `default_storage_field`) VALUES ('466', 'Band4_median', 'UAV Band 4 Plot Median', '39', 'double_val');
+INSERT INTO `specchio`.`attribute` (`attribute_id`, `name`, `description`, `category_id`, `default_storage_field`) VALUES ('467', 'Band4_std', 'UAV Band 4 Plot Standard Deviation', '39', 'double_val');
+INSERT INTO `specchio`.`attribute` (`attribute_id`, `name`, `description`, `category_id`, `default_storage_field`) VALUES ('468', 'Band5_mean', 'UAV Band 5 Plot Mean', '39', 'double_val');
+INSERT INTO `specchio`.`attribute` (`attribute_id`, `name`, `description`, `category_id`, `default_storage_field`) VALUES ('469', 'Band5_median', 'UAV Band 5 Plot Median', '39', 'double_val');
+INSERT INTO `specchio`.`attribute` (`attribute_id`, `name`, `description`, `category_id`, `default_storage_field`) VALUES ('470', 'Band5_std', 'UAV Band 5 Plot Standard Deviation', '39', 'double_val');
+
+-- Attributes VEGETATION INDICES (computed from the PICO spectra at upload)
+
+INSERT INTO `specchio`.`attribute` (`attribute_id`, `name`, `description`, `category_id`, `default_storage_field`) VALUES ('471', 'NDVI', 'Normalised Difference Vegetation Index', '40', 'double_val');
+INSERT INTO `specchio`.`attribute` (`attribute_id`, `name`, `description`, `category_id`, `default_storage_field`) VALUES ('472', 'GNDVI', 'Green Normalised Difference Vegetation Index', '40', 'double_val');
+INSERT INTO `specchio`.`attribute` (`attribute_id`, `name`, `description`, `category_id`, `default_storage_field`) VALUES ('473', 'SR', 'Simple Ratio', '40', 'double_val');
+INSERT INTO `specchio`.`attribute` (`attribute_id`, `name`, `description`, `category_id`, `default_storage_field`) VALUES ('474', 'NDRE', 'Normalised Difference Red Edge', '40', 'double_val');
+INSERT INTO `specchio`.`attribute` (`attribute_id`, `name`, `description`, `category_id`, `default_storage_field`) VALUES ('475', 'PRI', 'Photochemical Reflectance Index', '40', 'double_val');
+INSERT INTO `specchio`.`attribute` (`attribute_id`, `name`, `description`, `category_id`, `default_storage_field`) VALUES ('476', 'MTCI', 'MERIS Terrestrial Chlorophyll Index', '40', 'double_val');
+INSERT INTO `specchio`.`attribute` (`attribute_id`, `name`, `description`, `category_id`, `default_storage_field`) VALUES ('477', 'REIP', 'Red Edge Inflection Point', '40', 'double_val');
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+"""
+Where pyspecchio keeps the arrays and SQLite stores it reuses between runs.
+
+Each feature has its own subdirectory of PYSPECCHIO_CACHE_DIR (default
+~/.cache/pyspecchio), e.g. 'resampling' matrices, 'srf_weights', the upload
+'journal' and the 'dedup', 'catalog' and 'ancil' stores. Cached arrays are
+keyed by grid_hash() of the wavelength grids and settings they depend on.
+"""
+
+import hashlib
+import os
+
+import numpy as np
+
+
+def get_cache_dir(subdir):
+    """Returns (creating it if needed) a directory for cached arrays"""
+    cache_dir = os.path.join(
+        os.environ.get('PYSPECCHIO_CACHE_DIR',
+                       os.path.join(os.path.expanduser('~'), '.cache',
+                                    'pyspecchio')),
+        subdir)
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    return cache_dir
+
+
+def grid_hash(*arrays_and_strings):
+    """A short hash of wavelength grids, SRF tables and names"""
+    sha = hashlib.sha1()
+    for item in arrays_and_strings:
+        if isinstance(item, np.ndarray):
+            sha.update(np.ascontiguousarray(item, dtype='float64').tobytes())
+        else:
+            sha.update(str(item).encode('utf-8'))
+    return sha.hexdigest()[:16]
@@ -0,0 +1,336 @@
+# -*- coding: utf-8 -*-
+"""
+Watch-folder ingestion: uploads new files as they arrive.
+
+Spectrometers at a field station write .pico files continuously. A
+FolderWatcher monitors the spectra and ancillary data directories and hands
+new files to an upload callback in batches:
+
+    1. Change notifications come from inotify (if the inotify_simple package
+       is installed, on Linux) or, failing that, from polling. Polling only
+       lists the directories whose modification time has changed, so the
+       whole tree is not rescanned on every poll.
+    2. Files are debounced: a file is only ready once its size and
+       modification time have not changed for quiet_seconds, so partially
+       written files are never uploaded.
+    3. Ready files are grouped into batches of at most max_batch_files,
+       and a batch is handed over at the latest max_batch_seconds after its
+       first file became ready.
+
+On Ctrl-C, the files that have stopped changing since they were last
+checked are handed over too, without waiting out quiet_seconds. Files that
+are still changing are listed instead, as files already present when a
+watcher starts are not picked up.
+
+A batch whose upload raises an error is reported and kept aside, and the
+watcher carries on with the next one. Its files are listed as not uploaded
+when the watcher stops.
+"""
+
+import os
+import time
+
+try:
+    from inotify_simple import INotify, flags
+except ImportError:
+    INotify = None
+
+try:
+    from pyspecchio import metrics
+except ImportError:
+    import metrics
+
+# Files picked up by the watcher: PICO spectra and ancillary data
+WATCHED_EXTENSIONS = ('.pico', '.xlsx', '.prn', '.tif')
+
+DEFAULT_QUIET_SECONDS = 5.0
+DEFAULT_MAX_BATCH_FILES = 200
+DEFAULT_MAX_BATCH_SECONDS = 60.0
+DEFAULT_POLL_INTERVAL = 2.0
+
+
+def is_watched_file(path, extensions=WATCHED_EXTENSIONS):
+    """True for data files, ignoring office lock/backup and hidden files"""
+    name = os.path.basename(path)
+    if name.startswith(('~', '$', '.')):
+        return False
+    return os.path.splitext(name)[1].lower() in extensions
+
+
+class PollingSource(object):
+    """Finds new files by polling the directory trees.
+
+    Each poll stats every directory, but only lists those whose
+    modification time has changed since the last poll. Files present when
+    the source is created are not reported.
+    """
+
+    def __init__(self, paths, interval=DEFAULT_POLL_INTERVAL):
+        self.paths = list(paths)
+        self.interval = interval
+        # directory -> (mtime, set of files, list of subdirectories)
+        self.dirs = {}
+        for path in self.paths:
+            self._scan_dir(path, set(), report_new=False)
+
+    def _scan_dir(self, dirname, changed, report_new=True):
+        try:
+            mtime = os.stat(dirname).st_mtime
+        except OSError:  # deleted
+            self.dirs.pop(dirname, None)
+            return
+        known = self.dirs.get(dirname)
+        if known is None or known[0] != mtime:
+            files = set()
+            subdirs = []
+            for entry in os.scandir(dirname):
+                if entry.is_dir():
+                    subdirs.append(entry.path)
+                else:
+                    files.add(entry.path)
+            if known is not None:
+                changed.update(files - known[1])
+            elif report_new:
+                changed.update(files)
+            known = (mtime, files, subdirs)
+            self.dirs[dirname] = known
+        for subdir in known[2]:
+            self._scan_dir(subdir, changed, report_new)
+
+    def poll(self, timeout):
+        """Waits up to timeout seconds, then returns the new files"""
+        time.sleep(min(timeout, self.interval))
+        changed = set()
+        with metrics.timer('watch.poll'):
+            for path in self.paths:
+                self._scan_dir(path, changed)
+        return changed
+
+
+class InotifySource(object):
+    """Reports files written or moved into the directory trees, using
+    inotify watches on every directory"""
+
+    def __init__(self, paths):
+        self.inotify = INotify()
+        self.mask = (flags.CREATE | flags.MODIFY | flags.CLOSE_WRITE |
+                     flags.MOVED_TO)
+        self.watch_dirs = {}
+        for path in paths:
+            self._watch_tree(path)
+
+    def _watch_tree(self, top):
+        """Watches a directory and its subdirectories; returns the files
+        already in them"""
+        found = set()
+        for dirname, _, files in os.walk(top):
+            watch = self.inotify.add_watch(dirname, self.mask)
+            self.watch_dirs[watch] = dirname
+            found.update(os.path.join(dirname, fname) for fname in files)
+        return found
+
+    def poll(self, timeout):
+        changed = set()
+        for event in self.inotify.read(timeout=int(timeout * 1000)):
+            dirname = self.watch_dirs.get(event.wd)
+            if dirname is None or not event.name:
+                continue
+            path = os.path.join(dirname, event.name)
+            if event.mask & flags.ISDIR:
+                # Files may land in a new directory before it is watched
+                if event.mask & (flags.CREATE | flags.MOVED_TO):
+                    changed.update(self._watch_tree(path))
+            else:
+                changed.add(path)
+        return changed
+
+
+def make_source(paths, poll_interval=DEFAULT_POLL_INTERVAL):
+    """An InotifySource if inotify is available, otherwise a
+    PollingSource"""
+    if INotify is not None:
+        try:
+            return InotifySource(paths)
+        except OSError as err:  # e.g. out of inotify watches
+            print("inotify unavailable (" + str(err) + "), polling instead")
+    return PollingSource(paths, poll_interval)
+
+
+class Debouncer(object):
+    """Holds changed files until they have stopped changing"""
+
+    def __init__(self, quiet_seconds=DEFAULT_QUIET_SECONDS):
+        self.quiet_seconds = quiet_seconds
+        # path -> ((size, mtime), time the signature last changed)
+        self.pending = {}
+
+    def touch(self, path, now):
+        self.pending[path] = (None, now)
+
+    def ready(self, now):
+        """Returns the files that have not changed for quiet_seconds"""
+        ready = []
+        for path, (signature, changed_at) in list(self.pending.items()):
+            try:
+                stat = os.stat(path)
+            except OSError:  # deleted or renamed before it settled
+                del self.pending[path]
+                continue
+            current = (stat.st_size, stat.st_mtime)
+            if current != signature:
+                self.pending[path] = (current, now)
+            elif now - changed_at >= self.quiet_seconds and stat.st_size:
+                ready.append(path)
+                del self.pending[path]
+        return sorted(ready)
+
+    def drain(self):
+        """Empties the debouncer, e.g. on exit.
+
+        Returns:
+            (settled, changing): the files that have not changed since they
+            were last checked, and those that have (or are empty)
+        """
+        settled = []
+        changing = []
+        for path, (signature, _) in self.pending.items():
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            if (stat.st_size, stat.st_mtime) == signature and stat.st_size:
+                settled.append(path)
+            else:
+                changing.append(path)
+        self.pending = {}
+        return sorted(settled), sorted(changing)
+
+
+class Batcher(object):
+    """Groups ready files into size- and time-bounded batches"""
+
+    def __init__(self, max_files=DEFAULT_MAX_BATCH_FILES,
+                 max_seconds=DEFAULT_MAX_BATCH_SECONDS):
+        self.max_files = max_files
+        self.max_seconds = max_seconds
+        self.files = []
+        self.started_at = None
+
+    def add(self, paths, now):
+        for path in paths:
+            if path not in self.files:
+                self.files.append(path)
+        if self.files and self.started_at is None:
+            self.started_at = now
+
+    def due(self, now):
+        return bool(self.files) and (
+            len(self.files) >= self.max_files or
+            now - self.started_at >= self.max_seconds)
+
+    def take(self):
+        batch = self.files[:self.max_files]
+        self.files = self.files[self.max_files:]
+        self.started_at = None if not self.files else self.started_at
+        return batch
+
+
+class FolderWatcher(object):
+    """Watches directories and passes batches of new files to a callback.
+
+    Args:
+        paths: directories to watch (recursively)
+        handle_batch: called with a list of file paths for each batch
+        extensions: the file extensions to pick up
+        quiet_seconds, max_batch_files, max_batch_seconds: see the module
+            docstring
+        source: where changes come from (default: make_source(paths))
+        clock: returns the current time in seconds
+    """
+
+    def __init__(self, paths, handle_batch, extensions=WATCHED_EXTENSIONS,
+                 quiet_seconds=DEFAULT_QUIET_SECONDS,
+                 max_batch_files=DEFAULT_MAX_BATCH_FILES,
+                 max_batch_seconds=DEFAULT_MAX_BATCH_SECONDS,
+                 source=None, clock=time.time):
+        self.paths = [os.path.abspath(path) for path in paths]
+        self.handle_batch = handle_batch
+        self.extensions = tuple(ext.lower() for ext in extensions)
+        self.source = make_source(self.paths) if source is None else source
+        self.debouncer = Debouncer(quiet_seconds)
+        self.batcher = Batcher(max_batch_files, max_batch_seconds)
+        self.clock = clock
+        # Files of the batches whose upload failed
+        self.failed = []
+
+    def _hand_over(self, batch):
+        """Passes a batch to the callback, keeping its files in failed if
+        the callback raises"""
+        try:
+            with metrics.timer('watch.batch'):
+                self.handle_batch(batch)
+        except Exception as err:
+            print("Upload of a batch of", len(batch), "files failed:",
+                  repr(err))
+            self.failed.extend(batch)
+            metrics.count('watch.failed_batches')
+            return
+        metrics.count('watch.batches')
+        metrics.count('watch.files', len(batch))
+
+    def step(self, timeout=1.0):
+        """Collects changes for up to timeout seconds, and hands over a
+        batch if one is due. Returns the batch, or None."""
+        for path in self.source.poll(timeout):
+            if is_watched_file(path, self.extensions):
+                self.debouncer.touch(path, self.clock())
+        now = self.clock()
+        self.batcher.add(self.debouncer.ready(now), now)
+        if not self.batcher.due(now):
+            return None
+        batch = self.batcher.take()
+        self._hand_over(batch)
+        return batch
+
+    def finish(self):
+        """Hands over the batched files and the pending files that have
+        stopped changing, in batches.
+
+        Returns:
+            The files that were still changing, which are not handed over
+        """
+        settled, changing = self.debouncer.drain()
+        self.batcher.add(settled, self.clock())
+        if self.batcher.files:
+            print("Uploading", len(self.batcher.files), "remaining files")
+        while self.batcher.files:
+            self._hand_over(self.batcher.take())
+        return changing
+
+    def run(self, timeout=1.0):
+        """Watches until interrupted (Ctrl-C), then uploads the files that
+        have stopped changing"""
+        print("Watching", ', '.join(self.paths), "for new files...")
+        try:
+            while True:
+                self.step(timeout)
+        except KeyboardInterrupt:
+            self._report_not_uploaded(
+                "still being written", self.finish())
+        except Exception:
+            # e.g. the watched directories could not be read; the files
+            # not handed over yet are listed before the error is raised
+            pending = sorted(self.debouncer.pending) + self.batcher.files
+            self._report_not_uploaded("the watcher stopped", pending)
+            raise
+
+    def _report_not_uploaded(self, reason, paths):
+        """Lists the files not uploaded, for this reason and as their
+        upload failed. A new watcher would not pick them up, as they
+        exist."""
+        for why, not_uploaded in ((reason, paths),
+                                  ("their upload failed", self.failed)):
+            if not_uploaded:
+                print("Not uploaded, as " + why + ":")
+                for path in not_uploaded:
+                    print("  " + path)
@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+"""
+Starting the JVM that runs the SPECCHIO Java client, and monitoring it.
+
+The JVM is started once per process by start_jvm(), with options from the
+environment:
+
+    SPECCHIO_JAVA_CLIENT       - path of specchio-client.jar (required)
+    SPECCHIO_JVM_MAX_HEAP      - maximum heap, e.g. 4g (-Xmx)
+    SPECCHIO_JVM_INITIAL_HEAP  - initial heap, e.g. 1g (-Xms)
+    SPECCHIO_JVM_GC            - garbage collector: G1, Parallel, Serial or
+                                 Z (-XX:+Use<GC>GC)
+    SPECCHIO_JVM_OPTIONS       - any other JVM options, e.g.
+                                 "-XX:MaxGCPauseMillis=200"
+
+Large uploads otherwise run in the JVM's default heap, which may be a
+small part of the machine's memory.
+
+JavaMemorySampler samples the Java heap use and garbage collection time
+in a background thread while a run goes on, adding them to the run
+metrics (--profile/--metrics-json in specchio_main.py):
+
+    counters  jvm.gc_ms, jvm.gc_collections - GC during the run
+    gauges    jvm.heap_used_peak_bytes, jvm.heap_committed_peak_bytes,
+              jvm.heap_max_bytes
+"""
+
+import os
+import shlex
+import sys
+import threading
+
+try:
+    import jpype as jp
+except ImportError:
+    jp = None
+
+try:
+    from pyspecchio import metrics
+except ImportError:
+    import metrics
+
+# Always passed to the JVM (enable Java assertions)
+DEFAULT_JVM_OPTIONS = ('-ea',)
+
+GC_OPTIONS = {
+    'g1': '-XX:+UseG1GC',
+    'parallel': '-XX:+UseParallelGC',
+    'serial': '-XX:+UseSerialGC',
+    'z': '-XX:+UseZGC'}
+
+DEFAULT_SAMPLE_SECONDS = 1.0
+
+
+def jvm_options(environ=None):
+    """The JVM options configured in the environment (see above)"""
+    environ = os.environ if environ is None else environ
+    if 'SPECCHIO_JAVA_CLIENT' not in environ:
+        raise KeyError("SPECCHIO_JAVA_CLIENT must be set to the path of"
+                       " specchio-client.jar")
+    options = list(DEFAULT_JVM_OPTIONS)
+    options.append("-Djava.class.path=" + environ['SPECCHIO_JAVA_CLIENT'])
+    if environ.get('SPECCHIO_JVM_INITIAL_HEAP'):
+        options.append('-Xms' + environ['SPECCHIO_JVM_INITIAL_HEAP'])
+    if environ.get('SPECCHIO_JVM_MAX_HEAP'):
+        options.append('-Xmx' + environ['SPECCHIO_JVM_MAX_HEAP'])
+    if environ.get('SPECCHIO_JVM_GC'):
+        gc = environ['SPECCHIO_JVM_GC'].lower()
+        if gc not in GC_OPTIONS:
+            raise ValueError("Unknown SPECCHIO_JVM_GC: " + gc +
+                             ". Choose from: " + ', '.join(sorted(GC_OPTIONS)))
+        options.append(GC_OPTIONS[gc])
+    options.extend(shlex.split(environ.get('SPECCHIO_JVM_OPTIONS', '')))
+    return options
+
+
+def start_jvm(jvmpath=None):
+    """Starts the JVM with the configured options, unless it is running
+    already. Returns True if it was started."""
+    if jp.isJVMStarted():
+        return False
+    try:
+        with metrics.timer('jvm.startup'):
+            jp.startJVM(jvmpath or jp.getDefaultJVMPath(), *jvm_options())
+    except Exception as exc:
+        print(exc)
+        sys.exit(1)
+    return True
+
+
+def java_memory_sample():
+    """Heap use (bytes) and cumulative GC time (ms) and collections of the
+    running JVM"""
+    management = jp.java.lang.management.ManagementFactory
+    heap = management.getMemoryMXBean().getHeapMemoryUsage()
+    gc_ms = 0
+    gc_collections = 0
+    for collector in management.getGarbageCollectorMXBeans():
+        # -1 where a collector does not report it
+        gc_ms += max(int(collector.getCollectionTime()), 0)
+        gc_collections += max(int(collector.getCollectionCount()), 0)
+    return {'heap_used': int(heap.getUsed()),
+            'heap_committed': int(heap.getCommitted()),
+            'heap_max': int(heap.getMax()),
+            'gc_ms': gc_ms,
+            'gc_collections': gc_collections}
+
+
+class JavaMemorySampler(object):
+    """Samples the JVM's memory every `interval` seconds between start()
+    and stop() (or in a with block), recording into the run metrics.
+
+    Args:
+        sample: returns a dict like java_memory_sample()'s
+    """
+
+    def __init__(self, interval=DEFAULT_SAMPLE_SECONDS,
+                 sample=java_memory_sample, run_metrics=None):
+        self.interval = interval
+        self.sample = sample
+        self.metrics = run_metrics or metrics.METRICS
+        self._stopped = threading.Event()
+        self._thread = None
+        self._first = None
+
+    def _record(self):
+        sample = self.sample()
+        if self._first is None:
+            self._first = sample
+        self.metrics.count('jvm.heap_samples')
+        self.metrics.gauge_max('jvm.heap_used_peak_bytes',
+                               sample['heap_used'])
+        self.metrics.gauge_max('jvm.heap_committed_peak_bytes',
+                               sample['heap_committed'])
+        self.metrics.gauge_max('jvm.heap_max_bytes', sample['heap_max'])
+        return sample
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self._record()
+
+    def start(self):
+        self._stopped.clear()
+        self._record()
+        self._thread = threading.Thread(target=self._run,
+                                        name='java-memory-sampler')
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Stops sampling, adding the GC done since start() to the
+        metrics"""
+        if self._thread is None:
+            return
+        self._stopped.set()
+        self._thread.join()
+        self._thread = None
+        last = self._record()
+        self.metrics.count('jvm.gc_ms',
+                           last['gc_ms'] - self._first['gc_ms'])
+        self.metrics.count('jvm.gc_collections',
+                           last['gc_collections'] -
+                           self._first['gc_collections'])
+        self._first = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
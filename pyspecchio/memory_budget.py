@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+"""
+Chunked processing of large campaigns within a memory budget.
+
+By default every ancillary dataframe and every PICO file of a run is held
+in memory at once. With a memory budget (--memory-budget in
+specchio_main.py) files are instead processed in groups whose estimated
+in-memory size fits the budget:
+
+    - PICO files are grouped by their size on disk times PICO_EXPANSION,
+      the growth of a .pico file once its JSON is parsed into Python
+      objects and numpy arrays,
+    - ancillary dataframes are grouped by their measured size
+      (DataFrame.memory_usage(deep=True)) as they are parsed, see
+      ancildata_parser.iter_dataframe_chunks.
+
+A file bigger than the budget on its own is processed in a group of its
+own. After each group, buffered rows are flushed and the group's objects
+are released (release()), so memory use stays near one group's worth.
+
+The peak RSS of each stage is recorded by metrics.track_memory().
+"""
+
+import gc
+import os
+import re
+
+try:
+    from pyspecchio import metrics
+except ImportError:
+    import metrics
+
+# In-memory size of a parsed .pico file / its size on disk (measured on the
+# test PICO files: JSON text, decoded lists and the numpy copies)
+PICO_EXPANSION = 5
+
+_SIZE_UNITS = {'': 1, 'K': 2**10, 'M': 2**20, 'G': 2**30, 'T': 2**40}
+
+
+def parse_size(size):
+    """Bytes from a size such as '512M', '2G', '1.5GB' or '1000000'"""
+    match = re.match(r'^\s*([0-9.]+)\s*([KMGT]?)i?B?\s*$', str(size),
+                     re.IGNORECASE)
+    if not match:
+        raise ValueError("Not a memory size: " + str(size) +
+                         " (e.g. 512M or 2G)")
+    return int(float(match.group(1)) * _SIZE_UNITS[match.group(2).upper()])
+
+
+def estimated_pico_bytes(spectrafile):
+    """Estimated memory needed to process a spectra_parser.SpectraFile"""
+    return os.path.getsize(spectrafile.spath + spectrafile.sfile) * \
+        PICO_EXPANSION
+
+
+def dataframe_bytes(dataframe):
+    """Memory used by a dataframe, including the strings in its columns"""
+    return int(dataframe.memory_usage(deep=True, index=True).sum())
+
+
+def chunk_by_size(items, size_of, budget):
+    """Groups items, in order, into lists whose total size_of(item) is at
+    most budget. An item bigger than the budget gets a list of its own.
+
+    Yields:
+        Lists of items
+    """
+    chunk = []
+    chunk_bytes = 0
+    for item in items:
+        size = size_of(item)
+        if size > budget:
+            metrics.count('memory.over_budget_items')
+        if chunk and chunk_bytes + size > budget:
+            yield chunk
+            chunk = []
+            chunk_bytes = 0
+        chunk.append(item)
+        chunk_bytes += size
+    if chunk:
+        yield chunk
+
+
+def release():
+    """Frees the objects of a processed chunk, including reference cycles
+    (e.g. between pandas objects), before the next chunk is read"""
+    gc.collect()
+    metrics.count('memory.chunks')
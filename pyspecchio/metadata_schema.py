@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+"""
+Metadata type schema for uploading EAV metadata to SPECCHIO.
+
+SPECCHIO stores each attribute's values in one storage field of the eav
+table (string_val, double_val, int_val...), declared as the attribute's
+default_storage_field. The attributes pyspecchio adds are declared in
+edit_mysql_db.sql; this module reads their storage fields from there so the
+conversion for every metadata key is decided once, up front, instead of
+trying a value and retrying as a string when the java conversion fails.
+"""
+
+import os
+import re
+
+SQL_SCHEMA_FILE = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'edit_mysql_db.sql')
+
+# Attributes used by pyspecchio that are part of the standard SPECCHIO
+# database, or otherwise not declared in edit_mysql_db.sql
+STANDARD_STORAGE_FIELDS = {
+    'Batch': 'int_val',
+    'File Name': 'string_val',
+    'Integration Time': 'int_val',
+    'Instrument Serial Number': 'string_val'}
+
+# Storage field assumed for attributes not declared anywhere
+DEFAULT_STORAGE_FIELD = 'string_val'
+
+_ATTRIBUTE_INSERT = re.compile(
+    r"INSERT\s+INTO\s+`specchio`\.`attribute`\s*\((.*?)\)\s*VALUES\s*",
+    re.IGNORECASE | re.DOTALL)
+
+_storage_fields_cache = {}
+
+
+def split_sql_values(text):
+    """Splits the text following VALUES at its top-level commas.
+
+    Returns the list of values (quotes stripped) and the index of the
+    closing bracket. Sub-selects in brackets are kept as one value.
+    """
+    values = []
+    depth = 0
+    in_quote = False
+    current = ''
+    for i, char in enumerate(text):
+        if char == "'" and depth <= 1:
+            in_quote = not in_quote
+        if in_quote:
+            current += char
+            continue
+        if char == '(':
+            depth += 1
+            if depth == 1:
+                continue
+        elif char == ')':
+            depth -= 1
+            if depth == 0:
+                values.append(current.strip().strip("'"))
+                return values, i
+        elif char == ',' and depth == 1:
+            values.append(current.strip().strip("'"))
+            current = ''
+            continue
+        current += char
+    raise ValueError("Unterminated VALUES list in SQL")
+
+
+def read_attribute_storage_fields(sql_filename=SQL_SCHEMA_FILE):
+    """Reads the attribute name -> default_storage_field declarations from
+    the INSERT statements in an SQL file such as edit_mysql_db.sql"""
+    with open(sql_filename) as f:
+        sql = f.read()
+    storage_fields = {}
+    for match in _ATTRIBUTE_INSERT.finditer(sql):
+        columns = [col.strip().strip('`') for col in match.group(1).split(',')]
+        values, _ = split_sql_values(sql[match.end():])
+        row = dict(zip(columns, values))
+        if 'name' in row and 'default_storage_field' in row:
+            storage_fields[row['name']] = row['default_storage_field']
+    return storage_fields
+
+
+def get_storage_fields(sql_filename=SQL_SCHEMA_FILE):
+    """Storage fields of all known attributes, read once per process"""
+    if sql_filename not in _storage_fields_cache:
+        storage_fields = dict(STANDARD_STORAGE_FIELDS)
+        storage_fields.update(read_attribute_storage_fields(sql_filename))
+        _storage_fields_cache[sql_filename] = storage_fields
+    return _storage_fields_cache[sql_filename]
+
+
+def to_string_val(value):
+    """Lists (e.g. calibration coefficients) become comma separated strings
+    """
+    if isinstance(value, (list, tuple)):
+        return ', '.join(str(item) for item in value)
+    return str(value)
+
+
+def to_double_val(value):
+    return float(value)
+
+
+def to_int_val(value):
+    # bool first, as True/False are ints too
+    if isinstance(value, bool):
+        return int(value)
+    return int(round(float(value)))
+
+
+CONVERTERS = {
+    'string_val': to_string_val,
+    'double_val': to_double_val,
+    'int_val': to_int_val}
+
+
+class MetadataSchema(object):
+    """Maps metadata keys to their SPECCHIO attribute and value conversion.
+
+    Args:
+        key_to_attribute: dict of metadata key (e.g. in a pico file) to
+            SPECCHIO attribute name, e.g.
+            specchioDBinterface.MAP_PICO_METADATA_SPECCHIONAME
+        boxing: optional dict of storage field to a callable that wraps
+            the converted python value in the java type for that field,
+            e.g. {'double_val': java.lang.Double}
+        storage_fields: attribute name -> storage field, defaults to those
+            declared in edit_mysql_db.sql
+    """
+
+    def __init__(self, key_to_attribute, boxing=None, storage_fields=None):
+        if storage_fields is None:
+            storage_fields = get_storage_fields()
+        boxing = boxing or {}
+        self.attribute_names = dict(key_to_attribute)
+        self.storage_fields = {}
+        self.converters = {}
+        for key, attribute_name in self.attribute_names.items():
+            field = storage_fields.get(attribute_name, DEFAULT_STORAGE_FIELD)
+            self.storage_fields[key] = field
+            self.converters[key] = self._make_converter(
+                CONVERTERS.get(field, to_string_val), boxing.get(field))
+
+    @staticmethod
+    def _make_converter(convert, box):
+        if box is None:
+            return convert
+        return lambda value: box(convert(value))
+
+    def convert(self, key, value):
+        """Converts a value for the given key to its storage type.
+
+        Returns None for null values, which should not be uploaded.
+        """
+        if value is None:
+            return None
+        return self.converters[key](value)
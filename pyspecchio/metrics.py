@@ -0,0 +1,259 @@
+# -*- coding: utf-8 -*-
+"""
+Run-time instrumentation for the ingestion pipeline.
+
+A single module-level RunMetrics object collects, for the whole run:
+
+    stage timers  - wall clock seconds and number of calls per named stage,
+                    e.g. 'ancil.excel', 'spectra.json_decode', 'upload.insert'
+    counters      - bytes, rows, spectra, JVM calls etc.
+    gauges        - the highest value seen of a measurement, e.g. the Java
+                    heap in use (see jvm.JavaMemorySampler)
+    peak RSS      - with track_memory(), the highest resident set size
+                    reached by the end of each stage, since the outermost
+                    stage open started
+
+The parsers and the db interface record into it with:
+
+    with metrics.timer('ancil.excel'):
+        ...
+    metrics.count('ancil.rows', len(df))
+
+specchio_main.py reports the breakdown at the end of a run with the
+--profile and --metrics-json options.
+"""
+
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+def _read_proc_status(field):
+    """A memory field of /proc/self/status (Linux) in bytes, or None"""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError, ValueError):
+        pass
+    return None
+
+
+def current_rss():
+    """The resident set size of this process in bytes (None if unknown)"""
+    return _read_proc_status('VmRSS')
+
+
+def peak_rss():
+    """The highest resident set size of this process in bytes, since it
+    started or since the last reset_peak_rss()"""
+    peak = _read_proc_status('VmHWM')
+    if peak is None and resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # kilobytes on Linux, bytes on macOS
+        peak *= 1 if os.uname()[0] == 'Darwin' else 1024
+    return peak
+
+
+def reset_peak_rss():
+    """Resets the peak RSS to the current RSS, so the peak of the next
+    stage can be measured (Linux only). Returns False if it cannot be."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except (IOError, OSError):
+        return False
+
+
+class RunMetrics(object):
+    """Accumulates stage timings and counters.
+
+    It can be recorded into from several threads (e.g. the campaign loader
+    and parallel parsers): the totals are updated under a lock.
+
+    The peak RSS is the process's, and resetting it walks the whole
+    address space, so it is only reset when a stage starts with no other
+    stage open in any thread. A nested or concurrent stage's peak is then
+    the highest RSS since the outermost open stage started, and a reset
+    never wipes the peak of a stage still running.
+    """
+
+    def __init__(self):
+        self.memory_tracked = False
+        self._lock = threading.Lock()
+        # Stages open in all threads whose peak RSS is recorded
+        self._memory_stages_open = 0
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.start_time = time.time()
+            self.stage_seconds = defaultdict(float)
+            self.stage_calls = defaultdict(int)
+            self.counters = defaultdict(int)
+            self.gauges = {}
+            self.stage_peak_rss = defaultdict(int)
+            self._local = threading.local()
+
+    @property
+    def _open_peaks(self):
+        """Highest peak RSS of the stages nested in each enclosing stage
+        this thread is timing with memory"""
+        if not hasattr(self._local, 'open_peaks'):
+            self._local.open_peaks = []
+        return self._local.open_peaks
+
+    def track_memory(self, enabled=True):
+        """Records the peak RSS of each stage from now on. Where the peak
+        cannot be reset (not Linux) this is the process's peak so far."""
+        self.memory_tracked = enabled
+
+    @contextmanager
+    def timer(self, stage, memory=True):
+        """Times the enclosed block, adding it to the named stage.
+
+        With memory=False its peak RSS is not recorded even when memory is
+        tracked, for small stages timed very often (e.g. each JVM call),
+        where reading the RSS would cost more than the work timed.
+        """
+        memory = memory and self.memory_tracked
+        if memory:
+            with self._lock:
+                if not self._memory_stages_open:
+                    reset_peak_rss()
+                self._memory_stages_open += 1
+            self._open_peaks.append(0)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            with self._lock:
+                self.stage_seconds[stage] += seconds
+                self.stage_calls[stage] += 1
+            if memory:
+                if self._open_peaks:  # unless reset() since it started
+                    self._record_peak(stage)
+                with self._lock:
+                    self._memory_stages_open -= 1
+
+    def _record_peak(self, stage):
+        # The kernel's peak can read slightly lower later on, so an
+        # enclosing stage's peak is the highest of its own and its nested
+        # stages' peaks
+        open_peaks = self._open_peaks
+        peak = max(open_peaks.pop(), peak_rss() or 0)
+        with self._lock:
+            self.stage_peak_rss[stage] = max(self.stage_peak_rss[stage],
+                                             peak)
+        if open_peaks:
+            open_peaks[-1] = max(open_peaks[-1], peak)
+
+    def count(self, name, value=1):
+        """Adds value to the named counter"""
+        with self._lock:
+            self.counters[name] += value
+
+    def gauge_max(self, name, value):
+        """Keeps the highest value seen of the named gauge"""
+        with self._lock:
+            self.gauges[name] = max(self.gauges.get(name, value), value)
+
+    def as_dict(self):
+        """Returns the metrics as a JSON-serialisable dict"""
+        with self._lock:
+            stages = {}
+            for stage in sorted(self.stage_seconds):
+                stages[stage] = {'seconds': self.stage_seconds[stage],
+                                 'calls': self.stage_calls[stage]}
+                if stage in self.stage_peak_rss:
+                    stages[stage]['peak_rss_bytes'] = \
+                        self.stage_peak_rss[stage]
+            summary = {
+                'total_seconds': time.time() - self.start_time,
+                'stages': stages,
+                'counters': dict(sorted(self.counters.items()))}
+            if self.gauges:
+                summary['gauges'] = dict(sorted(self.gauges.items()))
+        return summary
+
+    def write_json(self, filename):
+        """Writes the metrics to a JSON file"""
+        with open(filename, 'w') as f:
+            json.dump(self.as_dict(), f, indent=2)
+
+    def report(self):
+        """Returns a per-stage breakdown as a printable table"""
+        summary = self.as_dict()
+        total = summary['total_seconds']
+        lines = ["{:<40} {:>10} {:>8} {:>7}".format(
+            'Stage', 'Seconds', 'Calls', '% run')]
+        if self.stage_peak_rss:
+            lines[0] += " {:>12}".format('Peak RSS MB')
+        for stage, stats in summary['stages'].items():
+            percent = 100.0 * stats['seconds'] / total if total else 0.0
+            line = "{:<40} {:>10.3f} {:>8d} {:>7.1f}".format(
+                stage, stats['seconds'], stats['calls'], percent)
+            if 'peak_rss_bytes' in stats:
+                line += " {:>12.1f}".format(stats['peak_rss_bytes'] / 2**20)
+            lines.append(line)
+        lines.append("{:<40} {:>10.3f}".format('Total run time', total))
+        if summary['counters']:
+            lines.append('')
+            lines.append("{:<40} {:>10}".format('Counter', 'Value'))
+            for name, value in summary['counters'].items():
+                lines.append("{:<40} {:>10}".format(name, value))
+        if 'gauges' in summary:
+            lines.append('')
+            lines.append("{:<40} {:>10}".format('Gauge (highest)', 'Value'))
+            for name, value in summary['gauges'].items():
+                lines.append("{:<40} {:>10}".format(name, value))
+        return '\n'.join(lines)
+
+
+class InstrumentedClient(object):
+    """Wraps a SPECCHIO client so every method call is counted and timed.
+
+    Calls to e.g. insertSpectralFile are recorded as the counter
+    'jvm_calls.insertSpectralFile' and the stage 'jvm.insertSpectralFile'.
+    Attribute access is otherwise passed straight through to the client.
+    """
+
+    def __init__(self, client, run_metrics=None):
+        self._client = client
+        self._metrics = run_metrics or METRICS
+
+    def __getattr__(self, name):
+        attr = getattr(self._client, name)
+        if not callable(attr):
+            return attr
+        run_metrics = self._metrics
+
+        def counted_call(*args, **kwargs):
+            run_metrics.count('jvm_calls.' + name)
+            with run_metrics.timer('jvm.' + name, memory=False):
+                return attr(*args, **kwargs)
+        return counted_call
+
+
+METRICS = RunMetrics()
+
+# Module-level shortcuts to the run's metrics
+timer = METRICS.timer
+count = METRICS.count
+reset = METRICS.reset
+report = METRICS.report
+write_json = METRICS.write_json
+as_dict = METRICS.as_dict
+track_memory = METRICS.track_memory
+gauge_max = METRICS.gauge_max
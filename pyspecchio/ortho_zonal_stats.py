@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+"""
+Per-plot band statistics from UAV orthomosaics.
+
+Orthomosaic GeoTIFFs are read in windowed tiles, never as a whole raster.
+Only tiles that overlap a plot polygon are read; each tile is rasterised
+against the plot polygons it intersects and the pixels falling in each plot
+are gathered. Tiles are processed in parallel, then the mean, median and
+standard deviation of every band is computed per plot.
+
+The results are stored in the ancillary data dataframes (see
+ancildata_parser), keyed like the other ancillary files, e.g.
+'ES_F1_20170530_UAV', so they are uploaded with the plot-level metadata.
+
+Plot polygons are read from a GeoJSON file, in the same coordinate reference
+system as the orthomosaics, with the plot ID in a feature property.
+
+Requires the rasterio package.
+"""
+
+import json
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+import rasterio
+from rasterio import features, windows
+
+try:
+    from pyspecchio import ancildata_parser as ancilparser
+    from pyspecchio import metrics
+except ImportError:
+    import ancildata_parser as ancilparser
+    import metrics
+
+DEFAULT_TILE_SIZE = 1024
+
+STATISTICS = ('mean', 'median', 'std')
+
+
+def read_plot_polygons(plots_file, id_property='Plot'):
+    """Reads plot polygons from a GeoJSON file.
+
+    Returns:
+        An OrderedDict of plot ID -> GeoJSON geometry
+    """
+    with open(plots_file) as f:
+        collection = json.load(f)
+    plots = OrderedDict()
+    for feature in collection['features']:
+        plots[str(feature['properties'][id_property])] = feature['geometry']
+    return plots
+
+
+def _flatten_coordinates(coordinates):
+    if isinstance(coordinates[0], (int, float)):
+        yield coordinates
+    else:
+        for item in coordinates:
+            for point in _flatten_coordinates(item):
+                yield point
+
+
+def geometry_bounds(geometry):
+    """Returns (minx, miny, maxx, maxy) of a GeoJSON geometry"""
+    points = np.array(list(_flatten_coordinates(geometry['coordinates'])))
+    return (points[:, 0].min(), points[:, 1].min(),
+            points[:, 0].max(), points[:, 1].max())
+
+
+def bounds_to_window(transform, bounds):
+    """The pixel window (whole pixels) covering (minx, miny, maxx, maxy)"""
+    minx, miny, maxx, maxy = bounds
+    inverse = ~transform
+    corners = [inverse * (x, y) for x in (minx, maxx) for y in (miny, maxy)]
+    cols = [col for col, _ in corners]
+    rows = [row for _, row in corners]
+    col_off = int(np.floor(min(cols)))
+    row_off = int(np.floor(min(rows)))
+    return windows.Window(col_off, row_off,
+                          int(np.ceil(max(cols))) - col_off,
+                          int(np.ceil(max(rows))) - row_off)
+
+
+def tile_windows(width, height, tile_size=DEFAULT_TILE_SIZE):
+    """Yields the windows tiling a raster of the given size"""
+    for row_off in range(0, height, tile_size):
+        for col_off in range(0, width, tile_size):
+            yield windows.Window(col_off, row_off,
+                                 min(tile_size, width - col_off),
+                                 min(tile_size, height - row_off))
+
+
+def _windows_intersect(a, b):
+    return (a.col_off < b.col_off + b.width and
+            b.col_off < a.col_off + a.width and
+            a.row_off < b.row_off + b.height and
+            b.row_off < a.row_off + a.height)
+
+
+def plan_tiles(dataset, plots, tile_size=DEFAULT_TILE_SIZE):
+    """Lists the tiles that overlap any plot, with the plots they overlap.
+
+    Returns:
+        A list of (window, [plot IDs]) tuples
+    """
+    plot_windows = dict(
+        (plot_id, bounds_to_window(dataset.transform,
+                                   geometry_bounds(geometry)))
+        for plot_id, geometry in plots.items())
+    tiles = []
+    for tile in tile_windows(dataset.width, dataset.height, tile_size):
+        overlapping = [plot_id for plot_id, window in plot_windows.items()
+                       if _windows_intersect(tile, window)]
+        if overlapping:
+            tiles.append((tile, overlapping))
+    return tiles
+
+
+def read_tile_plot_pixels(ortho_file, window, plots, plot_ids):
+    """Reads one tile and returns the valid pixels of each plot in it.
+
+    Each call opens its own dataset handle, as rasterio datasets must not
+    be shared between threads.
+
+    Returns:
+        A dict of plot ID -> array of shape (bands, pixels)
+    """
+    with rasterio.open(ortho_file) as dataset:
+        data = dataset.read(window=window, masked=True)
+        transform = dataset.window_transform(window)
+    metrics.count('ortho.tiles')
+    metrics.count('ortho.pixels_read', data.shape[1] * data.shape[2])
+    labels = features.rasterize(
+        [(plots[plot_id], i + 1) for i, plot_id in enumerate(plot_ids)],
+        out_shape=data.shape[1:], transform=transform, fill=0,
+        dtype='int32')
+    # A pixel is only used if it is valid in every band
+    valid = ~np.ma.getmaskarray(data).any(axis=0)
+    values = np.ma.getdata(data)
+    plot_pixels = {}
+    for i, plot_id in enumerate(plot_ids):
+        in_plot = (labels == i + 1) & valid
+        if in_plot.any():
+            plot_pixels[plot_id] = values[:, in_plot]
+    return plot_pixels
+
+
+def zonal_statistics(ortho_file, plots, tile_size=DEFAULT_TILE_SIZE,
+                     workers=None):
+    """Computes the mean, median and std of every band for each plot.
+
+    Args:
+        ortho_file: path of the orthomosaic GeoTIFF
+        plots: dict of plot ID -> GeoJSON geometry (see read_plot_polygons)
+        tile_size: width/height in pixels of the tiles read
+        workers: number of threads reading tiles (None for the default)
+
+    Returns:
+        A dataframe with a row per plot: the plot ID in the 'Plot' column,
+        then columns named e.g. 'Band1_mean', 'Band1_median', 'Band1_std'.
+        Plots with no valid pixels have NaN statistics.
+    """
+    with rasterio.open(ortho_file) as dataset:
+        band_count = dataset.count
+        tiles = plan_tiles(dataset, plots, tile_size)
+
+    pixels = dict((plot_id, []) for plot_id in plots)
+    with metrics.timer('ortho.zonal_statistics'):
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            tile_results = executor.map(
+                lambda tile: read_tile_plot_pixels(
+                    ortho_file, tile[0], plots, tile[1]), tiles)
+            for tile_pixels in tile_results:
+                for plot_id, values in tile_pixels.items():
+                    pixels[plot_id].append(values)
+
+    rows = []
+    for plot_id in plots:
+        row = OrderedDict([('Plot', plot_id)])
+        values = np.concatenate(pixels[plot_id], axis=1) \
+            if pixels[plot_id] else np.empty((band_count, 0))
+        for band in range(band_count):
+            band_values = values[band].astype('float64')
+            for statistic in STATISTICS:
+                name = 'Band{}_{}'.format(band + 1, statistic)
+                row[name] = getattr(np, statistic)(band_values) \
+                    if band_values.size else np.nan
+        rows.append(row)
+    return pd.DataFrame(rows)
+
+
+def extract_ortho_format(filefullname, dictname, plots_file,
+                         tile_size=DEFAULT_TILE_SIZE, workers=None):
+    """Stores the per-plot statistics of an orthomosaic in the ancillary
+    dataframes, as extract_excel_format does for the excel files"""
+    plots = read_plot_polygons(plots_file)
+    ancilparser.dataframes[dictname] = zonal_statistics(
+        filefullname, plots, tile_size, workers)
+    metrics.count('ortho.files')
@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+"""
+Local catalog of the metadata of every PICO spectrum under a directory tree.
+
+Finding e.g. "all upwelling spectra from QEP01651 with an integration time
+over 300 ms in May" otherwise means opening every .pico file. A
+PicoCatalog keeps one row per spectrum in a SQLite file:
+
+    path, spectra_number, mtime, size, serial, datetime, direction,
+    type, run, integration_time_ms, pixels
+
+with indexes on the columns most often selected on. update() scans the
+directory trees and only parses the files that are new or have changed
+(by modification time and size) since the last scan, in a process pool;
+spectra of files that have gone are dropped. Selections are then SQL
+queries:
+
+    catalog = PicoCatalog()
+    catalog.update(['/data/pico'], workers=8)
+    may = catalog.select("serial = ? AND direction = 'Upwelling'"
+                         " AND integration_time_ms > 300"
+                         " AND datetime >= '2017-05' AND datetime < '2017-06'",
+                         ('QEP01651',))
+
+Datetimes are the ISO 8601 strings of the files, so they compare in time
+order as strings.
+"""
+
+import os
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+try:
+    from pyspecchio import metrics
+    from pyspecchio.file_cache import get_cache_dir
+    from pyspecchio.spectra_parser import SpectraFile
+except ImportError:
+    import metrics
+    from file_cache import get_cache_dir
+    from spectra_parser import SpectraFile
+
+DEFAULT_CATALOG_NAME = 'pico_catalog.sqlite'
+
+CATALOG_COLUMNS = ('path', 'spectra_number', 'mtime', 'size', 'serial',
+                   'datetime', 'direction', 'type', 'run',
+                   'integration_time_ms', 'pixels')
+
+# Milliseconds per IntegrationTimeUnits
+INTEGRATION_TIME_MS = {'milliseconds': 1.0, 'microseconds': 1e-3,
+                       'seconds': 1e3}
+
+# Files parsed per task sent to a worker process
+SCAN_CHUNK_SIZE = 16
+
+
+def find_pico_files(top_dirs):
+    """The absolute paths of the .pico files under the directories"""
+    paths = []
+    for top in top_dirs:
+        for dirname, _, files in os.walk(top):
+            paths.extend(os.path.abspath(os.path.join(dirname, fname))
+                         for fname in files if fname.endswith('.pico'))
+    return sorted(paths)
+
+
+def integration_time_ms(metadata):
+    time = metadata.get('IntegrationTime')
+    if time is None:
+        return None
+    return time * INTEGRATION_TIME_MS.get(
+        metadata.get('IntegrationTimeUnits', 'milliseconds'), 1.0)
+
+
+def scan_file(path):
+    """Parses the metadata of one .pico file (in a worker process).
+
+    Returns:
+        (path, mtime, size, rows) where rows are tuples of CATALOG_COLUMNS,
+        or no rows if the file cannot be parsed
+    """
+    stat = os.stat(path)
+    spectrafile = SpectraFile(os.path.basename(path),
+                              os.path.join(os.path.dirname(path), ''))
+    try:
+        spectra = spectrafile.read_json()['Spectra']
+    except (ValueError, KeyError, TypeError):
+        return path, stat.st_mtime, stat.st_size, []
+    rows = []
+    for i, spectrum in enumerate(spectra):
+        metadata = spectrum['Metadata']
+        rows.append((path, i, stat.st_mtime, stat.st_size,
+                     metadata.get('SerialNumber'), metadata.get('Datetime'),
+                     metadata.get('Direction'), metadata.get('Type'),
+                     metadata.get('Run'), integration_time_ms(metadata),
+                     len(spectrum['Pixels'])))
+    return path, stat.st_mtime, stat.st_size, rows
+
+
+class PicoCatalog(object):
+    """SQLite catalog of PICO spectra metadata.
+
+    Args:
+        filename: the SQLite file, by default in PYSPECCHIO_CACHE_DIR,
+            or ':memory:' for a catalog lasting only this run.
+    """
+
+    def __init__(self, filename=None):
+        if filename is None:
+            filename = os.path.join(get_cache_dir('catalog'),
+                                    DEFAULT_CATALOG_NAME)
+        self.connection = sqlite3.connect(filename)
+        self.connection.executescript(
+            "CREATE TABLE IF NOT EXISTS pico_file ("
+            " path TEXT PRIMARY KEY, mtime REAL, size INTEGER);"
+            "CREATE TABLE IF NOT EXISTS spectrum ("
+            " path TEXT, spectra_number INTEGER, mtime REAL, size INTEGER,"
+            " serial TEXT, datetime TEXT, direction TEXT, type TEXT,"
+            " run TEXT, integration_time_ms REAL, pixels INTEGER,"
+            " PRIMARY KEY (path, spectra_number));"
+            "CREATE INDEX IF NOT EXISTS spectrum_serial_datetime"
+            " ON spectrum (serial, datetime);"
+            "CREATE INDEX IF NOT EXISTS spectrum_datetime"
+            " ON spectrum (datetime);"
+            "CREATE INDEX IF NOT EXISTS spectrum_direction"
+            " ON spectrum (direction, integration_time_ms);")
+        self.connection.commit()
+
+    def update(self, top_dirs, workers=None):
+        """Brings the catalog up to date with the .pico files under the
+        directories, parsing only new and changed files.
+
+        Returns:
+            A dict of the number of files 'added', 'changed', 'removed'
+            and 'unchanged'
+        """
+        known = dict((path, (mtime, size)) for path, mtime, size in
+                     self.connection.execute("SELECT * FROM pico_file"))
+        with metrics.timer('catalog.walk'):
+            paths = find_pico_files(top_dirs)
+        to_scan = []
+        for path in paths:
+            stat = os.stat(path)
+            if known.get(path) != (stat.st_mtime, stat.st_size):
+                to_scan.append(path)
+        tops = tuple(os.path.join(os.path.abspath(top), '')
+                     for top in top_dirs)
+        removed = [path for path in set(known) - set(paths)
+                   if path.startswith(tops)]
+
+        with metrics.timer('catalog.scan'):
+            if workers is not None and workers > 1 and len(to_scan) > 1:
+                with ProcessPoolExecutor(max_workers=workers) as executor:
+                    scanned = list(executor.map(scan_file, to_scan,
+                                                chunksize=SCAN_CHUNK_SIZE))
+            else:
+                scanned = [scan_file(path) for path in to_scan]
+
+        with metrics.timer('catalog.write'):
+            with self.connection:
+                for path in removed + to_scan:
+                    self.connection.execute(
+                        "DELETE FROM spectrum WHERE path = ?", (path,))
+                self.connection.executemany(
+                    "DELETE FROM pico_file WHERE path = ?",
+                    [(path,) for path in removed])
+                for path, mtime, size, rows in scanned:
+                    self.connection.execute(
+                        "INSERT OR REPLACE INTO pico_file VALUES (?, ?, ?)",
+                        (path, mtime, size))
+                    self.connection.executemany(
+                        "INSERT INTO spectrum VALUES"
+                        " (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+                    if not rows:
+                        metrics.count('catalog.unreadable_files')
+        metrics.count('catalog.files_scanned', len(to_scan))
+        changed = sum(1 for path in to_scan if path in known)
+        return {'added': len(to_scan) - changed, 'changed': changed,
+                'removed': len(removed),
+                'unchanged': len(paths) - len(to_scan)}
+
+    def select(self, where=None, params=()):
+        """The spectra matching an SQL condition on CATALOG_COLUMNS (all of
+        them if None), as a DataFrame in path and spectra number order"""
+        sql = "SELECT * FROM spectrum"
+        if where:
+            sql += " WHERE " + where
+        with metrics.timer('catalog.select'):
+            return pd.read_sql_query(
+                sql + " ORDER BY path, spectra_number", self.connection,
+                params=params)
+
+    @staticmethod
+    def spectra_to_upload(selection):
+        """The files and spectra numbers of a selection, as (SpectraFile,
+        spectra numbers) pairs for specchio_upload_pico_spectra"""
+        return [(SpectraFile(os.path.basename(path),
+                             os.path.join(os.path.dirname(path), '')),
+                 [int(number) for number in group['spectra_number']])
+                for path, group in selection.groupby('path', sort=True)]
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+"""
+Query builder for finding spectra by their metadata on the server.
+
+Instead of assembling EAVQueryConditionObjects by hand (see
+specchio_connect.py), or fetching a broad set of ids and filtering them
+locally, conditions are chained:
+
+    query = SpectraQuery(db_interface) \\
+        .where('Altitude', '>=', 50) \\
+        .where('Direction', '==', 'Upwelling')
+    ids = query.ids()
+    df = query.to_dataframe(['Direction', 'Altitude'])
+
+Attributes are looked up in the db interface's attributes name hash, which
+is fetched from the server once, so a misspelt attribute is reported before
+anything is sent. All the conditions are compiled into one Query, so the
+server does the filtering and only the matching ids are returned, in one
+round trip.
+"""
+
+import difflib
+
+try:
+    from pyspecchio import metrics
+    from pyspecchio import spectra_download
+    from pyspecchio.specchio_db_interface import spquery
+except ImportError:
+    import metrics
+    import spectra_download
+    from specchio_db_interface import spquery
+
+# Operators accepted by where() -> SPECCHIO EAV query operators
+OPERATORS = {
+    '==': '=', '=': '=',
+    '!=': '<>', '<>': '<>',
+    '<': '<', '<=': '<=', '>': '>', '>=': '>=',
+    'like': 'like'}
+
+
+class SpectraQuery(object):
+    """Conditions on spectra metadata, all of which must hold.
+
+    where() returns a new query, so a query can be extended in different
+    ways without changing it.
+
+    Args:
+        db_interface: a specchioDBinterface, whose client runs the query
+    """
+
+    def __init__(self, db_interface, conditions=()):
+        self.db_interface = db_interface
+        # (attribute name, SPECCHIO operator, value as a string)
+        self.conditions = tuple(conditions)
+
+    def _check_attribute(self, attribute_name):
+        if self.db_interface.get_attribute(attribute_name) is not None:
+            return
+        attributes = self.db_interface.attributes
+        names = [str(name) for name in (
+            attributes.keySet() if hasattr(attributes, 'keySet')
+            else attributes)]
+        message = "Unknown attribute: " + attribute_name
+        close = difflib.get_close_matches(attribute_name, names)
+        if close:
+            message += ". Did you mean: " + ', '.join(close)
+        raise KeyError(message)
+
+    def where(self, attribute_name, operator, value):
+        """Adds a condition, e.g. where('Altitude', '>=', 50).
+
+        The operator is one of OPERATORS, or 'between' with a (low, high)
+        value for low <= attribute <= high.
+        """
+        self._check_attribute(attribute_name)
+        operator = operator.lower()
+        if operator == 'between':
+            low, high = value
+            conditions = [(attribute_name, '>=', str(low)),
+                          (attribute_name, '<=', str(high))]
+        elif operator in OPERATORS:
+            conditions = [(attribute_name, OPERATORS[operator], str(value))]
+        else:
+            raise ValueError("Unknown operator: " + operator +
+                             ". Choose from: " +
+                             ', '.join(sorted(OPERATORS) + ['between']))
+        return SpectraQuery(self.db_interface,
+                            self.conditions + tuple(conditions))
+
+    def compile(self):
+        """The SPECCHIO Query object with all the conditions"""
+        if not self.conditions:
+            raise ValueError("The query has no conditions; add some with"
+                             " where() rather than fetching every spectrum")
+        query = spquery.Query()
+        for attribute_name, operator, value in self.conditions:
+            cond = spquery.EAVQueryConditionObject(
+                self.db_interface.get_attribute(attribute_name))
+            cond.setValue(value)
+            cond.setOperator(operator)
+            query.add_condition(cond)
+        return query
+
+    def ids(self):
+        """Runs the query on the server, returning the matching ids"""
+        with metrics.timer('query.execute'):
+            ids = self.db_interface.specchio_client \
+                .getSpectrumIdsMatchingQuery(self.compile())
+        ids = [int(spectrum_id) for spectrum_id in ids]
+        metrics.count('query.ids', len(ids))
+        return ids
+
+    def count(self):
+        return len(self.ids())
+
+    def to_dataframe(self, attributes=(), **kwargs):
+        """Downloads the matching spectra and attributes into a wide
+        DataFrame; keyword arguments are passed to spectra_download.download
+        """
+        return spectra_download.download(self.ids(), attributes, **kwargs)
+
+    def __repr__(self):
+        return 'SpectraQuery({})'.format(' AND '.join(
+            '{} {} {!r}'.format(*condition)
+            for condition in self.conditions))
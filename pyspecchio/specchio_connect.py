@@ -4,24 +4,11 @@ to the SPECCHIO API
 """
 
 import jpype as jp
-import sys
-import os
-
-def init_jvm(jvmpath=None):
-    """
-    Checks first to see if JVM is already running.
-    """
-    if jp.isJVMStarted():
-        return
-    try:
-        client_java_path = os.environ['SPECCHIO_JAVA_CLIENT']
-        client_java_argument = "-Djava.class.path=" + client_java_path
-        jp.startJVM(jp.getDefaultJVMPath(), "-ea", client_java_argument)
-    except Exception as exc:
-        print(exc)
-        sys.exit(1)
-
-init_jvm()
+
+import jvm
+
+# Started with the JVM options in the environment (see jvm.py)
+jvm.start_jvm()
 
 SPECCHIO = jp.JPackage('ch').specchio.client
 
@@ -91,12 +78,16 @@ unit = space.getMeasurementUnit().getUnitName()
 def plot_spectra():
     import numpy as np
     import matplotlib.pyplot as plt
+    import spectra_plot
 
     axes = plt.gca()
+    # Lines for a few thousand spectra, a density image for more
+    spectra = np.array([np.asarray(vector, dtype='float64')
+                        for vector in vectors])
+    spectra_plot.plot_spectra(np.asarray(wvl, dtype='float64'), spectra,
+                              axes)
     axes.set_xlim([350,2500])
     axes.set_ylim([0,1])
-    y = np.rot90(vectors, 3)
-    plt.plot(wvl, y)
     plt.show()
 
 plot_spectra()
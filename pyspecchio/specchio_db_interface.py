@@ -5,42 +5,113 @@ Created on Mon Feb 26 09:54:34 2018
 
 @author: Declan Valters
 """
+import json
 import os
-import sys
 
-import jpype as jp
 import numpy as np
 import pandas as pd
 
-import spectra_parser as specp
-import ancildata_parser as ancilparser
+try:
+    from pyspecchio import spectra_parser as specp
+    from pyspecchio import ancildata_parser as ancilparser
+    from pyspecchio import metrics
+    from pyspecchio import metadata_schema as metaschema
+    from pyspecchio import spectra_dedup as dedup
+    from pyspecchio import memory_budget as membudget
+    from pyspecchio import jvm
+except ImportError:
+    import spectra_parser as specp
+    import ancildata_parser as ancilparser
+    import metrics
+    import metadata_schema as metaschema
+    import spectra_dedup as dedup
+    import memory_budget as membudget
+    import jvm
+
+# 'java' talks to a SPECCHIO server through JPype, 'fake' uses the offline
+# stand-in client in specchio_fake_client (for testing and benchmarking) and
+# 'sql' bulk loads straight into the database tables (specchio_sql_client).
+SPECCHIO_CLIENT_BACKEND = os.environ.get('SPECCHIO_CLIENT_BACKEND', 'java')
 
 
 def init_jvm(jvmpath=None):
     """
-    Checks first to see if JVM is already running.
+    Starts the JVM for the java backend, if it is not already running,
+    with the options configured in the environment (see jvm.py).
     """
-    if jp.isJVMStarted():
+    if SPECCHIO_CLIENT_BACKEND != 'java':
         return
-    try:
-        client_java_path = os.environ['SPECCHIO_JAVA_CLIENT']
-        client_java_argument = "-Djava.class.path=" + client_java_path
-        jp.startJVM(jp.getDefaultJVMPath(), "-ea", client_java_argument)
-    except Exception as exc:
-        print(exc)
-        sys.exit(1)
+    jvm.start_jvm(jvmpath)
 
-init_jvm()
 
-spclient = jp.JPackage('ch').specchio.client
-spquery = jp.JPackage('ch').specchio.queries
-sptypes = jp.JPackage('ch').specchio.types
-spgui = jp.JPackage('ch').specchio.gui
-spreader_campaign = jp.JPackage('ch').specchio.file.reader.campaign
+if SPECCHIO_CLIENT_BACKEND in ('fake', 'sql'):
+    try:
+        from pyspecchio import specchio_fake_client as fakeclient
+        from pyspecchio import specchio_sql_client as sqlclient
+    except ImportError:
+        import specchio_fake_client as fakeclient
+        import specchio_sql_client as sqlclient
+
+    # Both use the plain python types of the fake client
+    if SPECCHIO_CLIENT_BACKEND == 'sql':
+        spclient = sqlclient
+    else:
+        spclient = fakeclient
+    spquery = fakeclient
+    sptypes = fakeclient
+    spreader_campaign = fakeclient
+    JavaFloat = float
+    JavaDouble = float
+    JavaInteger = int
+    JavaArrayList = fakeclient.JavaList
+    JavaException = fakeclient.JavaException
+else:
+    import jpype as jp
+
+    init_jvm()
+
+    spclient = jp.JPackage('ch').specchio.client
+    spquery = jp.JPackage('ch').specchio.queries
+    sptypes = jp.JPackage('ch').specchio.types
+    spgui = jp.JPackage('ch').specchio.gui
+    spreader_campaign = jp.JPackage('ch').specchio.file.reader.campaign
+    JavaFloat = jp.java.lang.Float
+    JavaDouble = jp.java.lang.Double
+    JavaInteger = jp.java.lang.Integer
+    JavaArrayList = jp.java.util.ArrayList
+    JavaException = jp.JavaException
 
 # TODO: Call or attribute? Check API here...
 metaparam = sptypes.MetaParameter
 
+# Java type each SPECCHIO storage field's values are boxed in
+JAVA_STORAGE_TYPES = {
+    'double_val': JavaDouble,
+    'int_val': JavaInteger}
+
+
+def to_java_float_list(vector):
+    """Converts a 1D sequence (e.g. wavelengths) to a list of java Floats"""
+    with metrics.timer('upload.java_conversion', memory=False):
+        java_floats = [JavaFloat(x) for x in vector]
+    metrics.count('upload.java_floats', len(java_floats))
+    return java_floats
+
+
+def to_java_float_lists(array):
+    """Converts a 2D numpy array of spectra to a list of lists of java
+    Floats, one list per spectrum (row)"""
+    return [to_java_float_list(row) for row in array]
+
+
+def to_java_id_list(ids):
+    """Converts spectrum ids to a java ArrayList of Integers, as taken by
+    getSpaces() and getMetaparameterValues()"""
+    java_ids = JavaArrayList()
+    for spectrum_id in ids:
+        java_ids.add(JavaInteger(int(spectrum_id)))
+    return java_ids
+
 
 class SpecchioClient(object):
     """Specchio db client in Python object form"""
@@ -92,8 +163,13 @@ class specchioDBinterface(object):
             'Wavelength Calibration Coefficients',
         'name': 'name'}
 
+    # Attribute the server stores each spectrum's file name in
+    FILE_NAME_ATTRIBUTE = 'File Name'
+
     # Other metadata -should contain sublevel headings or No?
     # 'Vegetation Biophysical Parameters'
+    # The dtypes these columns are read as are declared per category in
+    # ancildata_parser.ANCIL_DTYPES
     MAP_ANCIL_METADATA_SPECCHIONAME = {
         'Fluorescence': '',  # Tricky to see how this will fit into SPECCHIO DB
         'GS':               ('Fertiliser_level', 'GS'),
@@ -120,27 +196,169 @@ class specchioDBinterface(object):
                            'AmmoniamgperlN'),
         'ResinExtracts':  ('Fertiliser_level', 'Ammonia_set1', 'Nitrate_set1'),
         'Moisture':       ('Fertiliser_level', 'Moisture%g/g'),
-        'pH':             ('Fertiliser_level', 'pH')}
-
-    def __init__(self, campaign_name):
+        'pH':             ('Fertiliser_level', 'pH'),
+        # Per-plot statistics of UAV orthomosaics (ortho_zonal_stats),
+        # for cameras of up to five bands
+        'UAV': tuple('Band{}_{}'.format(band, statistic)
+                     for band in range(1, 6)
+                     for statistic in ('mean', 'median', 'std'))}
+
+    def __init__(self, campaign_name, client=None, deduplicator=None,
+                 similarity_index=None, journal=None, resampler=None,
+                 ancil_snapshot=None):
         """
         Check JVM is up and running, set up a database client and connect
         to the server.
+
+        A client object may be passed in instead, e.g. a BulkSQLClient for
+        a particular database connection. If a spectra_dedup.Deduplicator is
+        given, spectra that have already been uploaded are skipped. If a
+        spectral_index.SpectralIndex is given, uploaded spectra are added to
+        it (keyed by their spectrum ID), and it is saved on flush(). If an
+        upload_journal.UploadJournal is given, the progress of each spectra
+        file is recorded in it, and with resume, files already uploaded
+        are skipped. If a spectra_resample.Resampler is given, PICO spectra
+        are uploaded resampled onto its common wavelength grid, rather
+        than padded to 2048 pixels. If an ancil_snapshot.AncilSnapshot is
+        given, the ancillary data cells uploaded are recorded in it, for
+        update_ancil_metadata to find what has changed since.
         """
         init_jvm()
         self.campaign_name = campaign_name
-        client_factory = spclient.SPECCHIOClientFactory.getInstance()
-        descriptor_list = client_factory.getAllServerDescriptors()
-        self.specchio_client = client_factory.createClient(
-            descriptor_list.get(0))
-
-        # Set the campaign name and ID
+        if client is None:
+            client_factory = spclient.SPECCHIOClientFactory.getInstance()
+            descriptor_list = client_factory.getAllServerDescriptors()
+            client = client_factory.createClient(descriptor_list.get(0))
+        # Every client (JVM) call is counted and timed in the run metrics
+        self.specchio_client = metrics.InstrumentedClient(client)
+
+        # Set the campaign name and ID, reusing the campaign if one with
+        # this name already exists on the server
         self.campaign = sptypes.SpecchioCampaign()
         self.campaign.setName(self.campaign_name)
-        self.c_id = self.specchio_client.insertCampaign(self.campaign)
+        self.c_id = self.get_or_create_campaign_id(self.campaign)
         # Store the campaign ID in the campaign object
         self.campaign.setId(self.c_id)
         self.subhierarchy = "PlotData"
+        # Session cache of (campaign ID, hierarchy path) -> hierarchy ID
+        self.hierarchy_ids = {}
+        # Attribute name -> attribute, fetched from the server once
+        self.attributes = None
+        # Target type of each pico metadata value, decided once up front
+        self.pico_schema = metaschema.MetadataSchema(
+            self.MAP_PICO_METADATA_SPECCHIONAME, JAVA_STORAGE_TYPES)
+        # And of the ancillary data columns, which are named as their
+        # attributes, for metadata updates
+        self.ancil_schema = metaschema.MetadataSchema(
+            dict((column, column) for columns in
+                 self.MAP_ANCIL_METADATA_SPECCHIONAME.values()
+                 if isinstance(columns, tuple) for column in columns),
+            JAVA_STORAGE_TYPES)
+        self.deduplicator = deduplicator
+        self.similarity_index = similarity_index
+        self.journal = journal
+        self.resampler = resampler
+        self.ancil_snapshot = ancil_snapshot
+
+    def flush(self):
+        """Writes out any spectra still buffered by the client. Only the
+        bulk SQL backend buffers; other clients insert immediately.
+
+        The inserts held in the journal and the content hashes held by the
+        deduplicator are then committed, and the similarity index, if any,
+        is saved."""
+        if hasattr(self.specchio_client, 'flush'):
+            self.specchio_client.flush()
+        if self.journal is not None:
+            self.journal.commit_inserted(self.campaign_name)
+        if self.deduplicator is not None:
+            self.deduplicator.commit_uploaded(self.campaign_name)
+        if self.similarity_index is not None and \
+                self.similarity_index.path is not None:
+            self.similarity_index.save()
+
+    def record_progress(self, spectrafile, status, spectra_numbers=None,
+                        spectrum_ids=None, total=None):
+        """Records a spectra file's upload progress in the journal, if
+        there is one"""
+        if self.journal is not None:
+            self.journal.record(self.campaign_name, spectrafile, status,
+                                spectra_numbers, spectrum_ids, total)
+
+    def record_inserted(self, spectrafile, spectrum_ids):
+        """Records an acknowledged insert. It is done unless the client
+        is still buffering it (see flush())."""
+        if self.journal is None:
+            return
+        if hasattr(self.specchio_client, 'flush'):
+            self.record_progress(spectrafile, 'inserted',
+                                 spectrum_ids=spectrum_ids)
+            # The client may have written out its buffer with this insert
+            if not getattr(self.specchio_client, 'pending_spectra', 0):
+                self.journal.commit_inserted(self.campaign_name)
+        else:
+            self.record_progress(spectrafile, 'done',
+                                 spectrum_ids=spectrum_ids)
+
+    def add_to_similarity_index(self, spectrafile, spectra, metadata,
+                                spectra_numbers, spectrum_ids):
+        """Adds uploaded spectra to the similarity index, on the wavelengths
+        of their calibration coefficients. The spectra sharing a
+        wavelength grid are added together (with PCA, the index holds them
+        until it has enough to fit its components). They are keyed by their
+        spectrum ID, or by 'path/file#number' if the client did not return
+        the IDs."""
+        if spectrum_ids is None or len(spectrum_ids) != len(spectra_numbers):
+            spectrum_ids = ['{}#{}'.format(
+                spectrafile.spath + spectrafile.sfile, i)
+                for i in spectra_numbers]
+        groups = {}
+        for i, spectrum_id in zip(spectra_numbers, spectrum_ids):
+            coefficients = metadata[i]['WavelengthCalibrationCoefficients']
+            key = (tuple(coefficients), len(spectra[i]))
+            groups.setdefault(key, ([], []))
+            groups[key][0].append(spectra[i])
+            groups[key][1].append(spectrum_id)
+        with metrics.timer('upload.similarity_index'):
+            for (coefficients, num_pixels), (group, keys) in groups.items():
+                self.similarity_index.add(
+                    group, specp.wavelengths_from_coefficients(
+                        coefficients, num_pixels), keys)
+
+    def get_or_create_campaign_id(self, campaign):
+        """Returns the ID of the campaign with the same name on the server,
+        inserting it as a new campaign only if there is none."""
+        for existing in self.specchio_client.getCampaigns():
+            if existing.getName() == campaign.getName():
+                return existing.getId()
+        return self.specchio_client.insertCampaign(campaign)
+
+    def get_hierarchy_id(self, hierarchy_path):
+        """Returns the ID of a (possibly nested) hierarchy in the campaign,
+        creating it on the server if needed.
+
+        Args:
+            hierarchy_path: hierarchy names separated by '/', e.g.
+                "PlotData/ES_F1/20170420" for a site and date level below
+                PlotData.
+
+        IDs are cached for the session, so each level is only looked up on
+        the server once.
+        """
+        key = (self.c_id, hierarchy_path)
+        if key in self.hierarchy_ids:
+            return self.hierarchy_ids[key]
+        # 0 as the parent ID means the hierarchy is at the top level
+        parent_id = 0
+        path = ''
+        for name in hierarchy_path.split('/'):
+            path = path + '/' + name if path else name
+            if (self.c_id, path) not in self.hierarchy_ids:
+                self.hierarchy_ids[(self.c_id, path)] = \
+                    self.specchio_client.getSubHierarchyId(
+                        self.campaign, name, parent_id)
+            parent_id = self.hierarchy_ids[(self.c_id, path)]
+        return parent_id
 
     @classmethod
     def read_metadata(cls, filename):
@@ -156,16 +374,20 @@ class specchioDBinterface(object):
         return df
 
     def set_spectra_file_info(
-            self, spspectra_file, spectra_filepath, spectra_filename):
-        """Set basic info about the spectra file being processed"""
+            self, spspectra_file, spectra_filepath, spectra_filename,
+            hierarchy_path=None):
+        """Set basic info about the spectra file being processed.
+
+        The file is stored under hierarchy_path (see get_hierarchy_id), or
+        the default subhierarchy if none is given.
+        """
         # What happens if is dataframe?
         spspectra_file.setPath(spectra_filepath)
         spspectra_file.setFilename(spectra_filename)
         spspectra_file.setCompany('UoE')
-        # Creating a metadata hierarchy
-        hierarchy_id = self.specchio_client.getSubHierarchyId(
-            self.campaign, self.subhierarchy, 0)
-        # 0 argument specifices the hierarchy has no parent.
+        # Get (or create) the metadata hierarchy
+        hierarchy_id = self.get_hierarchy_id(
+            hierarchy_path or self.subhierarchy)
         # Set the campaign and hierarchy to store in
         spspectra_file.setHierarchyId(hierarchy_id)
         spspectra_file.setCampaignId(self.c_id)
@@ -211,14 +433,20 @@ class specchioDBinterface(object):
         (Not a 2D array, as might be expected)
         """
         return np.array(
-            [spectrafile.get_spectra_pixels(x) for x in range(0, 4)])
+            [spectrafile.get_spectra_pixels(x) for x in range(0, 4)],
+            dtype=object)
 
     @classmethod
-    def get_all_ancil_metadata(cls, ancildatadir):
+    def get_all_ancil_metadata(cls, ancildatadir, plots_file=None,
+                               filenames=None):
         """
-        Gets all the dataframes from the ancillary data.
+        Gets all the dataframes from the ancillary data, or only those of
+        the given files.
+
+        UAV orthomosaics are included if a plot polygons file is given.
         """
-        return ancilparser.extract_dataframes(ancildatadir)
+        return ancilparser.extract_dataframes(ancildatadir, plots_file,
+                                              filenames)
 
     def map_pico_spectrafile_to_plotID(self):
         """Gets the PlotID from the pico file...somehow"""
@@ -229,42 +457,50 @@ class specchioDBinterface(object):
         """Gets a spectra from the PICO json spectra files"""
         return specp.get_spectra_pixels(spectra_num)
 
+    def get_attribute(self, attribute_name):
+        """Returns the server's attribute with this name, or None.
+
+        The attributes name hash is only fetched from the server once.
+        """
+        if self.attributes is None:
+            self.attributes = self.specchio_client.getAttributesNameHash()
+        return self.attributes.get(attribute_name)
+
     def retrieve_metadata_from_hash(self, metadata_key):
         mp = metaparam.newInstance(
-                self.specchio_client.getAttributesNameHash().get(
+                self.get_attribute(
                         self.MAP_PICO_METADATA_SPECCHIONAME[metadata_key]))
         return mp
 
     def add_pico_metadata_for_spectra(self, smd, metadata, spectra_index):
         """Adds the spectrometer-specific metadata to the spectra file
 
+        Each value is converted to the type of its attribute's storage field
+        (see metadata_schema), lists becoming comma separated strings.
+        Null values, and keys with no attribute on the server, are skipped.
+
         Todo:
-            Deal better with null pointer exception.
-            How to handle 'null' unquoted value in pico data
-            Conversion of lists to comma separated string.
             Add plot number metadata.
         """
+        spectra_metadata = metadata[spectra_index]
         for metadata_key in self.PICO_METADATA:
-
-            try:
-                mp = self.retrieve_metadata_from_hash(metadata_key)
-                mp.setValue(metadata[spectra_index][metadata_key])
-                smd.addEntry(mp)
-            except KeyError as ke:
-                print("Warning: key: ", ke,
+            if metadata_key not in spectra_metadata:
+                print("Warning: key: ", metadata_key,
                       " is not in metadata for this spectra.")
-            except RuntimeError:  # Usually a java type conversion error
-                try:
-                    mp = self.retrieve_metadata_from_hash(metadata_key)
-                    mp.setValue(str(metadata[spectra_index][metadata_key]))
-                    smd.addEntry(mp)
-                except Exception as ex:
-                    print("Attempt at string conversion raised"
-                          "further excpetion: ", ex)
-            except jp.JavaException as je:
-                # Usually a java null pointer exception
-                print("Warning:", je,
-                      self.MAP_PICO_METADATA_SPECCHIONAME[metadata_key])
+                continue
+            value = self.pico_schema.convert(
+                metadata_key, spectra_metadata[metadata_key])
+            if value is None:  # 'null' in the pico file
+                continue
+            attribute_name = self.MAP_PICO_METADATA_SPECCHIONAME[metadata_key]
+            attribute = self.get_attribute(attribute_name)
+            if attribute is None:
+                print("Warning: no attribute in the database for:",
+                      attribute_name)
+                continue
+            mp = metaparam.newInstance(attribute)
+            mp.setValue(value)
+            smd.addEntry(mp)
 
     def add_ancillary_metadata_for_spectra(
              self, smd, ancil_metadata, spectra_index):
@@ -279,7 +515,7 @@ class specchioDBinterface(object):
         """
         for ancildata_key in self.MAP_ANCIL_METADATA_SPECCHIONAME.keys():
             mp = metaparam.newInstance(
-                    self.specchio_client.getAttributesNameHash().get(
+                    self.get_attribute(
                         self.MAP_ANCIL_METADATA_SPECCHIONAME[ancildata_key]))
             mp.setValue(ancil_metadata[spectra_index][ancildata_key])
             smd.addEntry(mp)
@@ -289,7 +525,10 @@ class specchioDBinterface(object):
         everything on this row to metadata"""
         pass
 
-    def specchio_upload_ancil_with_dummy_spectra(self, ancildir):
+    def specchio_upload_ancil_with_dummy_spectra(self, ancildir,
+                                                 plots_file=None,
+                                                 filenames=None,
+                                                 memory_budget=None):
         """Uploads ancillary metadata without spectra files.
 
         Creates a dummy spectra file at the plot level.
@@ -301,6 +540,13 @@ class specchioDBinterface(object):
 
         Args:
           ancildir: top-level directory containing the data.
+          plots_file: optional GeoJSON file of plot polygons, to include
+            per-plot statistics of the UAV orthomosaics (.tif) in ancildir.
+          filenames: optional list of files under ancildir; only these are
+            parsed and uploaded (e.g. new files found by folder_watcher).
+          memory_budget: optional size in bytes; the files are then parsed
+            and uploaded in groups of dataframes of at most this size, and
+            each group is released before the next is parsed.
 
         Logic:
           Dummy pico file created from plot name (and date?)
@@ -318,22 +564,59 @@ class specchioDBinterface(object):
           Check file modification time. etc..
 
         """
-        ancil_data = self.get_all_ancil_metadata(ancildir)
+        if memory_budget is None:
+            self.upload_ancil_dataframes(self.get_all_ancil_metadata(
+                ancildir, plots_file, filenames))
+            return
+        for ancil_data in ancilparser.iter_dataframe_chunks(
+                ancildir, memory_budget, plots_file, filenames):
+            with metrics.timer('upload.ancil_chunk'):
+                finished = not self.upload_ancil_dataframes(ancil_data)
+            self.flush()
+            del ancil_data
+            membudget.release()
+            if finished:
+                break
+
+    def upload_ancil_dataframes(self, ancil_data):
+        """Uploads the rows of ancillary dataframes (dictionary name ->
+        dataframe) with dummy spectra.
+
+        Each row is inserted as a one-pixel dummy spectrum, named as in
+        ancil_dummy_name, with the row's values as its metadata (empty
+        cells are left out). With an ancil_snapshot, the rows the server
+        returned spectrum ids for are recorded in it, with those ids.
+
+        Returns:
+            False if it stopped at a PRN (LAI) dataframe, as those are not
+            uploaded yet, otherwise True
+        """
         plot_ids = set()
         pico_dir = "./picotest/"
+        # The dummy spectra have a single zero pixel
+        java_wavelens = to_java_float_list([1.0])
+        java_measurements = to_java_float_lists(np.zeros((1, 1)))
 
         for df in ancil_data:
             if 'LAI' in df:  # Odd format from PRN files
-                break
+                return False
             category = ancilparser.get_category_from_df_key(df)
             datestr = ancilparser.get_date_from_df_key(df)
-
+            # Stored per site and date, e.g. PlotData/ES_F1/20170420
+            hierarchy_path = '/'.join([
+                self.subhierarchy, ancilparser.get_site_from_df_key(df),
+                datestr])
+
+            # Positions of the rows the server has stored, and the ids of
+            # their spectra by plot
+            uploaded_rows = []
+            row_spectrum_ids = {}
             # Loop through the rows in each dataframe
-            for _, row in ancil_data[df].iterrows():
+            for position, (_, row) in enumerate(ancil_data[df].iterrows()):
+                metrics.count('upload.ancil_rows')
                 # We need to create a unique name for each dummy spectra
-                plot_id_name = row[0] + '_' + datestr
-                plot_ids.add(plot_id_name)
-                dummy_pico_name = plot_id_name + ".pico"
+                dummy_pico_name = self.ancil_dummy_name(df, row[0])
+                plot_ids.add(dummy_pico_name[:-len(".pico")])
                 # Don't create new dummy files if ones already exist!
                 if not os.path.exists(pico_dir + dummy_pico_name):
                     # Write a new dummy pico file
@@ -347,7 +630,8 @@ class specchioDBinterface(object):
                     dummy_pico_name, os.path.abspath(pico_dir))
                 self.set_spectra_file_info(dummy_spectrafile_obj,
                                            dummy_spectrafile.dummyfile,
-                                           dummy_spectrafile.dummspecpath)
+                                           dummy_spectrafile.dummspecpath,
+                                           hierarchy_path)
                 smd = sptypes.Metadata()
                 dummy_spectrafile_obj.addSpectrumFilename(dummy_pico_name)
 
@@ -355,56 +639,280 @@ class specchioDBinterface(object):
                 subcateogries = self.MAP_ANCIL_METADATA_SPECCHIONAME[category]
 
                 for subcategory in subcateogries:
-                    value = row[subcategory]
+                    if subcategory not in row:  # e.g. fewer UAV bands
+                        continue
+                    # Plain python value of the typed (e.g. float32) column;
+                    # the row itself has been cast to a common dtype
+                    value = ancilparser.python_value(
+                        ancil_data[df][subcategory].iat[position])
+                    if pd.isnull(value):
+                        continue
                     # Now each column header is a metadata key. It must be added
                     # to each spectra file. PlotID + date.
 
                     # Pop off the value from the row by indexing using the
                     # subcategory in the class dictionary.
                     mp = metaparam.newInstance(
-                        self.specchio_client.getAttributesNameHash().get(
-                            subcategory))
+                        self.get_attribute(subcategory))
                     mp.setValue(value)
                     smd.addEntry(mp)
                 # check we are not overwriting spectra files somehow
+                dummy_spectrafile_obj.setNumberOfSpectra(1)
+                dummy_spectrafile_obj.addWvls(java_wavelens)
+                dummy_spectrafile_obj.addEavMetadata(smd)
+                dummy_spectrafile_obj.setMeasurements(java_measurements)
+                spectrum_ids = self.specchio_client.insertSpectralFile(
+                    dummy_spectrafile_obj)
+                if spectrum_ids is not None and len(spectrum_ids):
+                    uploaded_rows.append(position)
+                    row_spectrum_ids.setdefault(str(row[0]), []).extend(
+                        int(spectrum_id) for spectrum_id in spectrum_ids)
+                metrics.count('upload.ancil_spectra')
+            if self.ancil_snapshot is not None:
+                self.ancil_snapshot.record_dataframe(
+                    self.campaign_name, df,
+                    ancil_data[df].iloc[uploaded_rows],
+                    self.ancil_columns(df), row_spectrum_ids)
+        return True
+
+    @staticmethod
+    def ancil_dummy_name(df_key, plot_id):
+        """Name of the dummy spectrum of a plot's ancillary data on the date
+        of a dataframe, e.g. 'Lee1_20170420.pico'"""
+        return str(plot_id) + '_' + ancilparser.get_date_from_df_key(df_key) \
+            + ".pico"
+
+    def ancil_columns(self, df_key):
+        """The columns of an ancillary dataframe uploaded as metadata"""
+        columns = self.MAP_ANCIL_METADATA_SPECCHIONAME.get(
+            ancilparser.get_category_from_df_key(df_key), ())
+        return columns if isinstance(columns, tuple) else ()
+
+    def ancil_spectrum_ids(self, dummy_pico_name):
+        """The ids of the spectra on the server with this file name"""
+        query = spquery.Query()
+        cond = spquery.EAVQueryConditionObject(
+            self.get_attribute(self.FILE_NAME_ATTRIBUTE))
+        cond.setValue(dummy_pico_name)
+        cond.setOperator('=')
+        query.add_condition(cond)
+        return [int(spectrum_id) for spectrum_id in
+                self.specchio_client.getSpectrumIdsMatchingQuery(query)]
+
+    def update_ancil_metadata(self, ancildir, plots_file=None,
+                              filenames=None):
+        """Sends only the ancillary data cells that have changed since they
+        were uploaded (or last updated), as EAV updates of the spectra of
+        their rows.
+
+        The cells are compared with the ancil_snapshot. The spectra of each
+        changed row are those the snapshot recorded for it when it was
+        uploaded; rows with no spectra (e.g. new plots) are left for a full
+        upload. Each new value is sent once, in its attribute's storage
+        type (see metadata_schema), for all the spectra with it, and emptied
+        cells are removed.
+
+        Returns:
+            A dict of the number of 'changed', 'added' and 'removed' cells
+            sent, 'rows_updated', 'rows_without_spectra' and 'eav_updates'
+        """
+        if self.ancil_snapshot is None:
+            raise ValueError("Updating metadata needs an AncilSnapshot of"
+                             " the data already uploaded")
+        changes = self.ancil_snapshot.diff(
+            self.campaign_name,
+            self.get_all_ancil_metadata(ancildir, plots_file, filenames),
+            self.ancil_columns)
+        summary = {'changed': 0, 'added': 0, 'removed': 0,
+                   'rows_updated': 0, 'rows_without_spectra': 0,
+                   'eav_updates': 0}
+        # (attribute name, new value as JSON) -> (new value, spectrum ids)
+        updates = {}
+        sent = []
+        with metrics.timer('delta.find_spectra'):
+            for (df_key, plot_id), row_changes in changes.groupby(
+                    ['df_key', 'plot'], sort=False):
+                spectrum_ids = self.ancil_snapshot.spectrum_ids(
+                    self.campaign_name, df_key, plot_id)
+                if not spectrum_ids:
+                    print("Warning: no spectra uploaded for",
+                          plot_id, "in", df_key + "; upload it in full")
+                    summary['rows_without_spectra'] += 1
+                    continue
+                summary['rows_updated'] += 1
+                sent.append(row_changes)
+                for change in row_changes.itertuples(index=False):
+                    key = (change.column, json.dumps(change.new, default=str))
+                    updates.setdefault(key, (change.new, set()))[1].update(
+                        spectrum_ids)
+                    summary[change.change] += 1
+
+        with metrics.timer('delta.send'):
+            for (attribute_name, _), (value, spectrum_ids) in sorted(
+                    updates.items(), key=lambda item: item[0]):
+                mp = metaparam.newInstance(self.get_attribute(attribute_name))
+                java_ids = to_java_id_list(sorted(spectrum_ids))
+                if value is None:
+                    self.specchio_client.removeEavMetadata(mp, java_ids)
+                else:
+                    # e.g. a whole number of a double_val attribute, which
+                    # the snapshot keeps as an integer
+                    mp.setValue(self.ancil_schema.convert(attribute_name,
+                                                          value))
+                    self.specchio_client.updateEavMetadata(mp, java_ids)
+                summary['eav_updates'] += 1
+                metrics.count('delta.spectra_updated', len(spectrum_ids))
+        if sent:
+            self.ancil_snapshot.record_changes(self.campaign_name,
+                                               pd.concat(sent))
+        metrics.count('delta.eav_updates', summary['eav_updates'])
+        return summary
+
+    def add_index_metadata_for_spectra(self, smd, index_values):
+        """Adds vegetation index values (see vegetation_indices) to the
+        spectra file metadata, as double values"""
+        for index_name, value in sorted(index_values.items()):
+            attribute = self.get_attribute(index_name)
+            if attribute is None:
+                print("Warning: no attribute in the database for:",
+                      index_name)
+                continue
+            mp = metaparam.newInstance(attribute)
+            mp.setValue(JavaDouble(value))
+            smd.addEntry(mp)
 
-    def specchio_upload_pico_spectra(self, spectrafile):
+    def add_content_hash_for_spectra(self, smd, content_hash):
+        """Adds the spectrum's content hash (see spectra_dedup), so that
+        duplicates can be found on the server"""
+        attribute = self.get_attribute(dedup.CONTENT_HASH_ATTRIBUTE)
+        if attribute is None:
+            print("Warning: no attribute in the database for:",
+                  dedup.CONTENT_HASH_ATTRIBUTE)
+            return
+        mp = metaparam.newInstance(attribute)
+        mp.setValue(content_hash)
+        smd.addEntry(mp)
+
+    def spectra_with_content_hash(self, content_hash):
+        """Returns the ids of spectra on the server with this content hash
+        """
+        attribute = self.get_attribute(dedup.CONTENT_HASH_ATTRIBUTE)
+        if attribute is None:
+            return []
+        query = spquery.Query()
+        cond = spquery.EAVQueryConditionObject(attribute)
+        cond.setValue(content_hash)
+        cond.setOperator('=')
+        query.add_condition(cond)
+        return list(self.specchio_client.getSpectrumIdsMatchingQuery(query))
+
+    def specchio_upload_pico_spectra(self, spectrafile, index_engine=None,
+                                     spectra_numbers=None):
         """Upload the PICO type spectra.
 
         Args:
             spectrafile: a SpectraFile object
+            index_engine: optional vegetation_indices.IndexEngine; if given,
+                the indices computed from each spectrometer's reflectance
+                are added to the metadata of its spectra
+            spectra_numbers: optional list of the spectra in the file to
+                upload, e.g. those that passed QC (spectra_qc.clean_spectra);
+                all of them if None
 
         Remember, the specs are:
             2 sets of Up and Down spectra (four in total)
             Each have their own set of metadata
+
+        With a deduplicator, spectra already uploaded are left out, and
+        nothing is inserted if they all were.
+
+        With a resuming journal, nothing is done if the spectra have
+        already been uploaded, and only those that have not are if some
+        of the file's spectra were (e.g. by an earlier --select).
         """
+        if self.journal is not None and self.journal.resume and \
+                self.journal.is_done(self.campaign_name, spectrafile,
+                                     spectra_numbers):
+            metrics.count('journal.files_skipped')
+            return
         # Create a spectra file object
         spspectra_file_obj = sptypes.SpectralFile()
         self.set_spectra_file_info(spspectra_file_obj,
                                    spectrafile.sfile, spectrafile.spath)
         # as below.... loop through the four spectra
-        spectra = self.get_all_pico_spectra(spectrafile)
-        metadata = self.get_all_pico_metadata(spectrafile)
+        with metrics.timer('upload.read_pico'):
+            spectra = self.get_all_pico_spectra(spectrafile)
+            metadata = self.get_all_pico_metadata(spectrafile)
         # Should be 4 for PICO file format
-        num_spectras = np.size(spectra)  ## odd errors for the other sample PICO? (non USB, s2 one)
+        # np.size() would count every pixel when all four spectra have the
+        # same length (e.g. the QEPs2 sample file), so count the rows.
+        num_spectras = len(spectra)
         print(num_spectras)
-        # TODO: remove hard coding
-        num_wavelens = 2048
-        # Should not be hard coded in final version, OK for now...
-        dummy_wavelens = np.linspace(1.0, 2048.0, num_wavelens)
-        # Could be max len of spectra lists? 1044 vs 2044
-        spspectra_file_obj.setNumberOfSpectra(num_spectras)
-        # A numpy temporary holding array, dims of no of spectra x no of wvls
-        spectra_array = np.zeros((num_spectras, num_wavelens))
-
-        for i in range(0, num_spectras):
-            vector = spectra[i]  # 4 spectras from the PICO
-            # TODO: not sure what the wavelengths are yet...use length 1...n
-            for w in range(0, len(vector)):
-                spectra_array[i, w] = vector[w] 
+        # Numbers of the spectra in the file to upload
+        if spectra_numbers is None:
+            upload_numbers = list(range(num_spectras))
+        else:
+            upload_numbers = sorted(spectra_numbers)
+        # The file is done once all its spectra are stored, so those from
+        # earlier uploads are recorded with these
+        stored = set(self.journal.stored_spectra(
+            self.campaign_name, spectrafile)) \
+            if self.journal is not None else set()
+        if self.journal is not None and self.journal.resume:
+            upload_numbers = [i for i in upload_numbers if i not in stored]
+        self.record_progress(spectrafile, 'parsed',
+                             sorted(stored.union(upload_numbers)),
+                             total=num_spectras)
+        if not upload_numbers:
+            self.record_progress(spectrafile, 'done')
+            return
+        hashes = None
+        if self.deduplicator is not None:
+            with metrics.timer('upload.dedup'):
+                hashes = dict(
+                    (i, dedup.spectrum_hash(spectra[i], metadata[i]))
+                    for i in upload_numbers)
+                duplicates = self.deduplicator.find_duplicates(self, hashes)
+            if duplicates:
+                self.deduplicator.record_skipped(
+                    [spectra[i] for i in sorted(duplicates)])
+                print("Skipping", len(duplicates), "already uploaded spectra"
+                      " in", spectrafile.sfile)
+                upload_numbers = [i for i in upload_numbers
+                                  if i not in duplicates]
+            if not upload_numbers:
+                metrics.count('dedup.inserts_saved')
+                self.record_progress(spectrafile, 'done')
+                return
+        index_values = {}
+        if index_engine is not None:
+            with metrics.timer('upload.indices'):
+                index_values = index_engine.indices_for_file(
+                    spectrafile, spectra, metadata)
+        spspectra_file_obj.setNumberOfSpectra(len(upload_numbers))
+        if self.resampler is not None:
+            # Every instrument's spectra on the common grid
+            upload_wavelens = self.resampler.wavelengths
+            spectra_array = self.resampler.resample_pico(
+                [spectra[i] for i in upload_numbers],
+                [metadata[i] for i in upload_numbers])
+        else:
+            # TODO: remove hard coding
+            num_wavelens = 2048
+            # Should not be hard coded in final version, OK for now...
+            upload_wavelens = np.linspace(1.0, 2048.0, num_wavelens)
+            # Could be max len of spectra lists? 1044 vs 2044
+            # A numpy temporary holding array, dims of no of spectra x no of
+            # wvls
+            spectra_array = np.zeros((len(upload_numbers), num_wavelens))
+            for row, i in enumerate(upload_numbers):
+                vector = spectra[i]  # 4 spectras from the PICO
+                spectra_array[row, :len(vector)] = vector
+        java_wavelens = to_java_float_list(upload_wavelens)
+
+        for i in upload_numbers:
             # Add wavelens
-            spspectra_file_obj.addWvls(
-                [jp.java.lang.Float(x) for x in dummy_wavelens])
+            spspectra_file_obj.addWvls(java_wavelens)
             # Add filename:
             # we add an automatic number here to make them distinct
             fname_spectra = spectrafile.sfile + str(i)
@@ -413,17 +921,38 @@ class specchioDBinterface(object):
             # Metadata...FOR EACH SPECTRA (use dummy if needed)
             # =-=-=-=-=-=
             smd = sptypes.Metadata()
-            self.add_pico_metadata_for_spectra(smd, metadata, i)
+            with metrics.timer('upload.pico_metadata', memory=False):
+                self.add_pico_metadata_for_spectra(smd, metadata, i)
+                if i in index_values:
+                    self.add_index_metadata_for_spectra(smd, index_values[i])
+                if hashes is not None:
+                    self.add_content_hash_for_spectra(smd, hashes[i])
             # self.add_ancillary_metadata_for_spectra(smd, metadata, i)
             spspectra_file_obj.addEavMetadata(smd)
 
         # Convert the spectra list to a suitable
-        javafloat_spectra_list = [
-            [jp.java.lang.Float(j) for j in i] for i in spectra_array]
+        javafloat_spectra_list = to_java_float_lists(spectra_array)
 
         spspectra_file_obj.setMeasurements(javafloat_spectra_list)
 
-        self.specchio_client.insertSpectralFile(spspectra_file_obj)
+        spectrum_ids = self.specchio_client.insertSpectralFile(
+            spspectra_file_obj)
+        self.record_inserted(
+            spectrafile, list(spectrum_ids) if spectrum_ids is not None
+            else None)
+        if self.similarity_index is not None:
+            self.add_to_similarity_index(
+                spectrafile, spectra, metadata, upload_numbers,
+                list(spectrum_ids) if spectrum_ids is not None else None)
+        if hashes is not None:
+            self.deduplicator.record_uploaded(
+                self, [hashes[i] for i in upload_numbers])
+            # As in record_inserted: unless the client is still buffering
+            # them, the spectra have been written out
+            if not getattr(self.specchio_client, 'pending_spectra', 0):
+                self.deduplicator.commit_uploaded(self.campaign_name)
+        metrics.count('upload.files')
+        metrics.count('upload.spectra', len(upload_numbers))
 
     def specchio_uploader_test(self, filename, filepath,
                                subhierarchy, use_dummy_spectra=False):
@@ -458,8 +987,7 @@ class specchioDBinterface(object):
                 # Perhaps create a numpy array first and then populate?
                 spectra_array[i, w] = vector[w]
 
-            spspectra_file.addWvls(
-                [jp.java.lang.Float(x) for x in wavelengths])
+            spspectra_file.addWvls(to_java_float_list(wavelengths))
 
             # Add filename:
             # we add an automatic number here to make them distinct
@@ -494,8 +1022,7 @@ class specchioDBinterface(object):
 
                 spspectra_file.addEavMetadata(smd)
 
-        javafloat_spectra_list = [
-            [jp.java.lang.Float(j) for j in i] for i in spectra_array]
+        javafloat_spectra_list = to_java_float_lists(spectra_array)
 
         spspectra_file.setMeasurements(javafloat_spectra_list)
 
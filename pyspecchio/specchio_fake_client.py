@@ -0,0 +1,466 @@
+# -*- coding: utf-8 -*-
+"""
+Offline stand-in for the SPECCHIO Java client.
+
+Pure Python versions of the parts of the SPECCHIO client API and types that
+pyspecchio uses, so the uploader can be exercised and benchmarked without a
+SPECCHIO server, a JVM or the specchio-client.jar.
+
+It is selected with environment variables, in the same way the Java client
+is located with SPECCHIO_JAVA_CLIENT:
+
+    export SPECCHIO_CLIENT_BACKEND=fake
+    export SPECCHIO_FAKE_LATENCY=0.005    # seconds per client call (optional)
+
+Every client call is counted in FakeSPECCHIOClient.call_counts, and sleeps
+for the configured latency to mimic a round trip to the server.
+"""
+
+import os
+import threading
+import time
+from collections import Counter
+
+
+def get_fake_latency():
+    """Per-call latency in seconds, from the SPECCHIO_FAKE_LATENCY env var"""
+    return float(os.environ.get('SPECCHIO_FAKE_LATENCY', 0.0))
+
+
+class JavaException(Exception):
+    """Stands in for jpype.JavaException, e.g. null pointer exceptions"""
+    pass
+
+
+class JavaList(list):
+    """A python list with the java.util.List methods used by pyspecchio"""
+
+    def get(self, index):
+        return self[index]
+
+    def size(self):
+        return len(self)
+
+    def add(self, item):
+        self.append(item)
+
+
+class Attribute(object):
+    """A metadata attribute as returned by getAttributesNameHash()"""
+
+    def __init__(self, attribute_id, name):
+        self.id = attribute_id
+        self.name = name
+
+    def getId(self):
+        return self.id
+
+    def getName(self):
+        return self.name
+
+
+class AttributesNameHash(dict):
+    """Mimics the java Hashtable of attribute name to Attribute.
+
+    Any attribute name is accepted, and registered on first lookup, so the
+    fake server does not need the SPECCHIO attribute tables loaded.
+    """
+
+    def get(self, name):
+        if name is None:
+            return None
+        if name not in self:
+            self[name] = Attribute(len(self) + 1, name)
+        return self[name]
+
+
+class MetaParameter(object):
+    """A single EAV metadata value"""
+
+    def __init__(self, attribute):
+        self.attribute = attribute
+        self.value = None
+
+    @classmethod
+    def newInstance(cls, attribute):
+        if attribute is None:
+            raise JavaException("java.lang.NullPointerException")
+        return cls(attribute)
+
+    def setValue(self, value):
+        self.value = value
+
+    def getValue(self):
+        return self.value
+
+    def getAttributeName(self):
+        return self.attribute.getName()
+
+
+class Metadata(object):
+    """Container of the metaparameters for one spectrum"""
+
+    def __init__(self):
+        self.entries = JavaList()
+
+    def addEntry(self, metaparameter):
+        self.entries.add(metaparameter)
+
+    def getEntries(self):
+        return self.entries
+
+    def get_entry(self, attribute_name):
+        for mp in self.entries:
+            if mp.getAttributeName() == attribute_name:
+                return mp
+        return None
+
+
+class SpecchioCampaign(object):
+    """A SPECCHIO campaign"""
+
+    def __init__(self):
+        self.name = None
+        self.id = 0
+
+    def setName(self, name):
+        self.name = name
+
+    def getName(self):
+        return self.name
+
+    def setId(self, campaign_id):
+        self.id = campaign_id
+
+    def getId(self):
+        return self.id
+
+
+class SpectralFile(object):
+    """A file of one or more spectra, with wavelengths and metadata"""
+
+    def __init__(self):
+        self.path = None
+        self.filename = None
+        self.company = None
+        self.hierarchy_id = 0
+        self.campaign_id = 0
+        self.number_of_spectra = 0
+        self.wvls = JavaList()
+        self.spectrum_filenames = JavaList()
+        self.eav_metadata = JavaList()
+        self.measurements = None
+
+    def setPath(self, path):
+        self.path = path
+
+    def setFilename(self, filename):
+        self.filename = filename
+
+    def setCompany(self, company):
+        self.company = company
+
+    def setHierarchyId(self, hierarchy_id):
+        self.hierarchy_id = hierarchy_id
+
+    def getHierarchyId(self):
+        return self.hierarchy_id
+
+    def setCampaignId(self, campaign_id):
+        self.campaign_id = campaign_id
+
+    def getCampaignId(self):
+        return self.campaign_id
+
+    def setNumberOfSpectra(self, number_of_spectra):
+        self.number_of_spectra = number_of_spectra
+
+    def getNumberOfSpectra(self):
+        return self.number_of_spectra
+
+    def addWvls(self, wvls):
+        self.wvls.add(list(wvls))
+
+    def addSpectrumFilename(self, filename):
+        self.spectrum_filenames.add(filename)
+
+    def addEavMetadata(self, smd):
+        self.eav_metadata.add(smd)
+
+    def setMeasurements(self, measurements):
+        self.measurements = [list(vector) for vector in measurements]
+
+
+class EAVQueryConditionObject(object):
+    """A condition on a single attribute"""
+
+    OPERATORS = {
+        '=': lambda a, b: a == b,
+        '==': lambda a, b: a == b,
+        '<>': lambda a, b: a != b,
+        '!=': lambda a, b: a != b,
+        '<': lambda a, b: a < b,
+        '<=': lambda a, b: a <= b,
+        '>': lambda a, b: a > b,
+        '>=': lambda a, b: a >= b,
+        'like': lambda a, b: str(b).strip('%') in str(a)}
+
+    def __init__(self, attribute):
+        self.attribute = attribute
+        self.value = None
+        self.operator = '='
+
+    def setValue(self, value):
+        self.value = value
+
+    def setOperator(self, operator):
+        self.operator = operator
+
+    def matches(self, smd):
+        """True if the metadata satisfies this condition"""
+        mp = smd.get_entry(self.attribute.getName())
+        if mp is None or mp.getValue() is None:
+            return False
+        stored = mp.getValue()
+        wanted = self.value
+        # Conditions are set as strings, as with the java client
+        if isinstance(stored, (int, float)) and not isinstance(stored, bool):
+            try:
+                wanted = float(wanted)
+            except (TypeError, ValueError):
+                stored = str(stored)
+        else:
+            stored, wanted = str(stored), str(wanted)
+        return self.OPERATORS[self.operator](stored, wanted)
+
+
+class Query(object):
+    """A query made of one or more conditions, all of which must match"""
+
+    def __init__(self):
+        self.conditions = JavaList()
+
+    def add_condition(self, condition):
+        self.conditions.add(condition)
+
+    def matches(self, smd):
+        return all(cond.matches(smd) for cond in self.conditions)
+
+
+class MeasurementUnit(object):
+
+    def __init__(self, unit_name):
+        self.unit_name = unit_name
+
+    def getUnitName(self):
+        return self.unit_name
+
+
+class Space(object):
+    """A spectral space: a set of spectrum ids sharing a wavelength grid"""
+
+    def __init__(self, spectrum_ids):
+        self.spectrum_ids = JavaList(spectrum_ids)
+        self.vectors = None
+        self.wavelengths = None
+
+    def getSpectrumIds(self):
+        return self.spectrum_ids
+
+    def getVectorsAsArray(self):
+        return self.vectors
+
+    def getAverageWavelengths(self):
+        return self.wavelengths
+
+    def getMeasurementUnit(self):
+        return MeasurementUnit('DN')
+
+
+class ServerDescriptor(object):
+
+    def getDataSourceName(self):
+        return 'fake@localhost'
+
+
+class FakeSPECCHIOClient(object):
+    """In-memory SPECCHIO client.
+
+    Campaigns, hierarchies and spectra are held in dicts. The number of
+    calls to each client method is recorded in call_counts.
+    """
+
+    def __init__(self, latency=None):
+        self.latency = get_fake_latency() if latency is None else latency
+        self.call_counts = Counter()
+        self.attributes = AttributesNameHash()
+        self.campaigns = {}
+        self.hierarchies = {}
+        # spectrum id -> (vector, wavelengths, metadata, hierarchy id)
+        self.spectra = {}
+
+    def _call(self, method_name):
+        self.call_counts[method_name] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def insertCampaign(self, campaign):
+        self._call('insertCampaign')
+        campaign_id = len(self.campaigns) + 1
+        self.campaigns[campaign_id] = campaign.getName()
+        return campaign_id
+
+    def getCampaigns(self):
+        self._call('getCampaigns')
+        campaigns = JavaList()
+        for campaign_id in sorted(self.campaigns):
+            campaigns.add(self.getCampaign(campaign_id))
+        return campaigns
+
+    def getCampaign(self, campaign_id):
+        self._call('getCampaign')
+        campaign = SpecchioCampaign()
+        campaign.setId(campaign_id)
+        campaign.setName(self.campaigns[campaign_id])
+        return campaign
+
+    def getSubHierarchyId(self, campaign, name, parent_id):
+        self._call('getSubHierarchyId')
+        key = (campaign.getId(), name, parent_id)
+        if key not in self.hierarchies:
+            self.hierarchies[key] = len(self.hierarchies) + 1
+        return self.hierarchies[key]
+
+    def getAttributesNameHash(self):
+        self._call('getAttributesNameHash')
+        return self.attributes
+
+    def insertSpectralFile(self, spectral_file):
+        self._call('insertSpectralFile')
+        ids = JavaList()
+        for i, vector in enumerate(spectral_file.measurements):
+            spectrum_id = len(self.spectra) + 1
+            wvls = spectral_file.wvls[i] if i < len(spectral_file.wvls) \
+                else None
+            smd = spectral_file.eav_metadata[i] \
+                if i < len(spectral_file.eav_metadata) else Metadata()
+            # The server keeps each spectrum's file name as metadata
+            if i < len(spectral_file.spectrum_filenames) and \
+                    smd.get_entry('File Name') is None:
+                file_name = MetaParameter(self.attributes.get('File Name'))
+                file_name.setValue(spectral_file.spectrum_filenames[i])
+                smd.addEntry(file_name)
+            self.spectra[spectrum_id] = (
+                vector, wvls, smd, spectral_file.getHierarchyId())
+            ids.add(spectrum_id)
+        return ids
+
+    def getSpectrumIdsMatchingQuery(self, query):
+        self._call('getSpectrumIdsMatchingQuery')
+        return JavaList(
+            spectrum_id for spectrum_id, spectrum in self.spectra.items()
+            if query.matches(spectrum[2]))
+
+    def getMetaparameterValues(self, ids, attribute_name):
+        """The value of an attribute for each spectrum id (None where a
+        spectrum does not have it)"""
+        self._call('getMetaparameterValues')
+        values = JavaList()
+        for spectrum_id in ids:
+            mp = self.spectra[spectrum_id][2].get_entry(attribute_name)
+            values.add(mp.getValue() if mp is not None else None)
+        return values
+
+    def updateEavMetadata(self, metaparameter, ids):
+        """Sets the metaparameter's value on each spectrum, replacing any
+        value it had for the attribute"""
+        self._call('updateEavMetadata')
+        name = metaparameter.getAttributeName()
+        for spectrum_id in ids:
+            entries = self.spectra[spectrum_id][2].entries
+            entries[:] = [mp for mp in entries
+                          if mp.getAttributeName() != name]
+            mp = MetaParameter(metaparameter.attribute)
+            mp.setValue(metaparameter.getValue())
+            entries.add(mp)
+        return 0
+
+    def removeEavMetadata(self, metaparameter, ids):
+        """Removes the spectra's values of the metaparameter's attribute"""
+        self._call('removeEavMetadata')
+        name = metaparameter.getAttributeName()
+        for spectrum_id in ids:
+            entries = self.spectra[spectrum_id][2].entries
+            entries[:] = [mp for mp in entries
+                          if mp.getAttributeName() != name]
+
+    def getSpaces(self, ids, order_by):
+        self._call('getSpaces')
+        return JavaList([Space(ids)])
+
+    def loadSpace(self, space):
+        self._call('loadSpace')
+        ids = space.getSpectrumIds()
+        space.vectors = [list(self.spectra[i][0]) for i in ids]
+        space.wavelengths = self.spectra[ids[0]][1] if ids else []
+        return space
+
+
+class SpecchioCampaignDataLoader(object):
+    """Stands in for the server-side campaign data loader, a Java thread
+    that loads the files of a campaign's directory. The fake loads
+    files_per_campaign files, taking the client's latency for each."""
+
+    files_per_campaign = 5
+
+    def __init__(self, client):
+        self.client = client
+        self.campaign = None
+        self.parsed_file_counter = 0
+        self.successful_file_counter = 0
+        self._thread = threading.Thread(target=self.run)
+        self._thread.daemon = True
+
+    def set_campaign(self, campaign):
+        self.campaign = campaign
+
+    def run(self):
+        for _ in range(self.files_per_campaign):
+            self.client._call('loadCampaignFile')
+            self.parsed_file_counter += 1
+            self.successful_file_counter += 1
+
+    def start(self):
+        self._thread.start()
+
+    def isAlive(self):
+        return self._thread.is_alive()
+
+    def join(self, millis=0):
+        """Waits up to millis milliseconds (for ever if 0), as
+        java.lang.Thread.join"""
+        self._thread.join(millis / 1000.0 if millis else None)
+
+    def getParsed_file_counter(self):
+        return self.parsed_file_counter
+
+    def getSuccessful_file_counter(self):
+        return self.successful_file_counter
+
+
+class SPECCHIOClientFactory(object):
+    """Hands out FakeSPECCHIOClient instances"""
+
+    _instance = None
+
+    @classmethod
+    def getInstance(cls):
+        if cls._instance is None:
+            cls._instance = cls()
+        return cls._instance
+
+    def getAllServerDescriptors(self):
+        return JavaList([ServerDescriptor()])
+
+    def createClient(self, descriptor):
+        return FakeSPECCHIOClient()
@@ -20,6 +20,9 @@ import argparse
 
 import specchio_db_interface as specchio
 import spectra_parser as spectraparser
+import memory_budget as membudget
+import upload_journal
+import metrics
 
 
 parser = argparse.ArgumentParser(description='Process data files to be'
@@ -60,6 +63,255 @@ parser.add_argument('--test-spectra-upload', dest='test_spectra_mode',
                     help='Runs the program in test mode, using the data from'
                     ' the test directory, uploading it to a test campaign.\n'
                     'No further arguments are required.\n')
+parser.add_argument('--plots-file', metavar='GEOJSON', type=str,
+                    dest='plots_file',
+                    help='GeoJSON file of the plot polygons. If given, UAV'
+                    ' orthomosaics (.tif) in the data path are reduced to'
+                    ' per-plot band statistics and uploaded with the'
+                    ' ancillary data.\n')
+parser.add_argument('--vegetation-indices', dest='vegetation_indices',
+                    action='store_const',
+                    const=True,
+                    help='Compute vegetation indices (NDVI, PRI, MTCI...)'
+                    ' from the reflectance of each PICO spectrometer and'
+                    ' upload them as metadata of its spectra.\n')
+parser.add_argument('--skip-duplicates', dest='skip_duplicates',
+                    action='store_const',
+                    const=True,
+                    help='Do not upload spectra that have already been'
+                    ' uploaded to the campaign, identified by a hash of'
+                    ' their pixels and key metadata kept in a local index.\n')
+parser.add_argument('--hash-index', metavar='FILE', type=str,
+                    dest='hash_index',
+                    help='SQLite file of the hashes of uploaded spectra, used'
+                    ' with --skip-duplicates (default: in the pyspecchio'
+                    ' cache directory).\n')
+parser.add_argument('--check-server-duplicates', dest='check_server',
+                    action='store_const',
+                    const=True,
+                    help='With --skip-duplicates, also look for each'
+                    ' spectrum\'s hash on the server.\n')
+parser.add_argument('--qc', dest='qc',
+                    action='store_const',
+                    const=True,
+                    help='Screen the spectra for saturation, dark signal,'
+                    ' integration time and detector temperature before'
+                    ' upload, and only upload the spectra that pass.\n')
+parser.add_argument('--qc-report', metavar='FILE', type=str,
+                    dest='qc_report',
+                    help='Write the QC report (one row per spectrum, with the'
+                    ' checks it failed) to a CSV file. Implies --qc.\n')
+parser.add_argument('--watch', dest='watch',
+                    action='store_const',
+                    const=True,
+                    help='Keep running, watching the spectra path and data'
+                    ' path for new files, and upload them in batches as they'
+                    ' arrive. Stop with Ctrl-C.\n')
+parser.add_argument('--watch-quiet', metavar='SECONDS', type=float,
+                    dest='watch_quiet', default=5.0,
+                    help='With --watch, how long a file must be unchanged'
+                    ' before it is uploaded (default 5).\n')
+parser.add_argument('--batch-files', metavar='N', type=int,
+                    dest='batch_files', default=200,
+                    help='With --watch, the most files uploaded in one batch'
+                    ' (default 200).\n')
+parser.add_argument('--batch-seconds', metavar='SECONDS', type=float,
+                    dest='batch_seconds', default=60.0,
+                    help='With --watch, the longest a new file waits for its'
+                    ' batch to fill before it is uploaded (default 60).\n')
+parser.add_argument('--similarity-index', metavar='DIR', type=str,
+                    dest='similarity_index',
+                    help='Add the uploaded spectra to the nearest-neighbour'
+                    ' spectral similarity index in DIR (created if needed),'
+                    ' for finding the spectra most similar to a new one.\n')
+parser.add_argument('--common-grid', metavar='START:STOP:STEP', type=str,
+                    dest='common_grid',
+                    help='Upload the spectra of every instrument resampled'
+                    ' onto a common wavelength grid in nm, e.g. 400:1000:1,'
+                    ' instead of padded to 2048 pixels. Wavelengths outside'
+                    ' an instrument\'s range are NaN.\n')
+parser.add_argument('--resume', dest='resume',
+                    action='store_const',
+                    const=True,
+                    help='Resume an interrupted upload: skip the spectra'
+                    ' files that the upload journal records as already'
+                    ' uploaded to the campaign.\n')
+parser.add_argument('--journal', metavar='FILE', type=str,
+                    dest='journal',
+                    help='SQLite file of the upload progress of each spectra'
+                    ' file, used by --resume (default: in the pyspecchio'
+                    ' cache directory).\n')
+parser.add_argument('--update-metadata', dest='update_metadata',
+                    action='store_const',
+                    const=True,
+                    help='Instead of uploading the ancillary data in the data'
+                    ' path in full, send only the cells changed since it was'
+                    ' uploaded, as metadata updates of the spectra already'
+                    ' on the server.\n')
+parser.add_argument('--ancil-snapshot', metavar='FILE', type=str,
+                    dest='ancil_snapshot',
+                    help='SQLite file of the ancillary data uploaded to each'
+                    ' campaign, compared with by --update-metadata (default:'
+                    ' in the pyspecchio cache directory).\n')
+parser.add_argument('--select', metavar='WHERE', type=str,
+                    dest='select',
+                    help='Upload only the spectra under the spectra path'
+                    ' matching an SQL condition on the PICO catalog, e.g.'
+                    ' "serial = \'QEP01651\' AND direction = \'Upwelling\'"'
+                    ' (columns: serial, datetime, direction, type, run,'
+                    ' integration_time_ms, pixels, path).\n')
+parser.add_argument('--catalog', metavar='FILE', type=str,
+                    dest='catalog',
+                    help='SQLite file of the PICO catalog used by --select,'
+                    ' updated with the new and changed files under the'
+                    ' spectra path (default: in the pyspecchio cache'
+                    ' directory).\n')
+parser.add_argument('--catalog-workers', metavar='N', type=int,
+                    dest='catalog_workers', default=None,
+                    help='Number of processes reading new spectra files into'
+                    ' the PICO catalog.\n')
+parser.add_argument('--export-archive', metavar='STORE', type=str,
+                    dest='export_archive',
+                    help='Instead of uploading, export all the .pico files'
+                    ' under the spectra path and the ancillary data in the'
+                    ' data path to a chunked HDF5 (.h5) or Zarr (.zarr)'
+                    ' archive, appending to it if it exists.\n')
+parser.add_argument('--export-workers', metavar='N', type=int,
+                    dest='export_workers', default=None,
+                    help='Number of processes parsing spectra files for'
+                    ' --export-archive.\n')
+parser.add_argument('--memory-budget', metavar='SIZE', type=str,
+                    dest='memory_budget',
+                    help='Process the spectra and ancillary data files in'
+                    ' groups that fit in SIZE of memory (e.g. 512M or 2G),'
+                    ' releasing each group before the next, instead of all'
+                    ' at once. The peak memory of each stage is reported'
+                    ' with --profile/--metrics-json.\n')
+parser.add_argument('--metrics-json', metavar='FILE', type=str,
+                    dest='metrics_json',
+                    help='Write per-stage timings and counters (bytes, rows,'
+                    ' spectra, JVM calls, Java heap and GC time) for the run'
+                    ' to a JSON file.\n')
+parser.add_argument('--profile', dest='profile',
+                    action='store_const',
+                    const=True,
+                    help='Print a per-stage breakdown of where the run time'
+                    ' was spent at the end of the run.\n')
+
+
+def qc_clean_spectra(spectrafiles):
+    """Runs QC on the spectra files if it was requested, returning a dict
+    of file path -> numbers of the spectra to upload (None without QC)"""
+    if not (args.qc or args.qc_report):
+        return None
+    import spectra_qc
+    report = spectra_qc.screen(spectrafiles)
+    if args.qc_report:
+        spectra_qc.write_report(report, args.qc_report)
+    rejected = report[report['rejected']]
+    for (path, number), flags in rejected['flags'].items():
+        print("QC rejected spectrum", number, "of", path + ":", flags)
+    return spectra_qc.clean_spectra(report)
+
+
+def upload_spectra_files(db_interface, spectrafiles, selection=None):
+    """Uploads a batch of spectra files, after QC if it was requested.
+
+    With a selection (file path -> spectra numbers, e.g. from the PICO
+    catalog), only those spectra of each file are uploaded.
+
+    With a memory budget, the files are QC'd and uploaded in groups that
+    fit in it, flushing the client and releasing memory after each.
+
+    When resuming, files the journal records as uploaded are left out."""
+    if db_interface.journal is not None:
+        spectrafiles = db_interface.journal.unfinished(
+            db_interface.campaign_name, spectrafiles, selection)
+    if memory_budget is None:
+        chunks = [spectrafiles]
+    else:
+        chunks = membudget.chunk_by_size(
+            spectrafiles, membudget.estimated_pico_bytes, memory_budget)
+    for chunk in chunks:
+        clean = qc_clean_spectra(chunk)
+        for spectrafile in chunk:
+            spectra_numbers = None if selection is None else \
+                selection[spectrafile.spath + spectrafile.sfile]
+            if clean is not None:
+                passed = clean.get(spectrafile.spath + spectrafile.sfile, [])
+                spectra_numbers = passed if spectra_numbers is None else \
+                    [i for i in spectra_numbers if i in passed]
+            db_interface.specchio_upload_pico_spectra(
+                spectrafile, index_engine, spectra_numbers)
+        if memory_budget is not None:
+            db_interface.flush()
+            del clean
+            membudget.release()
+
+
+def upload_selected_spectra(db_interface, top_dir, where):
+    """Uploads the spectra under top_dir matching an SQL condition on the
+    PICO catalog, bringing the catalog up to date first"""
+    import pico_catalog
+    catalog = pico_catalog.PicoCatalog(args.catalog)
+    changes = catalog.update([top_dir], workers=args.catalog_workers)
+    print("Catalog: {added} new, {changed} changed, {removed} removed and"
+          " {unchanged} unchanged spectra files".format(**changes))
+    selection = catalog.select(where)
+    catalog.close()
+    print("Selected", len(selection), "spectra")
+    to_upload = pico_catalog.PicoCatalog.spectra_to_upload(selection)
+    upload_spectra_files(
+        db_interface, [spectrafile for spectrafile, _ in to_upload],
+        dict((spectrafile.spath + spectrafile.sfile, spectra_numbers)
+             for spectrafile, spectra_numbers in to_upload))
+
+
+def new_db_interface(campaign_name):
+    """A database interface for the campaign, with the journal,
+    deduplicator, similarity index, resampler and ancillary snapshot that
+    the options set up"""
+    return specchio.specchioDBinterface(
+        campaign_name, deduplicator=deduplicator,
+        similarity_index=similarity_index, journal=journal,
+        resampler=resampler, ancil_snapshot=ancil_snapshot)
+
+
+def upload_watched_batch(db_interface, paths):
+    """Uploads a batch of new files found by --watch, then writes out
+    anything the client has buffered"""
+    pico_paths = [path for path in paths if path.endswith('.pico')]
+    # PRN (LAI) files are not uploaded yet, and the upload of a batch would
+    # stop at the first one, leaving the rest of the batch out
+    prn_paths = [path for path in paths if path.lower().endswith('.prn')]
+    ancil_paths = [path for path in paths
+                   if path not in pico_paths and path not in prn_paths]
+    if pico_paths:
+        upload_spectra_files(db_interface, [
+            spectraparser.SpectraFile(os.path.basename(path),
+                                      os.path.join(os.path.dirname(path), ''))
+            for path in pico_paths])
+    if ancil_paths and args.datapath:
+        # Ending with a separator, as for the other ancillary uploads
+        db_interface.specchio_upload_ancil_with_dummy_spectra(
+            os.path.join(os.path.abspath(args.datapath), ''),
+            args.plots_file, ancil_paths, memory_budget)
+    for path in prn_paths:
+        print("Not uploaded, as PRN files are not supported yet:", path)
+    db_interface.flush()
+    print("Uploaded", len(paths), "new files")
+
+
+def report_run():
+    """Stops the Java memory sampler and reports the run's metrics, as
+    the options asked"""
+    if jvm_monitor is not None:
+        jvm_monitor.stop()
+    if args.profile:
+        print(metrics.report())
+    if args.metrics_json:
+        metrics.write_json(args.metrics_json)
+
 
 args = parser.parse_args()
 # Must have at least one of these options:
@@ -70,29 +322,149 @@ if not (args.datapath or args.spectrapath or args.test_spectra_mode or
                  " the --datapath option or specify --test-mode.")
     sys.exit(0)
 
-# Assumes a single spectra file for now
-if args.spectrapath and args.spectrafile:
-    spectra_filename = args.spectraname
-    spectra_filepath = args.spectrapath
+memory_budget = None
+if args.memory_budget:
+    try:
+        memory_budget = membudget.parse_size(args.memory_budget)
+    except ValueError as err:
+        parser.error(str(err))
+if memory_budget is not None or args.profile or args.metrics_json:
+    metrics.track_memory()
+
+if args.export_archive:
+    import campaign_archive
+    import ancildata_parser
+    spectrafiles = []
+    if args.spectrapath:
+        for dirname, _, files in os.walk(args.spectrapath):
+            spectrafiles.extend(
+                spectraparser.SpectraFile(fname, os.path.join(dirname, ''))
+                for fname in sorted(files) if fname.endswith('.pico'))
+    ancilpath = os.path.join(os.path.abspath(args.datapath), '') \
+        if args.datapath else None
+    # With a memory budget, each group of files is appended in turn
+    if memory_budget is None:
+        spectra_chunks = [spectrafiles]
+        ancil_chunks = [ancildata_parser.extract_dataframes(
+            ancilpath, args.plots_file)] if ancilpath else []
+    else:
+        spectra_chunks = membudget.chunk_by_size(
+            spectrafiles, membudget.estimated_pico_bytes, memory_budget)
+        ancil_chunks = ancildata_parser.iter_dataframe_chunks(
+            ancilpath, memory_budget, args.plots_file) if ancilpath else []
+    appended = 0
+    for chunk in spectra_chunks:
+        appended += campaign_archive.export_campaign(
+            args.export_archive, chunk, workers=args.export_workers,
+            campaign_name=args.campaign_name, root=args.spectrapath)
+        if memory_budget is not None:
+            membudget.release()
+    for chunk in ancil_chunks:
+        campaign_archive.export_campaign(args.export_archive,
+                                         ancil_dataframes=chunk)
+        if memory_budget is not None:
+            del chunk
+            membudget.release()
+    print("Exported", appended, "new spectra to", args.export_archive)
+    if args.profile:
+        print(metrics.report())
+    if args.metrics_json:
+        metrics.write_json(args.metrics_json)
+    sys.exit(0)
+
+# Set by whichever upload below is run
+db_interface = None
+
+# Sample the Java heap and GC time into the run metrics
+jvm_monitor = None
+if (args.profile or args.metrics_json) and \
+        specchio.SPECCHIO_CLIENT_BACKEND == 'java':
+    import jvm
+    jvm_monitor = jvm.JavaMemorySampler().start()
+
+index_engine = None
+if args.vegetation_indices:
+    import vegetation_indices
+    index_engine = vegetation_indices.IndexEngine()
+
+deduplicator = None
+if args.skip_duplicates:
+    import spectra_dedup
+    deduplicator = spectra_dedup.Deduplicator(
+        spectra_dedup.HashIndex(args.hash_index), bool(args.check_server))
+
+# Progress of every spectra upload is journalled, so it can be resumed
+journal = upload_journal.UploadJournal(args.journal, bool(args.resume))
+if args.resume and args.campaign_name:
+    done = journal.summary(args.campaign_name).get('done', 0)
+    print("Resuming upload:", done, "files already uploaded to",
+          args.campaign_name)
+
+similarity_index = None
+if args.similarity_index:
+    import spectral_index
+    similarity_index = spectral_index.SpectralIndex.open(
+        args.similarity_index)
+
+resampler = None
+if args.common_grid:
+    import spectra_resample
+    try:
+        resampler = spectra_resample.Resampler(
+            spectra_resample.parse_grid(args.common_grid))
+    except ValueError as err:
+        parser.error(str(err))
+
+# The ancillary data uploaded is recorded, for --update-metadata
+ancil_snapshot = None
+if args.datapath:
+    import ancil_snapshot as snapshot
+    ancil_snapshot = snapshot.AncilSnapshot(args.ancil_snapshot)
+elif args.update_metadata:
+    parser.error("--update-metadata needs the --data-path of the corrected"
+                 " ancillary data.")
+
+if args.spectrapath and args.spectraname:
+    spectra_filepath = os.path.join(args.spectrapath, '')
     campaign_name = args.campaign_name
 
-    spectrafile = spectraparser.SpectraFile(spectra_filename, spectra_filepath)
-    db_interface = specchio.specchioDBinterface(campaign_name)
-    db_interface.db_interface.specchio_upload_pico_spectra(spectrafile)
+    db_interface = new_db_interface(campaign_name)
+    upload_spectra_files(db_interface, [
+        spectraparser.SpectraFile(spectra_filename, spectra_filepath)
+        for spectra_filename in args.spectraname])
+
+if args.spectrapath and args.select:
+    db_interface = new_db_interface(args.campaign_name)
+    upload_selected_spectra(db_interface, args.spectrapath, args.select)
 
-if args.spectrapath and not args.spectrafile:
+if args.spectrapath and not (args.spectraname or args.watch or
+                             args.select):
     parser.error("You supplied a path to the spectra files, but not the name"
                  " of a spectra file.")
     sys.exit(0)
 
 if args.datapath:
-    # Upload the metadata in the data path
-    # TODO: Normalise filepath perhaps?
-    ancilpath = args.datapath
+    # Upload the metadata in the data path. The dictionary names of the
+    # files are taken from their paths below it, so it must end with a
+    # separator
+    ancilpath = os.path.join(os.path.abspath(args.datapath), '')
     campaign_name = args.campaign_name
     # Initialise the database interface object for data upload
-    db_interface = specchio.specchioDBinterface(campaign_name)
-    db_interface.specchio_upload_ancil_with_dummy_spectra(ancilpath)
+    db_interface = new_db_interface(campaign_name)
+    if args.update_metadata:
+        summary = db_interface.update_ancil_metadata(ancilpath,
+                                                     args.plots_file)
+        print("Updated metadata:", summary['changed'], "changed,",
+              summary['added'], "added and", summary['removed'],
+              "removed values of", summary['rows_updated'], "rows, in",
+              summary['eav_updates'], "updates;",
+              summary['rows_without_spectra'], "rows have no spectra")
+    elif not args.watch:
+        # With --watch, only new files are uploaded; the dummy spectra of
+        # the ancillary data are not journalled, so uploading the whole
+        # data path on every start would duplicate them
+        db_interface.specchio_upload_ancil_with_dummy_spectra(
+            ancilpath, args.plots_file, memory_budget=memory_budget)
 
 if args.test_metadata_mode:
     if args.campaign_name is None:
@@ -104,7 +476,7 @@ if args.test_metadata_mode:
 
     # VALIDATE PATH!
 
-    db_interface = specchio.specchioDBinterface(campaign_name)
+    db_interface = new_db_interface(campaign_name)
     db_interface.specchio_upload_ancil_with_dummy_spectra(ancilpath)
 
 if args.test_spectra_mode:
@@ -118,8 +490,33 @@ if args.test_spectra_mode:
         campaign_name = args.campaign_name
 
     spectrafile = spectraparser.SpectraFile(spectra_filename, spectra_filepath)
-    db_interface = specchio.specchioDBinterface(campaign_name)
-    db_interface.specchio_upload_pico_spectra(spectrafile)
+    db_interface = new_db_interface(campaign_name)
+    upload_spectra_files(db_interface, [spectrafile])
+
+# Write anything still buffered by the client (bulk SQL backend)
+if db_interface is not None:
+    db_interface.flush()
+
+if args.watch:
+    import folder_watcher
+    watch_paths = [path for path in (args.spectrapath, args.datapath)
+                   if path]
+    if not watch_paths:
+        parser.error("--watch needs a --spectra-path and/or --data-path to"
+                     " watch.")
+    # An interface of its own, whichever uploads were run above
+    db_interface = new_db_interface(args.campaign_name)
+    watcher = folder_watcher.FolderWatcher(
+        watch_paths, lambda paths: upload_watched_batch(db_interface, paths),
+        quiet_seconds=args.watch_quiet, max_batch_files=args.batch_files,
+        max_batch_seconds=args.batch_seconds)
+    # The metrics are reported however the watcher stops
+    try:
+        watcher.run()
+    finally:
+        report_run()
+else:
+    report_run()
 
 
 def new_data():
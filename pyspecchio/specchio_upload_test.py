@@ -1,22 +1,9 @@
 import jpype as jp
-import time
 
+import campaign_loader
+import jvm
 
-def init_jvm(jvmpath=None):
-    """
-    Checks first to see if JVM is already running.
-    """
-    if jp.isJVMStarted():
-        return
-    try:
-        client_java_path = os.environ['SPECCHIO_JAVA_CLIENT']
-        client_java_argument = "-Djava.class.path=" + client_java_path
-        jp.startJVM(jp.getDefaultJVMPath(), "-ea", client_java_argument)
-    except Exception as exc:
-        print(exc)
-        sys.exit(1)
-
-init_jvm()
+jvm.start_jvm()
 
 spclient = jp.JPackage('ch').specchio.client
 spquery = jp.JPackage('ch').specchio.queries
@@ -29,21 +16,16 @@ client_factory = spclient.SPECCHIOClientFactory.getInstance()
 descriptor_list = client_factory.getAllServerDescriptors()
 specchio_client = client_factory.createClient(descriptor_list.get(0))
 
-# Set up a campaign data loader
-cdl = spreader_campaign.SpecchioCampaignDataLoader(specchio_client)
-
-campaign = specchio_client.getCampaign(18)
-
-cdl.set_campaign(campaign)
-cdl.start()
+# Load the campaign's data on the server, reporting progress as it goes
+def progress(campaign_name, parsed, inserted):
+    print(campaign_name + ':', parsed, 'parsed,', inserted, 'inserted')
 
-delay = 0.01
 
-while cdl.isAlive:
-    time.sleep(delay)
+result = campaign_loader.load_campaigns(
+    [18], progress=progress, clients=[specchio_client])[0]
 
-print('Number of parsed files: ', cdl.getParsed_file_Counter)
-print('Number of inserted files: ', cdl.getSuccessful_file_counter)
+print('Number of parsed files: ', result['parsed'])
+print('Number of inserted files: ', result['inserted'])
 
 
 # class testSpecchio(unittest.TestCase):
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+"""
+Content-hash deduplication of spectra before upload.
+
+The same PICO folders are often copied to the ingest share more than once.
+Each spectrum is identified by a hash of its pixel buffer and key metadata
+(DEDUP_METADATA_KEYS). Hashes of uploaded spectra are kept in a local SQLite
+index, per campaign, and spectra already in it are not uploaded again.
+
+The hash is also uploaded with each spectrum, as the 'Content Hash'
+attribute, so that the server can be asked about spectra that were uploaded
+from another machine (Deduplicator(check_server=True)).
+"""
+
+import hashlib
+import os
+import sqlite3
+
+import numpy as np
+
+try:
+    from pyspecchio import metrics
+    from pyspecchio.file_cache import get_cache_dir
+except ImportError:
+    import metrics
+    from file_cache import get_cache_dir
+
+# Metadata that, with the pixels, identifies a spectrum
+DEDUP_METADATA_KEYS = ('SerialNumber', 'Datetime', 'Direction')
+
+# SPECCHIO attribute the hash is uploaded as
+CONTENT_HASH_ATTRIBUTE = 'Content Hash'
+
+DEFAULT_INDEX_NAME = 'spectra_hashes.sqlite'
+
+
+def spectrum_hash(pixels, metadata):
+    """Hash of a spectrum's pixel buffer and its DEDUP_METADATA_KEYS"""
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(np.ascontiguousarray(pixels, dtype='float64').tobytes())
+    for key in DEDUP_METADATA_KEYS:
+        digest.update(repr((key, metadata.get(key))).encode('utf-8'))
+    return digest.hexdigest()
+
+
+class HashIndex(object):
+    """Local index of the content hashes uploaded to each campaign.
+
+    Args:
+        filename: the SQLite file, by default in PYSPECCHIO_CACHE_DIR,
+            or ':memory:' for an index lasting only this run.
+    """
+
+    def __init__(self, filename=None):
+        if filename is None:
+            filename = os.path.join(get_cache_dir('dedup'),
+                                    DEFAULT_INDEX_NAME)
+        self.connection = sqlite3.connect(filename)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS spectrum_hash ("
+            " campaign TEXT, hash TEXT, PRIMARY KEY (campaign, hash))")
+        self.connection.commit()
+        # campaign -> set of hashes, read once per campaign
+        self.hashes = {}
+
+    def _campaign_hashes(self, campaign):
+        if campaign not in self.hashes:
+            rows = self.connection.execute(
+                "SELECT hash FROM spectrum_hash WHERE campaign = ?",
+                (campaign,))
+            self.hashes[campaign] = set(row[0] for row in rows)
+        return self.hashes[campaign]
+
+    def contains(self, campaign, content_hash):
+        return content_hash in self._campaign_hashes(campaign)
+
+    def add(self, campaign, content_hashes):
+        hashes = self._campaign_hashes(campaign)
+        new = [h for h in content_hashes if h not in hashes]
+        self.connection.executemany(
+            "INSERT OR IGNORE INTO spectrum_hash (campaign, hash)"
+            " VALUES (?, ?)", [(campaign, h) for h in new])
+        self.connection.commit()
+        hashes.update(new)
+
+    def close(self):
+        self.connection.close()
+
+
+class Deduplicator(object):
+    """Decides which spectra of a file have already been uploaded.
+
+    Args:
+        index: a HashIndex (the default one if None)
+        check_server: also look the hashes up on the server, with an EAV
+            query on the 'Content Hash' attribute (one query per spectrum
+            not in the local index)
+    """
+
+    def __init__(self, index=None, check_server=False):
+        self.index = HashIndex() if index is None else index
+        self.check_server = check_server
+        # campaign -> hashes of spectra inserted but still buffered by the
+        # client, added to the index once they are written out
+        self.pending = {}
+
+    def find_duplicates(self, db_interface, hashes):
+        """Returns the set of spectra numbers, of a dict of spectra number
+        -> content hash, that are duplicates"""
+        campaign = db_interface.campaign_name
+        duplicates = set()
+        for i, content_hash in sorted(hashes.items()):
+            if self.index.contains(campaign, content_hash) or \
+                    content_hash in self.pending.get(campaign, ()):
+                duplicates.add(i)
+            elif self.check_server and \
+                    db_interface.spectra_with_content_hash(content_hash):
+                duplicates.add(i)
+                self.index.add(campaign, [content_hash])
+        return duplicates
+
+    def record_uploaded(self, db_interface, hashes):
+        """Holds the hashes of inserted spectra until commit_uploaded, as
+        the client may not have written the spectra out yet"""
+        self.pending.setdefault(db_interface.campaign_name, set()).update(
+            hashes)
+
+    def commit_uploaded(self, campaign):
+        """Adds the held hashes to the index, once the client has
+        written their spectra out"""
+        hashes = self.pending.pop(campaign, None)
+        if hashes:
+            self.index.add(campaign, sorted(hashes))
+
+    @staticmethod
+    def record_skipped(spectra):
+        """Counts the spectra skipped and the pixel bytes not uploaded (as
+        32 bit floats)"""
+        metrics.count('dedup.spectra_skipped', len(spectra))
+        metrics.count('dedup.bytes_saved',
+                      sum(4 * len(vector) for vector in spectra))
@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+"""
+Parallel bulk download of spectra and their metadata into pandas.
+
+A long list of spectrum ids (e.g. from getSpectrumIdsMatchingQuery) is
+split into pages. The pages are downloaded concurrently, one thread per
+SPECCHIO client, each thread using only its own client. For each page,
+the spectral spaces are loaded (getSpaces/loadSpace), with one
+getMetaparameterValues call per requested attribute. The pages are then
+assembled into one wide DataFrame, indexed by spectrum id, with a column
+per attribute and then a column per wavelength.
+
+    clients = spectra_download.connect_clients(4)
+    ids = clients[0].getSpectrumIdsMatchingQuery(query)
+    df = spectra_download.download(ids, ['Direction', 'Plot ID'],
+                                   clients=clients)
+
+With the JVM client, each thread is attached to the JVM by JPype. Spectra
+from spaces with different wavelength grids are NaN at the wavelengths of
+the other grids.
+"""
+
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import numpy as np
+import pandas as pd
+
+try:
+    from pyspecchio import metrics
+    from pyspecchio import specchio_db_interface as specchio
+except ImportError:
+    import metrics
+    import specchio_db_interface as specchio
+
+DEFAULT_PAGE_SIZE = 1000
+DEFAULT_WORKERS = 4
+
+
+def paginate(ids, page_size=DEFAULT_PAGE_SIZE):
+    """Splits spectrum ids (without repeats) into lists of at most
+    page_size ids"""
+    ids = list(dict.fromkeys(int(spectrum_id) for spectrum_id in ids))
+    return [ids[start:start + page_size]
+            for start in range(0, len(ids), page_size)]
+
+
+def connect_clients(n):
+    """Creates n clients connected to the first configured server"""
+    specchio.init_jvm()
+    factory = specchio.spclient.SPECCHIOClientFactory.getInstance()
+    descriptor = factory.getAllServerDescriptors().get(0)
+    return [factory.createClient(descriptor) for _ in range(n)]
+
+
+def print_progress(spectra_done, spectra_total):
+    """Default progress report: a line updated in place on stderr"""
+    sys.stderr.write("\rDownloaded {} of {} spectra".format(
+        spectra_done, spectra_total))
+    if spectra_done == spectra_total:
+        sys.stderr.write("\n")
+    sys.stderr.flush()
+
+
+def _to_python(value):
+    """Python value of a metaparameter value (java Double, String...)"""
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    if hasattr(value, 'doubleValue'):  # java.lang.Number
+        return float(value.doubleValue())
+    return str(value)
+
+
+def download_page(client, page, attributes=(),
+                  order_by='Acquisition Time'):
+    """Downloads one page of spectrum ids with one client.
+
+    Returns:
+        (spectra, metadata): dataframes indexed by spectrum id, with a
+        column per wavelength and a column per attribute respectively
+    """
+    java_ids = specchio.to_java_id_list(page)
+    frames = []
+    for space in client.getSpaces(java_ids, order_by):
+        space = client.loadSpace(space)
+        space_ids = [int(i) for i in space.getSpectrumIds()]
+        if not space_ids:
+            continue
+        vectors = np.array([np.asarray(vector, dtype='float64')
+                            for vector in space.getVectorsAsArray()])
+        frames.append(pd.DataFrame(
+            vectors, index=space_ids,
+            columns=np.asarray(space.getAverageWavelengths(),
+                               dtype='float64')))
+    spectra = pd.concat(frames) if frames else pd.DataFrame(index=page)
+    metadata = pd.DataFrame(index=page)
+    for attribute in attributes:
+        metadata[attribute] = [
+            _to_python(value) for value in
+            client.getMetaparameterValues(java_ids, attribute)]
+    return spectra, metadata
+
+
+class SpectraDownloader(object):
+    """Downloads pages of spectra concurrently, one thread per client.
+
+    Args:
+        clients: SPECCHIO clients; each is only used by one thread at a time
+        page_size: spectrum ids per page
+        order_by: the order of the spectra within each space
+        progress: called with (spectra downloaded, total) after each page,
+            or None for no progress report
+    """
+
+    def __init__(self, clients, page_size=DEFAULT_PAGE_SIZE,
+                 order_by='Acquisition Time', progress=print_progress):
+        if not clients:
+            raise ValueError("Need at least one client to download with")
+        self.clients = list(clients)
+        self.page_size = page_size
+        self.order_by = order_by
+        self.progress = progress
+        self._free_clients = list(self.clients)
+        self._lock = threading.Lock()
+
+    def _download_with_free_client(self, page, attributes):
+        with self._lock:
+            client = self._free_clients.pop()
+        try:
+            return download_page(client, page, attributes, self.order_by)
+        finally:
+            with self._lock:
+                self._free_clients.append(client)
+
+    def download(self, ids, attributes=()):
+        """Downloads the spectra and attributes of the spectrum ids.
+
+        Returns:
+            A DataFrame indexed by spectrum id (in the order of ids), with
+            the attributes then the spectra (one column per wavelength)
+        """
+        pages = paginate(ids, self.page_size)
+        total = sum(len(page) for page in pages)
+        spectra_parts = []
+        metadata_parts = []
+        done = 0
+        with metrics.timer('download.total'):
+            with ThreadPoolExecutor(max_workers=len(self.clients)) as pool:
+                futures = [pool.submit(self._download_with_free_client,
+                                       page, attributes) for page in pages]
+                for future in as_completed(futures):
+                    spectra, metadata = future.result()
+                    spectra_parts.append(spectra)
+                    metadata_parts.append(metadata)
+                    done += len(metadata)
+                    metrics.count('download.pages')
+                    if self.progress is not None:
+                        self.progress(done, total)
+            with metrics.timer('download.assemble'):
+                wide = self._assemble(pages, spectra_parts, metadata_parts,
+                                      attributes)
+        metrics.count('download.spectra', total)
+        return wide
+
+    @staticmethod
+    def _assemble(pages, spectra_parts, metadata_parts, attributes):
+        order = [spectrum_id for page in pages for spectrum_id in page]
+        if spectra_parts:
+            spectra = pd.concat(spectra_parts)
+            spectra = spectra[sorted(spectra.columns)].reindex(order)
+            metadata = pd.concat(metadata_parts).reindex(order)
+        else:
+            spectra = pd.DataFrame(index=order)
+            metadata = pd.DataFrame(index=order, columns=list(attributes))
+        wide = pd.concat([metadata, spectra], axis=1)
+        wide.index.name = 'spectrum_id'
+        return wide
+
+
+def download(ids, attributes=(), workers=DEFAULT_WORKERS, clients=None,
+             page_size=DEFAULT_PAGE_SIZE, progress=print_progress):
+    """Downloads spectra and attributes into a wide DataFrame, with
+    workers new clients unless clients are given (see SpectraDownloader)"""
+    if clients is None:
+        clients = connect_clients(workers)
+    return SpectraDownloader(clients, page_size,
+                             progress=progress).download(ids, attributes)
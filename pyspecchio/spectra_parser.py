@@ -11,9 +11,15 @@ or pandas
 
 import json
 import os
+import numpy as np
 import pandas as pd
 from pandas.io.json import json_normalize
 
+try:
+    from pyspecchio import metrics
+except ImportError:
+    import metrics
+
 
 class SpectraFile(object):
     def __init__(self, spectrafile, spectrapath):
@@ -22,8 +28,11 @@ class SpectraFile(object):
 
     def read_json(self):
         """Simple JSON reader"""
-        with open(self.spath + self.sfile, "r") as f:
-            data = json.load(f)
+        with metrics.timer('spectra.json_decode'):
+            with open(self.spath + self.sfile, "r") as f:
+                data = json.load(f)
+                metrics.count('spectra.bytes_read', f.tell())
+        metrics.count('spectra.json_reads')
         return data
 
     def pandas_read_json(self):
@@ -99,6 +108,96 @@ class SpectraFile(object):
         # Metadata [0] and Pixels [1]
         return whole_file['Spectra'][spectra_number]['Pixels']
 
+    def get_spectra_wavelengths(self, spectra_number):
+        """Returns the wavelengths (nm) of each pixel of ONE of the spectra,
+        from the spectrometer's wavelength calibration coefficients."""
+        metadata = self.get_spectra_metadata(spectra_number)
+        return wavelengths_from_coefficients(
+            metadata['WavelengthCalibrationCoefficients'],
+            len(self.get_spectra_pixels(spectra_number)))
+
+
+def wavelengths_from_coefficients(coefficients, num_pixels):
+    """Wavelength of each pixel from the polynomial calibration coefficients
+    (c0 + c1 * pixel + c2 * pixel^2 + ...), as used by Ocean Optics."""
+    return np.polynomial.polynomial.polyval(
+        np.arange(num_pixels, dtype='float64'), coefficients)
+
+
+class SpectraStack(object):
+    """The spectra from one or more files that share a wavelength grid,
+    stacked into a 2D array with one spectrum per row.
+
+    Attributes:
+        wavelengths: 1D array of the wavelength (nm) of each pixel
+        spectra: 2D array, (number of spectra, number of pixels)
+        metadata: list of the metadata dict of each spectrum
+        sources: list of (file path, spectra number) of each spectrum
+    """
+
+    def __init__(self, wavelengths):
+        self.wavelengths = np.asarray(wavelengths, dtype='float64')
+        self.spectra = np.empty((0, len(self.wavelengths)))
+        self.metadata = []
+        self.sources = []
+        self._rows = []
+
+    def add(self, pixels, metadata, source):
+        self._rows.append(pixels)
+        self.metadata.append(metadata)
+        self.sources.append(source)
+
+    def finish(self):
+        """Builds the spectra array from the rows added"""
+        if self._rows:
+            self.spectra = np.array(self._rows, dtype='float64')
+        self._rows = []
+        return self
+
+    def __len__(self):
+        return len(self.sources)
+
+
+def stack_spectra(spectrafiles):
+    """Reads the spectra of several SpectraFiles into SpectraStacks, one
+    for each distinct wavelength grid (i.e. instrument calibration and
+    detector size). Each file is only read once. Spectra are identified
+    by their file's full path, as file names repeat across PICO folders.
+
+    Returns:
+        A list of SpectraStack
+    """
+    stacks = {}
+    for spectrafile in spectrafiles:
+        whole_file = spectrafile.read_json()
+        _add_to_stacks(stacks, spectrafile,
+                       [spectrum['Pixels'] for spectrum in
+                        whole_file['Spectra']],
+                       [spectrum['Metadata'] for spectrum in
+                        whole_file['Spectra']])
+    return [stack.finish() for stack in stacks.values()]
+
+
+def stack_file_spectra(spectrafile, spectra, metadata):
+    """As stack_spectra, for the pixels and metadata of the spectra of one
+    file that have already been read (all of them, in file order)"""
+    stacks = {}
+    _add_to_stacks(stacks, spectrafile, spectra, metadata)
+    return [stack.finish() for stack in stacks.values()]
+
+
+def _add_to_stacks(stacks, spectrafile, spectra, metadata):
+    # Stacks are keyed by calibration and detector size
+    for i, (pixels, spectrum_metadata) in enumerate(zip(spectra, metadata)):
+        key = (tuple(spectrum_metadata['WavelengthCalibrationCoefficients']),
+               len(pixels))
+        if key not in stacks:
+            stacks[key] = SpectraStack(wavelengths_from_coefficients(
+                key[0], key[1]))
+        stacks[key].add(pixels, spectrum_metadata,
+                        (spectrafile.spath + spectrafile.sfile, i))
+
+
 class DummySpectraFile(SpectraFile):
     """Class that contains dummy spectra for when Metadata have no assoc.
     pico file but need to be inserted into SPECCHIO.
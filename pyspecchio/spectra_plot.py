@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+"""
+Fast plotting of large collections of spectra.
+
+Plotting one matplotlib line per spectrum (as in specchio_connect.py)
+becomes unusable past a few thousand spectra. Here all the spectra are
+reduced to what can be seen before anything is drawn:
+
+    - plot_lines() draws every spectrum as a single LineCollection, each
+      decimated to the minimum and maximum of each of `columns` runs of
+      pixels (so peaks and dips survive; about the width of the plot in
+      pixels is enough),
+    - plot_density() draws a 2D histogram of how many spectra pass through
+      each (wavelength, value) cell, for collections too big to see as
+      lines,
+    - plot_envelopes() draws percentile bands per group of spectra, e.g. per
+      plot or per day.
+
+plot_spectra() chooses between lines and density by the number of spectra.
+The spectra are a 2D array with one spectrum per row, as in
+spectra_parser.SpectraStack:
+
+    stack = spectra_parser.stack_spectra(spectrafiles)[0]
+    spectra_plot.plot_spectra(stack.wavelengths, stack.spectra)
+    days = [metadata['Datetime'][:10] for metadata in stack.metadata]
+    spectra_plot.plot_envelopes(stack.wavelengths,
+        spectra_plot.percentile_envelopes(stack.spectra, days))
+
+The reductions only need numpy; drawing needs matplotlib.
+"""
+
+import numpy as np
+
+try:
+    import matplotlib.pyplot as plt
+    from matplotlib.collections import LineCollection
+    from matplotlib.colors import LogNorm
+except ImportError:
+    plt = None
+
+try:
+    from pyspecchio import metrics
+except ImportError:
+    import metrics
+
+# Pixel runs each spectrum is decimated to (about a plot's width)
+DEFAULT_COLUMNS = 1000
+# Size of the density image
+DEFAULT_DENSITY_SHAPE = (600, 1000)
+# plot_spectra() draws more spectra than this as a density image
+LINES_MAX_SPECTRA = 5000
+# Spectra binned at a time into the density image
+DENSITY_CHUNK = 4096
+DEFAULT_PERCENTILES = (5, 25, 50, 75, 95)
+
+
+def _require_matplotlib():
+    if plt is None:
+        raise ImportError("The matplotlib module is needed for plotting")
+
+
+def minmax_decimate(wavelengths, spectra, columns=DEFAULT_COLUMNS):
+    """Reduces each spectrum to the minimum and maximum of each of about
+    `columns` runs of consecutive pixels, in wavelength order.
+
+    Returns:
+        (x, y): 2D arrays of the wavelengths and values of the points kept,
+        one row per spectrum (the inputs if they are small enough already)
+    """
+    wavelengths = np.asarray(wavelengths, dtype='float64')
+    spectra = np.atleast_2d(np.asarray(spectra, dtype='float64'))
+    n_spectra, n_pixels = spectra.shape
+    if n_pixels <= 2 * columns:
+        return np.broadcast_to(wavelengths, spectra.shape), spectra
+    width = -(-n_pixels // columns)
+    columns = -(-n_pixels // width)
+    padding = columns * width - n_pixels
+    with metrics.timer('plot.decimate'):
+        finite = np.isfinite(spectra)
+        for_min = np.pad(np.where(finite, spectra, np.inf),
+                         ((0, 0), (0, padding)), constant_values=np.inf)
+        for_max = np.pad(np.where(finite, spectra, -np.inf),
+                         ((0, 0), (0, padding)), constant_values=-np.inf)
+        shape = (n_spectra, columns, width)
+        lowest = for_min.reshape(shape).argmin(axis=2)
+        highest = for_max.reshape(shape).argmax(axis=2)
+        starts = np.arange(columns) * width
+        index = np.stack([np.minimum(lowest, highest),
+                          np.maximum(lowest, highest)], axis=2) \
+            + starts[None, :, None]
+        index = np.minimum(index.reshape(n_spectra, 2 * columns),
+                           n_pixels - 1)
+    return wavelengths[index], np.take_along_axis(spectra, index, axis=1)
+
+
+def density_image(wavelengths, spectra, shape=DEFAULT_DENSITY_SHAPE,
+                  value_range=None):
+    """Counts the spectra values falling in each cell of a (value,
+    wavelength) grid of shape (rows, columns).
+
+    Args:
+        value_range: (low, high) of the rows, by default the range of the
+            finite values
+
+    Returns:
+        (image, extent): the counts, lowest value first, and the
+        (left, right, bottom, top) of the image for imshow
+    """
+    wavelengths = np.asarray(wavelengths, dtype='float64')
+    spectra = np.atleast_2d(np.asarray(spectra))
+    rows, columns = shape
+    if value_range is None:
+        value_range = (np.nanmin(spectra), np.nanmax(spectra))
+    low, high = float(value_range[0]), float(value_range[1])
+    if high <= low:
+        high = low + 1.0
+    left, right = wavelengths.min(), wavelengths.max()
+    column = np.minimum(((wavelengths - left) / max(right - left, 1e-12) *
+                         columns).astype('int64'), columns - 1)
+    counts = np.zeros(rows * columns, dtype='int64')
+    with metrics.timer('plot.density'):
+        for start in range(0, len(spectra), DENSITY_CHUNK):
+            chunk = spectra[start:start + DENSITY_CHUNK]
+            scaled = (chunk - low) / (high - low) * rows
+            valid = np.isfinite(scaled) & (scaled >= 0) & (scaled <= rows)
+            row = np.minimum(scaled[valid].astype('int64'), rows - 1)
+            cell = row * columns + np.broadcast_to(column, chunk.shape)[valid]
+            counts += np.bincount(cell, minlength=rows * columns)
+    return counts.reshape(rows, columns), (left, right, low, high)
+
+
+def percentile_envelopes(spectra, groups=None,
+                         percentiles=DEFAULT_PERCENTILES):
+    """Percentiles of the spectra at each wavelength, per group.
+
+    Args:
+        groups: a label (e.g. plot ID or date) per spectrum, or None for
+            one group of all the spectra
+
+    Returns:
+        A dict of label -> 2D array, (len(percentiles), number of pixels)
+    """
+    spectra = np.atleast_2d(np.asarray(spectra, dtype='float64'))
+    if groups is None:
+        groups = np.zeros(len(spectra), dtype='int64')
+        labels = [None]
+    else:
+        labels, groups = np.unique(np.asarray(groups), return_inverse=True)
+    with metrics.timer('plot.envelopes'):
+        return dict((label, np.nanpercentile(spectra[groups == i],
+                                             percentiles, axis=0))
+                    for i, label in enumerate(labels))
+
+
+def plot_lines(wavelengths, spectra, ax=None, columns=DEFAULT_COLUMNS,
+               **line_kwargs):
+    """Draws the (decimated) spectra as one LineCollection, returning it.
+    Keyword arguments are passed to LineCollection."""
+    _require_matplotlib()
+    ax = ax if ax is not None else plt.gca()
+    x, y = minmax_decimate(wavelengths, spectra, columns)
+    line_kwargs.setdefault('linewidths', 0.5)
+    line_kwargs.setdefault('alpha', min(1.0, max(0.05, 50.0 / len(y))))
+    lines = LineCollection(np.stack([x, y], axis=2), **line_kwargs)
+    ax.add_collection(lines)
+    ax.autoscale_view()
+    metrics.count('plot.spectra', len(y))
+    return lines
+
+
+def plot_density(wavelengths, spectra, ax=None, shape=DEFAULT_DENSITY_SHAPE,
+                 value_range=None, cmap='viridis', log=True):
+    """Draws the density image of the spectra, returning the AxesImage"""
+    _require_matplotlib()
+    ax = ax if ax is not None else plt.gca()
+    image, extent = density_image(wavelengths, spectra, shape, value_range)
+    image = np.ma.masked_equal(image, 0)
+    artist = ax.imshow(image, origin='lower', extent=extent, aspect='auto',
+                       cmap=cmap, norm=LogNorm() if log else None,
+                       interpolation='nearest')
+    metrics.count('plot.spectra', len(np.atleast_2d(spectra)))
+    return artist
+
+
+def plot_envelopes(wavelengths, envelopes, ax=None, alpha=0.2):
+    """Draws percentile_envelopes() as shaded bands between the outer pairs
+    of percentiles and a line at the middle one, per group"""
+    _require_matplotlib()
+    ax = ax if ax is not None else plt.gca()
+    for label, envelope in envelopes.items():
+        middle = len(envelope) // 2
+        line, = ax.plot(wavelengths, envelope[middle],
+                        label=None if label is None else str(label))
+        for i in range(middle):
+            ax.fill_between(wavelengths, envelope[i], envelope[-1 - i],
+                            color=line.get_color(), alpha=alpha,
+                            linewidth=0)
+    if any(label is not None for label in envelopes):
+        ax.legend()
+    return ax
+
+
+def plot_spectra(wavelengths, spectra, ax=None, method='auto'):
+    """Draws the spectra as lines, or as a density image if there are more
+    than LINES_MAX_SPECTRA of them (method 'auto', 'lines' or 'density')"""
+    if method == 'auto':
+        method = 'lines' if len(np.atleast_2d(spectra)) <= \
+            LINES_MAX_SPECTRA else 'density'
+    if method == 'lines':
+        return plot_lines(wavelengths, spectra, ax)
+    if method == 'density':
+        return plot_density(wavelengths, spectra, ax)
+    raise ValueError("Unknown plot method: " + str(method))
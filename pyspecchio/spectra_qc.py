@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+"""
+Quality control of PICO spectra before upload.
+
+The spectra of a batch of files are stacked by wavelength grid (see
+spectra_parser.stack_spectra) and every check is run on whole arrays:
+
+    saturated             pixels in the OpticalPixelRange at or above the
+                          spectrometer's SaturationLevel
+    dark                  median signal in the OpticalPixelRange a very
+                          small fraction of the SaturationLevel
+    integration_time      IntegrationTime (ms) outside the allowed range
+    detector_temperature  TemperatureDetectorActual too far from
+                          TemperatureDetectorSet (cooling not settled)
+
+Failed checks are recorded as flags in a QC report (a dataframe, one row per
+spectrum). Spectra with a flag in QCCriteria.reject are rejected; the others
+are clean, and clean_spectra() lists them for
+specchioDBinterface.specchio_upload_pico_spectra.
+"""
+
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+try:
+    from pyspecchio import metrics
+    from pyspecchio.spectra_parser import stack_spectra
+except ImportError:
+    import metrics
+    from spectra_parser import stack_spectra
+
+QC_CHECKS = ('saturated', 'dark', 'integration_time', 'detector_temperature')
+
+
+class QCCriteria(object):
+    """Thresholds of the QC checks.
+
+    Args:
+        max_saturated_pixels: saturated pixels allowed in the optical range
+        min_signal_fraction: lowest median signal, as a fraction of the
+            saturation level
+        min_integration_time, max_integration_time: allowed range (ms),
+            None for no limit
+        max_detector_temperature_error: largest difference (degrees C)
+            between the detector's actual and set temperatures
+        reject: the checks that reject a spectrum; the others only flag it
+    """
+
+    def __init__(self, max_saturated_pixels=0, min_signal_fraction=0.01,
+                 min_integration_time=None, max_integration_time=None,
+                 max_detector_temperature_error=1.0,
+                 reject=('saturated', 'dark')):
+        self.max_saturated_pixels = max_saturated_pixels
+        self.min_signal_fraction = min_signal_fraction
+        self.min_integration_time = min_integration_time
+        self.max_integration_time = max_integration_time
+        self.max_detector_temperature_error = max_detector_temperature_error
+        self.reject = tuple(reject)
+
+
+def _metadata_column(metadata, key):
+    """One float per spectrum, NaN where the key is missing or null"""
+    values = [m.get(key) for m in metadata]
+    return np.array([np.nan if v is None else v for v in values],
+                    dtype='float64')
+
+
+def optical_pixel_mask(metadata, num_pixels):
+    """Boolean (spectra x pixels) mask of each spectrum's
+    OpticalPixelRange (inclusive), or of all pixels if it has none"""
+    low = np.zeros(len(metadata), dtype=int)
+    high = np.full(len(metadata), num_pixels - 1, dtype=int)
+    for row, m in enumerate(metadata):
+        pixel_range = m.get('OpticalPixelRange')
+        if pixel_range and len(pixel_range) == 2:
+            low[row], high[row] = pixel_range
+    pixels = np.arange(num_pixels)
+    return (pixels >= low[:, None]) & (pixels <= high[:, None])
+
+
+def screen_stack(stack, criteria):
+    """Runs the QC checks on a SpectraStack.
+
+    Returns:
+        (values, failed): OrderedDicts of 1D arrays with one entry per
+        spectrum; values has the measured quantities and failed a boolean
+        array for each of QC_CHECKS (True = failed)
+    """
+    spectra = stack.spectra
+    in_range = optical_pixel_mask(stack.metadata, spectra.shape[1])
+    saturation = _metadata_column(stack.metadata, 'SaturationLevel')
+    integration = _metadata_column(stack.metadata, 'IntegrationTime')
+    temperature_error = np.abs(
+        _metadata_column(stack.metadata, 'TemperatureDetectorActual') -
+        _metadata_column(stack.metadata, 'TemperatureDetectorSet'))
+
+    saturated_pixels = ((spectra >= saturation[:, None]) & in_range).sum(
+        axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        signal_fraction = np.nanmedian(
+            np.where(in_range, spectra, np.nan), axis=1) / saturation
+
+    values = OrderedDict([
+        ('saturated_pixels', saturated_pixels),
+        ('signal_fraction', signal_fraction),
+        ('integration_time', integration),
+        ('detector_temperature_error', temperature_error)])
+
+    bad_time = np.zeros(len(stack), dtype=bool)
+    if criteria.min_integration_time is not None:
+        bad_time |= integration < criteria.min_integration_time
+    if criteria.max_integration_time is not None:
+        bad_time |= integration > criteria.max_integration_time
+    failed = OrderedDict([
+        ('saturated', saturated_pixels > criteria.max_saturated_pixels),
+        ('dark', signal_fraction < criteria.min_signal_fraction),
+        ('integration_time', bad_time),
+        # NaN (no detector temperatures, e.g. USB2000+) compares False
+        ('detector_temperature',
+         temperature_error > criteria.max_detector_temperature_error)])
+    return values, failed
+
+
+def screen(spectrafiles, criteria=None):
+    """Runs the QC checks on the spectra of a batch of SpectraFiles.
+
+    Returns:
+        The QC report: a dataframe with a row per spectrum, indexed by
+        (file path, spectra number), with the measured values, a 'flags'
+        column listing the failed checks and a boolean 'rejected' column.
+    """
+    if criteria is None:
+        criteria = QCCriteria()
+    frames = []
+    with metrics.timer('qc.screen'):
+        for stack in stack_spectra(spectrafiles):
+            values, failed = screen_stack(stack, criteria)
+            frame = pd.DataFrame(values, index=pd.MultiIndex.from_tuples(
+                stack.sources, names=['file', 'spectra_number']))
+            frame.insert(0, 'SerialNumber',
+                         [m.get('SerialNumber') for m in stack.metadata])
+            frame.insert(1, 'Direction',
+                         [m.get('Direction') for m in stack.metadata])
+            frame['flags'] = [
+                ','.join(check for check in QC_CHECKS if failed[check][row])
+                for row in range(len(stack))]
+            rejected = np.zeros(len(stack), dtype=bool)
+            for check in criteria.reject:
+                rejected |= failed[check]
+            frame['rejected'] = rejected
+            frames.append(frame)
+    if not frames:
+        return pd.DataFrame(columns=['flags', 'rejected'])
+    report = pd.concat(frames).sort_index()
+    metrics.count('qc.spectra', len(report))
+    metrics.count('qc.rejected', int(report['rejected'].sum()))
+    metrics.count('qc.flagged', int((report['flags'] != '').sum()))
+    return report
+
+
+def clean_spectra(report):
+    """The spectra that passed QC.
+
+    Returns:
+        A dict of file path (spath + sfile) -> list of clean spectra
+        numbers (files with no clean spectra map to an empty list)
+    """
+    clean = OrderedDict()
+    for (path, number), rejected in report['rejected'].items():
+        clean.setdefault(path, [])
+        if not rejected:
+            clean[path].append(number)
+    return clean
+
+
+def write_report(report, filename):
+    """Writes the QC report as CSV"""
+    report.to_csv(filename)
@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+"""
+Resamples spectra from different instruments onto a common wavelength grid.
+
+The PICO spectrometers have different detectors (1044 and 2048 pixels) and
+calibrations, so their spectra are on different wavelength grids. A
+Resampler maps each instrument's calibrated grid onto one target grid with
+a sparse (target x source) matrix:
+
+    'linear'   linear interpolation between the two nearest pixels
+    'average'  the mean of the source spectrum over each target wavelength's
+               bin (pixel-overlap weights), which does not alias when the
+               target grid is coarser than the instrument's
+
+Matrices are cached in memory and on disk (in PYSPECCHIO_CACHE_DIR), keyed
+by a hash of the source grid, target grid and method, so each is only
+computed once per (instrument, target grid). Each batch of spectra on the
+same grid is then resampled with a single sparse matrix multiply:
+
+    resampler = Resampler(np.arange(400.0, 1000.0 + 1e-9, 1.0))
+    common = resampler.harmonise_stacks(spectra_parser.stack_spectra(files))
+    common.spectra   # (all spectra x target wavelengths), one dense array
+
+Target wavelengths outside an instrument's range are NaN in its spectra.
+"""
+
+import os
+
+import numpy as np
+
+try:
+    from scipy import sparse
+except ImportError:
+    sparse = None
+
+try:
+    from pyspecchio import metrics
+    from pyspecchio.file_cache import get_cache_dir, grid_hash
+    from pyspecchio.spectra_parser import (
+        SpectraStack, wavelengths_from_coefficients)
+except ImportError:
+    import metrics
+    from file_cache import get_cache_dir, grid_hash
+    from spectra_parser import SpectraStack, wavelengths_from_coefficients
+
+# Range covered by the QEP and USB2000+ spectrometers, at 1 nm
+DEFAULT_WAVELENGTHS = np.arange(400.0, 1000.0 + 1e-9, 1.0)
+
+METHODS = ('linear', 'average')
+
+
+def parse_grid(grid):
+    """Target wavelengths from 'START:STOP:STEP' (nm, STOP included)"""
+    try:
+        start, stop, step = (float(part) for part in grid.split(':'))
+    except ValueError:
+        raise ValueError("Not a wavelength grid: " + str(grid) +
+                         " (e.g. 400:1000:1)")
+    if step <= 0 or stop < start:
+        raise ValueError("Empty wavelength grid: " + str(grid))
+    return np.arange(start, stop + step * 1e-6, step)
+
+
+def _bin_edges(wavelengths):
+    """Edges of each wavelength's bin, halfway to its neighbours"""
+    middles = (wavelengths[1:] + wavelengths[:-1]) / 2.0
+    return np.concatenate([[2 * wavelengths[0] - middles[0]], middles,
+                           [2 * wavelengths[-1] - middles[-1]]])
+
+
+def resampling_matrix(source, target, method='linear'):
+    """Computes the dense (target x source) resampling weights.
+
+    Returns:
+        (matrix, valid): the weights, and a boolean array marking the target
+        wavelengths within the source range (the others have no weights)
+    """
+    source = np.asarray(source, dtype='float64')
+    target = np.asarray(target, dtype='float64')
+    if method == 'linear':
+        valid = (target >= source[0]) & (target <= source[-1])
+        upper = np.clip(np.searchsorted(source, target), 1, len(source) - 1)
+        lower = upper - 1
+        fraction = (target - source[lower]) / (source[upper] - source[lower])
+        matrix = np.zeros((len(target), len(source)))
+        rows = np.arange(len(target))
+        matrix[rows, lower] = 1.0 - fraction
+        matrix[rows, upper] += fraction
+    elif method == 'average':
+        source_edges = _bin_edges(source)
+        target_edges = _bin_edges(target)
+        valid = (target_edges[:-1] >= source_edges[0]) & \
+            (target_edges[1:] <= source_edges[-1])
+        widths = np.diff(source_edges)
+
+        def covered(x):
+            # Length of each source bin below each x
+            return np.clip(x[:, None] - source_edges[None, :-1], 0, widths)
+        matrix = covered(target_edges[1:]) - covered(target_edges[:-1])
+        totals = matrix.sum(axis=1, keepdims=True)
+        totals[totals == 0] = 1.0
+        matrix /= totals
+    else:
+        raise ValueError("Unknown resampling method: " + str(method) +
+                         ". Choose from: " + ', '.join(METHODS))
+    matrix[~valid] = 0.0
+    return matrix, valid
+
+
+class Resampler(object):
+    """Resamples spectra onto a target grid with cached sparse matrices.
+
+    Args:
+        wavelengths: the target grid (nm)
+        method: one of METHODS
+        cache_dir: where matrices are saved between runs, None for the
+            default, or False to only cache in memory.
+    """
+
+    def __init__(self, wavelengths=DEFAULT_WAVELENGTHS, method='linear',
+                 cache_dir=None):
+        if method not in METHODS:
+            raise ValueError("Unknown resampling method: " + str(method) +
+                             ". Choose from: " + ', '.join(METHODS))
+        if cache_dir is None:
+            cache_dir = get_cache_dir('resampling')
+        self.wavelengths = np.asarray(wavelengths, dtype='float64')
+        self.method = method
+        self.cache_dir = cache_dir
+        self.matrix_cache = {}
+
+    def _cache_file(self, key):
+        return os.path.join(self.cache_dir, key + '.npz')
+
+    def get_matrix(self, source):
+        """Returns (matrix, valid) for a source grid, from the memory or
+        disk cache if it has already been computed. The matrix is a scipy
+        CSR matrix, or dense without scipy."""
+        source = np.asarray(source, dtype='float64')
+        key = grid_hash(source, self.wavelengths, self.method)
+        if key in self.matrix_cache:
+            return self.matrix_cache[key]
+        shape = (len(self.wavelengths), len(source))
+        if self.cache_dir and os.path.exists(self._cache_file(key)):
+            with np.load(self._cache_file(key)) as cached:
+                parts = (cached['data'], cached['indices'], cached['indptr'])
+                valid = cached['valid']
+            metrics.count('resample.matrices_loaded')
+        else:
+            with metrics.timer('resample.compute_matrix'):
+                dense, valid = resampling_matrix(source, self.wavelengths,
+                                                 self.method)
+                rows, columns = np.nonzero(dense)
+                parts = (dense[rows, columns], columns,
+                         np.searchsorted(rows, np.arange(shape[0] + 1)))
+            if self.cache_dir:
+                np.savez_compressed(self._cache_file(key), data=parts[0],
+                                    indices=parts[1], indptr=parts[2],
+                                    valid=valid)
+        if sparse is not None:
+            matrix = sparse.csr_matrix(parts, shape=shape)
+        else:
+            matrix = np.zeros(shape)
+            for row in range(shape[0]):
+                span = slice(parts[2][row], parts[2][row + 1])
+                matrix[row, parts[1][span]] = parts[0][span]
+        self.matrix_cache[key] = (matrix, valid)
+        return self.matrix_cache[key]
+
+    def resample(self, spectra, wavelengths):
+        """Resamples a 2D array of spectra (one per row) on one source grid.
+
+        Returns:
+            A (spectra x target wavelengths) array, NaN outside the source
+            range
+        """
+        matrix, valid = self.get_matrix(wavelengths)
+        spectra = np.atleast_2d(np.asarray(spectra, dtype='float64'))
+        with metrics.timer('resample.apply'):
+            resampled = np.asarray((matrix @ spectra.T).T)
+        resampled[:, ~valid] = np.nan
+        metrics.count('resample.spectra', len(spectra))
+        return resampled
+
+    def resample_many(self, spectra, wavelengths):
+        """Resamples spectra that may each be on a different grid, one
+        matrix multiply per distinct grid.
+
+        Args:
+            spectra: a list of 1D spectra
+            wavelengths: the wavelengths of each spectrum
+
+        Returns:
+            A (spectra x target wavelengths) array, in the order given
+        """
+        groups = {}
+        for i, grid in enumerate(wavelengths):
+            grid = np.asarray(grid, dtype='float64')
+            key = grid_hash(grid)
+            groups.setdefault(key, (grid, []))[1].append(i)
+        resampled = np.empty((len(spectra), len(self.wavelengths)))
+        for grid, rows in groups.values():
+            resampled[rows] = self.resample([spectra[i] for i in rows], grid)
+        return resampled
+
+    def resample_pico(self, spectra, metadata):
+        """Resamples PICO spectra using the wavelength calibration in each
+        spectrum's metadata (see specchioDBinterface.get_all_pico_spectra
+        and get_all_pico_metadata)"""
+        return self.resample_many(spectra, [
+            wavelengths_from_coefficients(
+                spectrum_metadata['WavelengthCalibrationCoefficients'],
+                len(spectrum))
+            for spectrum, spectrum_metadata in zip(spectra, metadata)])
+
+    def harmonise_stacks(self, stacks):
+        """Resamples SpectraStacks (e.g. from spectra_parser.stack_spectra,
+        one per instrument grid) into one SpectraStack on the target grid"""
+        harmonised = SpectraStack(self.wavelengths)
+        parts = []
+        for stack in stacks:
+            if len(stack):
+                parts.append(self.resample(stack.spectra, stack.wavelengths))
+            harmonised.metadata.extend(stack.metadata)
+            harmonised.sources.extend(stack.sources)
+        if parts:
+            harmonised.spectra = np.concatenate(parts)
+        return harmonised
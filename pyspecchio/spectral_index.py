@@ -0,0 +1,303 @@
+# -*- coding: utf-8 -*-
+"""
+Nearest-neighbour index of spectra, for "find the k most similar spectra".
+
+Used to match unlabelled PICO captures to plots, and to spot anomalies
+(spectra whose nearest neighbours are all far away). Each spectrum is:
+
+    1. resampled onto the index's wavelength grid by linear interpolation
+       (a spectra_resample.Resampler, which caches a matrix per instrument
+       grid); spectra that do not cover the whole grid are left out,
+    2. normalised to unit length, so that brightness (e.g. integration time
+       or upwelling/downwelling) does not matter,
+    3. optionally reduced with PCA (an uncentred, truncated SVD, so dot
+       products - and hence cosine similarity - are preserved) and
+       normalised again. Spectra are held unreduced until fit_spectra of
+       them have been added (e.g. one uploaded file at a time); the basis
+       is then fitted to all of them, and is fixed from then on.
+
+Queries are batched: the similarities of many query spectra with every
+indexed spectrum are computed in blocks by matrix multiplication, keeping
+the k best of each. Distances are cosine distance (1 - cos) or the spectral
+angle (SAM, in radians), which rank neighbours identically.
+
+An index is persisted as a directory: the settings and PCA basis, then one
+segment file per save() holding the spectra added since the previous save,
+so incremental updates do not rewrite the index. Spectra still held for the
+PCA fit are saved apart, and rewritten on each save until it is fitted. Spectra uploaded through
+specchioDBinterface can be added to an index as they are uploaded (see
+specchioDBinterface.__init__).
+"""
+
+import glob
+import json
+import os
+
+import numpy as np
+
+try:
+    from pyspecchio import metrics
+    from pyspecchio.spectra_resample import Resampler
+except ImportError:
+    import metrics
+    from spectra_resample import Resampler
+
+# Range covered by the QEP and USB2000+ spectrometers alike
+DEFAULT_WAVELENGTHS = np.arange(400.0, 900.0 + 1e-9, 2.0)
+
+METRICS = ('cosine', 'sam')
+
+# Indexed spectra compared with the queries per matrix multiply
+QUERY_BLOCK_SIZE = 65536
+
+# Spectra the PCA basis is fitted to, unless fewer are queried
+DEFAULT_FIT_SPECTRA = 1000
+
+UNFITTED_FILE = 'unfitted.npz'
+
+
+def _normalise(vectors):
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+class SpectralIndex(object):
+    """k-nearest-neighbour index of spectra.
+
+    Args:
+        wavelengths: the grid spectra are resampled onto (nm)
+        n_components: number of PCA components, or None to index the
+            resampled spectra themselves
+        metric: 'cosine' or 'sam'
+        path: directory the index is saved to
+        fit_spectra: number of spectra to hold before fitting the PCA
+            basis (at least n_components). A query fits it to the spectra
+            held so far.
+    """
+
+    def __init__(self, wavelengths=DEFAULT_WAVELENGTHS, n_components=None,
+                 metric='cosine', path=None,
+                 fit_spectra=DEFAULT_FIT_SPECTRA):
+        if metric not in METRICS:
+            raise ValueError("Unknown metric: " + str(metric) +
+                             ". Choose from: " + ', '.join(METRICS))
+        self.wavelengths = np.asarray(wavelengths, dtype='float64')
+        self.n_components = n_components
+        self.fit_spectra = fit_spectra
+        self.metric = metric
+        self.path = path
+        self.components = None
+        self.resampler = Resampler(self.wavelengths, cache_dir=False)
+        # Saved segments and the spectra added since the last save
+        self.segments = []
+        self.unsaved = []
+        # Normalised spectra held until the PCA basis is fitted
+        self.unfitted = []
+        self._vectors = None
+        self._keys = None
+
+    def __len__(self):
+        return sum(len(keys) for _, keys in
+                   self.segments + self.unsaved + self.unfitted)
+
+    def resample(self, spectra, wavelengths):
+        """Resamples spectra onto the index grid.
+
+        Returns:
+            None if the spectra's wavelengths do not cover the index grid,
+            otherwise the resampled (spectra x index wavelengths) array
+        """
+        wavelengths = np.asarray(wavelengths, dtype='float64')
+        if wavelengths[0] > self.wavelengths[0] or \
+                wavelengths[-1] < self.wavelengths[-1]:
+            return None
+        return self.resampler.resample(spectra, wavelengths)
+
+    def fit_components(self, vectors):
+        """Fits the PCA basis (truncated SVD) to normalised vectors"""
+        if len(vectors) < self.n_components:
+            raise ValueError("Need at least " + str(self.n_components) +
+                             " spectra to fit the PCA components")
+        _, _, vt = np.linalg.svd(vectors, full_matrices=False)
+        self.components = vt[:self.n_components]
+
+    def normalised(self, spectra, wavelengths):
+        """Resampled, normalised spectra (None if not covered)"""
+        resampled = self.resample(spectra, wavelengths)
+        if resampled is None:
+            return None
+        return _normalise(resampled)
+
+    def reduce(self, vectors):
+        """Index vectors of normalised spectra, reduced with the PCA
+        basis if there is one"""
+        if self.n_components is not None:
+            vectors = _normalise(vectors.dot(self.components.T))
+        return vectors.astype('float32')
+
+    def prepare(self, spectra, wavelengths):
+        """Turns spectra into index vectors (None if not covered). With
+        PCA, the basis must have been fitted."""
+        vectors = self.normalised(spectra, wavelengths)
+        return None if vectors is None else self.reduce(vectors)
+
+    def fit_unfitted(self):
+        """Fits the PCA basis to the spectra held for it, and adds them
+        to the index"""
+        vectors = np.concatenate([v for v, _ in self.unfitted])
+        keys = np.concatenate([k for _, k in self.unfitted])
+        self.fit_components(vectors)
+        self.unsaved.append((self.reduce(vectors), keys))
+        self.unfitted = []
+        self._vectors = None
+
+    def add(self, spectra, wavelengths, keys):
+        """Adds spectra (one per row, on the given wavelength grid) under
+        the given keys, e.g. 'file.pico#0' or SPECCHIO spectrum ids.
+
+        Returns:
+            The number of spectra added (0 if they do not cover the grid)
+        """
+        with metrics.timer('similarity.add'):
+            vectors = self.normalised(spectra, wavelengths)
+            if vectors is None:
+                metrics.count('similarity.not_covered', len(keys))
+                return 0
+            keys = np.array([str(k) for k in keys], dtype=object)
+            if self.n_components is not None and self.components is None:
+                self.unfitted.append((vectors, keys))
+                if sum(len(k) for _, k in self.unfitted) >= \
+                        max(self.fit_spectra, self.n_components):
+                    self.fit_unfitted()
+            else:
+                self.unsaved.append((self.reduce(vectors), keys))
+                self._vectors = None
+        metrics.count('similarity.added', len(keys))
+        return len(keys)
+
+    def add_stack(self, stack):
+        """Adds a spectra_parser.SpectraStack, keyed 'file#number'"""
+        return self.add(stack.spectra, stack.wavelengths,
+                        ['{}#{}'.format(*source) for source in stack.sources])
+
+    def _all(self):
+        if self._vectors is None:
+            parts = self.segments + self.unsaved
+            self._vectors = np.concatenate([v for v, _ in parts]) \
+                if parts else np.empty((0, 0), dtype='float32')
+            self._keys = np.concatenate([k for _, k in parts]) \
+                if parts else np.empty(0, dtype=object)
+        return self._vectors, self._keys
+
+    def _distance(self, similarity):
+        similarity = np.clip(similarity, -1.0, 1.0)
+        if self.metric == 'sam':
+            return np.arccos(similarity)
+        return 1.0 - similarity
+
+    def query(self, spectra, wavelengths, k=5):
+        """Finds the k nearest indexed spectra of each query spectrum.
+
+        Returns:
+            (keys, distances): (queries x k) arrays, nearest first, or None
+            if the query spectra do not cover the index grid
+        """
+        if self.unfitted:
+            self.fit_unfitted()
+        if self.n_components is not None and self.components is None:
+            raise ValueError("The PCA components are fitted to the spectra"
+                             " added, and none have been")
+        queries = self.prepare(spectra, wavelengths)
+        if queries is None:
+            return None
+        data, keys = self._all()
+        k = min(k, len(data))
+        best_similarity = np.full((len(queries), k), -np.inf)
+        best_index = np.zeros((len(queries), k), dtype=int)
+        with metrics.timer('similarity.query'):
+            for start in range(0, len(data), QUERY_BLOCK_SIZE):
+                block = data[start:start + QUERY_BLOCK_SIZE]
+                similarity = np.hstack(
+                    [best_similarity, queries.dot(block.T)])
+                index = np.hstack([best_index, np.broadcast_to(
+                    np.arange(start, start + len(block)),
+                    (len(queries), len(block)))])
+                top = np.argpartition(-similarity, k - 1, axis=1)[:, :k]
+                best_similarity = np.take_along_axis(similarity, top, axis=1)
+                best_index = np.take_along_axis(index, top, axis=1)
+        order = np.argsort(-best_similarity, axis=1)
+        best_similarity = np.take_along_axis(best_similarity, order, axis=1)
+        best_index = np.take_along_axis(best_index, order, axis=1)
+        metrics.count('similarity.queries', len(queries))
+        return keys[best_index], self._distance(best_similarity)
+
+    def query_stack(self, stack, k=5):
+        """query() for the spectra of a SpectraStack"""
+        return self.query(stack.spectra, stack.wavelengths, k)
+
+    def save(self, path=None):
+        """Writes the settings, and the spectra added since the last save
+        as a new segment"""
+        path = path or self.path
+        if path is None:
+            raise ValueError("No path to save the index to")
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        settings = {'n_components': self.n_components,
+                    'metric': self.metric, 'fit_spectra': self.fit_spectra}
+        with open(os.path.join(path, 'index.json'), 'w') as f:
+            json.dump(settings, f)
+        np.save(os.path.join(path, 'wavelengths.npy'), self.wavelengths)
+        if self.components is not None:
+            np.save(os.path.join(path, 'components.npy'), self.components)
+        if path != self.path:  # saving a copy elsewhere: write everything
+            self.unsaved = self.segments + self.unsaved
+            self.segments = []
+        if self.unsaved:
+            vectors = np.concatenate([v for v, _ in self.unsaved])
+            keys = np.concatenate([k for _, k in self.unsaved])
+            segment = os.path.join(path, 'segment_{:06d}.npz'.format(
+                len(glob.glob(os.path.join(path, 'segment_*.npz')))))
+            np.savez(segment, vectors=vectors, keys=keys.astype(str))
+            self.segments.append((vectors, keys))
+        self.unsaved = []
+        unfitted_file = os.path.join(path, UNFITTED_FILE)
+        if self.unfitted:
+            np.savez(unfitted_file,
+                     vectors=np.concatenate([v for v, _ in self.unfitted]),
+                     keys=np.concatenate(
+                         [k for _, k in self.unfitted]).astype(str))
+        elif os.path.exists(unfitted_file):
+            os.remove(unfitted_file)
+        self.path = path
+
+    @classmethod
+    def load(cls, path):
+        """Loads a saved index"""
+        with open(os.path.join(path, 'index.json')) as f:
+            settings = json.load(f)
+        index = cls(np.load(os.path.join(path, 'wavelengths.npy')),
+                    settings['n_components'], settings['metric'], path,
+                    settings.get('fit_spectra', DEFAULT_FIT_SPECTRA))
+        components_file = os.path.join(path, 'components.npy')
+        if os.path.exists(components_file):
+            index.components = np.load(components_file)
+        for segment in sorted(glob.glob(os.path.join(path, 'segment_*.npz'))):
+            with np.load(segment) as data:
+                index.segments.append((data['vectors'],
+                                       data['keys'].astype(object)))
+        unfitted_file = os.path.join(path, UNFITTED_FILE)
+        if os.path.exists(unfitted_file):
+            with np.load(unfitted_file) as data:
+                index.unfitted.append((data['vectors'],
+                                       data['keys'].astype(object)))
+        return index
+
+    @classmethod
+    def open(cls, path, **kwargs):
+        """Loads the index in path if there is one, or starts a new one
+        that will be saved there"""
+        if os.path.exists(os.path.join(path, 'index.json')):
+            return cls.load(path)
+        return cls(path=path, **kwargs)
@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+"""
+Journal of upload progress, so an interrupted upload can be resumed.
+
+Each spectra file's progress through an upload is recorded, per campaign,
+in a local SQLite file:
+
+    parsed    - the file was read; the spectra numbers to upload (with
+                those already stored) and the file's number of spectra
+                are kept
+    inserted  - insertSpectralFile acknowledged it; the spectrum ids the
+                server returned are kept
+    done      - the spectra are stored on the server
+
+With clients that insert straight away (the JVM client), a file is done
+once its insert is acknowledged. The bulk SQL client buffers spectra, so
+its files stay 'inserted' until the buffer is written out (flush()).
+
+With resume=True (--resume in specchio_main.py), files that are done are
+skipped, so rerunning an interrupted upload only replays the unfinished
+files. A file is identified by its path, size and modification time; a
+file that has changed since it was uploaded is uploaded again. A file only
+some of whose spectra were uploaded (e.g. with --select) is only skipped
+when the spectra asked for are among them; otherwise the others are
+uploaded.
+
+A crash between the server acknowledging an insert and the journal
+recording it replays that one file. Use --skip-duplicates as well to leave
+out its spectra (spectra_dedup).
+"""
+
+import json
+import os
+import sqlite3
+import time
+
+try:
+    from pyspecchio import metrics
+    from pyspecchio.file_cache import get_cache_dir
+except ImportError:
+    import metrics
+    from file_cache import get_cache_dir
+
+STATUSES = ('parsed', 'inserted', 'done')
+
+DEFAULT_JOURNAL_NAME = 'uploads.sqlite'
+
+
+def file_signature(spectrafile):
+    """(absolute path, size, modification time) of a SpectraFile"""
+    path = os.path.abspath(spectrafile.spath + spectrafile.sfile)
+    stat = os.stat(path)
+    return path, stat.st_size, stat.st_mtime
+
+
+class UploadJournal(object):
+    """Records the upload progress of each file.
+
+    Args:
+        filename: the SQLite file, by default in PYSPECCHIO_CACHE_DIR,
+            or ':memory:' for a journal lasting only this run.
+        resume: skip the files that the journal says are done
+    """
+
+    def __init__(self, filename=None, resume=False):
+        if filename is None:
+            filename = os.path.join(get_cache_dir('journal'),
+                                    DEFAULT_JOURNAL_NAME)
+        self.resume = resume
+        self.connection = sqlite3.connect(filename)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS upload_journal ("
+            " campaign TEXT, path TEXT, size INTEGER, mtime REAL,"
+            " status TEXT, spectra TEXT, spectrum_ids TEXT, updated REAL,"
+            " total INTEGER, PRIMARY KEY (campaign, path))")
+        columns = [row[1] for row in self.connection.execute(
+            "PRAGMA table_info(upload_journal)")]
+        if 'total' not in columns:
+            # Journals written before the number of spectra was kept
+            self.connection.execute(
+                "ALTER TABLE upload_journal ADD COLUMN total INTEGER")
+        self.connection.commit()
+
+    def record(self, campaign, spectrafile, status, spectra_numbers=None,
+               spectrum_ids=None, total=None):
+        """Records that a file has reached status (one of STATUSES). The
+        spectra numbers and ids, and the file's number of spectra (total),
+        are kept from earlier records if None."""
+        if status not in STATUSES:
+            raise ValueError("Unknown upload status: " + str(status))
+        path, size, mtime = file_signature(spectrafile)
+        self.connection.execute(
+            "INSERT INTO upload_journal (campaign, path, size, mtime,"
+            " status, spectra, spectrum_ids, updated, total)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)"
+            " ON CONFLICT (campaign, path) DO UPDATE SET"
+            " size = excluded.size, mtime = excluded.mtime,"
+            " status = excluded.status,"
+            " spectra = COALESCE(excluded.spectra, spectra),"
+            " spectrum_ids = COALESCE(excluded.spectrum_ids, spectrum_ids),"
+            " updated = excluded.updated,"
+            " total = COALESCE(excluded.total, total)",
+            (campaign, path, size, mtime, status,
+             None if spectra_numbers is None
+             else json.dumps([int(i) for i in spectra_numbers]),
+             None if spectrum_ids is None
+             else json.dumps([int(i) for i in spectrum_ids]),
+             time.time(), total))
+        self.connection.commit()
+
+    def commit_inserted(self, campaign):
+        """Marks the files whose inserts have been written out as done"""
+        self.connection.execute(
+            "UPDATE upload_journal SET status = 'done', updated = ?"
+            " WHERE campaign = ? AND status = 'inserted'",
+            (time.time(), campaign))
+        self.connection.commit()
+
+    def entry(self, campaign, spectrafile):
+        """The journal entry of a file as a dict, or None if it has none
+        or has changed since"""
+        path, size, mtime = file_signature(spectrafile)
+        row = self.connection.execute(
+            "SELECT status, spectra, spectrum_ids, total FROM upload_journal"
+            " WHERE campaign = ? AND path = ? AND size = ? AND mtime = ?",
+            (campaign, path, size, mtime)).fetchone()
+        if row is None:
+            return None
+        return {'status': row[0],
+                'spectra': json.loads(row[1]) if row[1] else None,
+                'spectrum_ids': json.loads(row[2]) if row[2] else None,
+                'total': row[3]}
+
+    def stored_spectra(self, campaign, spectrafile):
+        """The numbers of the file's spectra that are stored on the server
+        (none if it has changed since)"""
+        entry = self.entry(campaign, spectrafile)
+        if entry is None or entry['status'] != 'done':
+            return []
+        return entry['spectra'] or []
+
+    def is_done(self, campaign, spectrafile, spectra_numbers=None):
+        """Whether the spectra numbers of the file (all of its spectra if
+        None) are stored on the server"""
+        entry = self.entry(campaign, spectrafile)
+        if entry is None or entry['status'] != 'done':
+            return False
+        if spectra_numbers is None:
+            if entry['total'] is None:
+                # Recorded before partial uploads were told apart
+                return True
+            spectra_numbers = range(entry['total'])
+        return set(spectra_numbers) <= set(entry['spectra'] or [])
+
+    def unfinished(self, campaign, spectrafiles, selection=None):
+        """The spectra files that are not done, when resuming (all of them
+        otherwise). With a selection (file path -> spectra numbers), a file
+        is done once its selected spectra are."""
+        if not self.resume:
+            return list(spectrafiles)
+        pending = [spectrafile for spectrafile in spectrafiles
+                   if not self.is_done(
+                       campaign, spectrafile, None if selection is None
+                       else selection[spectrafile.spath + spectrafile.sfile])]
+        metrics.count('journal.files_skipped',
+                      len(spectrafiles) - len(pending))
+        return pending
+
+    def summary(self, campaign):
+        """Number of files in each status for a campaign"""
+        return dict(self.connection.execute(
+            "SELECT status, COUNT(*) FROM upload_journal"
+            " WHERE campaign = ? GROUP BY status", (campaign,)))
+
+    def close(self):
+        self.connection.close()
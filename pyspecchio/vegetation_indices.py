@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+"""
+Vectorised vegetation index engine.
+
+Indices are declared as band windows (nm) and a function of those bands,
+in INDEX_DEFINITIONS. For each instrument wavelength grid, the windows are
+turned once into an averaging matrix (windows x pixels), so the mean of
+every window for a whole campaign's spectra is one matrix multiply, and
+each index formula is then evaluated on whole arrays.
+
+PICO files hold upwelling and downwelling spectra from each spectrometer;
+pico_reflectance() pairs them up into reflectance (up / down) spectra, which
+the indices are usually computed from. The indices can also be attached to
+the spectra as metadata when they are uploaded (see
+specchioDBinterface.specchio_upload_pico_spectra).
+"""
+
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+try:
+    from pyspecchio import metrics
+    from pyspecchio.file_cache import grid_hash
+    from pyspecchio.spectra_parser import stack_spectra, stack_file_spectra
+except ImportError:
+    import metrics
+    from file_cache import grid_hash
+    from spectra_parser import stack_spectra, stack_file_spectra
+
+# Name -> (band windows as {band: (low nm, high nm)}, function of the band
+# means, taking each band as a keyword argument)
+INDEX_DEFINITIONS = OrderedDict([
+    ('NDVI', ({'nir': (795, 805), 'red': (665, 675)},
+              lambda nir, red: (nir - red) / (nir + red))),
+    ('GNDVI', ({'nir': (795, 805), 'green': (545, 555)},
+               lambda nir, green: (nir - green) / (nir + green))),
+    ('SR', ({'nir': (795, 805), 'red': (665, 675)},
+            lambda nir, red: nir / red)),
+    ('NDRE', ({'nir': (785, 795), 'rededge': (715, 725)},
+              lambda nir, rededge: (nir - rededge) / (nir + rededge))),
+    ('PRI', ({'r531': (530, 532), 'r570': (569, 571)},
+             lambda r531, r570: (r531 - r570) / (r531 + r570))),
+    ('MTCI', ({'r754': (752, 756), 'r709': (707, 711), 'r681': (679, 683)},
+              lambda r754, r709, r681: (r754 - r709) / (r709 - r681))),
+    ('REIP', ({'r670': (668, 672), 'r700': (698, 702), 'r740': (738, 742),
+               'r780': (778, 782)},
+              lambda r670, r700, r740, r780:
+              700 + 40 * ((r670 + r780) / 2 - r700) / (r740 - r700)))])
+
+
+def pico_reflectance(stack):
+    """Pairs the upwelling and downwelling spectra of each spectrometer in
+    each file of a SpectraStack and returns their ratio.
+
+    Returns:
+        (reflectance, pairs): a 2D array with one reflectance spectrum per
+        row, and for each row (file path, upwelling spectra number,
+        downwelling spectra number)
+    """
+    rows = OrderedDict()
+    for row, (metadata, source) in enumerate(zip(stack.metadata,
+                                                 stack.sources)):
+        key = (source[0], metadata.get('SerialNumber'))
+        rows.setdefault(key, {})[metadata.get('Direction')] = row
+    pairs = []
+    up_rows = []
+    down_rows = []
+    for (filename, _), directions in rows.items():
+        if 'Upwelling' in directions and 'Downwelling' in directions:
+            up, down = directions['Upwelling'], directions['Downwelling']
+            up_rows.append(up)
+            down_rows.append(down)
+            pairs.append((filename, stack.sources[up][1],
+                          stack.sources[down][1]))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        reflectance = stack.spectra[up_rows] / stack.spectra[down_rows]
+    reflectance[~np.isfinite(reflectance)] = np.nan
+    return reflectance, pairs
+
+
+class IndexEngine(object):
+    """Evaluates a set of index definitions over arrays of spectra.
+
+    Args:
+        definitions: dict like INDEX_DEFINITIONS (the default)
+    """
+
+    def __init__(self, definitions=None):
+        if definitions is None:
+            definitions = INDEX_DEFINITIONS
+        self.definitions = OrderedDict(definitions)
+        # Every distinct window, shared between indices
+        self.windows = sorted(set(
+            window for bands, _ in self.definitions.values()
+            for window in bands.values()))
+        self.mask_cache = {}
+
+    def window_matrix(self, wavelengths):
+        """Returns the (windows x pixels) averaging matrix for a grid.
+
+        A window narrower than the pixel spacing uses the nearest pixel;
+        a window outside the grid has a row of NaN.
+        """
+        wavelengths = np.asarray(wavelengths, dtype='float64')
+        key = grid_hash(wavelengths)
+        if key in self.mask_cache:
+            return self.mask_cache[key]
+        matrix = np.zeros((len(self.windows), len(wavelengths)))
+        for i, (low, high) in enumerate(self.windows):
+            mask = (wavelengths >= low) & (wavelengths <= high)
+            if not mask.any():
+                if high < wavelengths.min() or low > wavelengths.max():
+                    matrix[i] = np.nan
+                    continue
+                centre = (low + high) / 2.0
+                mask[np.argmin(np.abs(wavelengths - centre))] = True
+            matrix[i, mask] = 1.0 / mask.sum()
+        self.mask_cache[key] = matrix
+        return matrix
+
+    def evaluate(self, spectra, wavelengths):
+        """Computes every index for a 2D array of spectra (one per row).
+
+        Returns:
+            An OrderedDict of index name -> 1D array of values
+        """
+        spectra = np.atleast_2d(np.asarray(spectra, dtype='float64'))
+        with metrics.timer('indices.evaluate'):
+            window_means = spectra.dot(self.window_matrix(wavelengths).T)
+            columns = dict((window, window_means[:, i])
+                           for i, window in enumerate(self.windows))
+            results = OrderedDict()
+            with np.errstate(divide='ignore', invalid='ignore'):
+                for name, (bands, formula) in self.definitions.items():
+                    results[name] = formula(**dict(
+                        (band, columns[window])
+                        for band, window in bands.items()))
+        metrics.count('indices.spectra', len(spectra))
+        return results
+
+    def evaluate_reflectance(self, stacks):
+        """Computes the indices from the up/down reflectance of each
+        spectrometer in a list of SpectraStacks.
+
+        Returns:
+            A DataFrame with a column per index, indexed by (file,
+            upwelling spectra number, downwelling spectra number)
+        """
+        frames = []
+        for stack in stacks:
+            reflectance, pairs = pico_reflectance(stack)
+            if not pairs:
+                continue
+            values = self.evaluate(reflectance, stack.wavelengths)
+            frames.append(pd.DataFrame(values, index=pd.MultiIndex.from_tuples(
+                pairs, names=['file', 'upwelling', 'downwelling'])))
+        if not frames:
+            return pd.DataFrame(columns=list(self.definitions))
+        return pd.concat(frames)
+
+    def indices_for_file(self, spectrafile, spectra=None, metadata=None):
+        """Indices for each spectrum of one PICO file, for upload.
+
+        Both the upwelling and downwelling spectra of a pair get the
+        indices computed from their reflectance. The pixels and metadata
+        of the file's spectra can be given if they have already been read
+        (e.g. by the uploader), so the file is not read again.
+
+        Returns:
+            A dict of spectra number -> {index name: value}
+        """
+        if spectra is None:
+            stacks = stack_spectra([spectrafile])
+        else:
+            stacks = stack_file_spectra(spectrafile, spectra, metadata)
+        table = self.evaluate_reflectance(stacks)
+        per_spectrum = {}
+        for (_, up, down), row in table.iterrows():
+            values = dict((name, float(value)) for name, value in row.items()
+                          if np.isfinite(value))
+            per_spectrum[up] = values
+            per_spectrum[down] = values
+        return per_spectrum
@@ -0,0 +1,28 @@
+#!/bin/bash
+# Runs the performance benchmarks in benchmarks/ (needs pytest-benchmark).
+#
+# Results are kept in benchmarks/.results, which is not committed, as the
+# timings depend on the machine. Each run is compared against
+# the most recently saved baseline, and fails if any benchmark's mean time
+# has regressed by more than BENCHMARK_THRESHOLD (default 20%).
+#
+#   ./run_benchmarks.sh           compare with the saved baseline
+#   ./run_benchmarks.sh --save    compare, then save this run as the baseline
+THRESHOLD=${BENCHMARK_THRESHOLD:-20%}
+STORAGE=benchmarks/.results
+
+EXTRA_ARGS=""
+if [ -n "$(find $STORAGE -name '*.json' 2>/dev/null)" ]; then
+    EXTRA_ARGS="--benchmark-compare --benchmark-compare-fail=mean:$THRESHOLD"
+else
+    echo "No saved baseline in $STORAGE, run with --save to create one."
+fi
+if [ "$1" == "--save" ]; then
+    EXTRA_ARGS="$EXTRA_ARGS --benchmark-save=baseline"
+fi
+
+python3 -m pytest benchmarks -p no:cacheprovider \
+    --benchmark-only \
+    --benchmark-storage=$STORAGE \
+    --benchmark-sort=name \
+    $EXTRA_ARGS
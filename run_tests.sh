@@ -1,4 +1,4 @@
 #!/bin/bash
 # Run these from the command line, or add them 
 # to your CI testing framework
-python3 -m unittest test.test_parsers
+python3 -m unittest discover -s test -t .
@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for metadata-only updates of changed ancillary data
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import pandas as pd
+
+try:
+    import openpyxl
+except ImportError:
+    openpyxl = None
+
+# Must be set before the db interface is imported
+os.environ['SPECCHIO_CLIENT_BACKEND'] = 'fake'
+
+import pyspecchio.ancildata_parser as ancilparser
+import pyspecchio.metrics as metrics
+import pyspecchio.specchio_db_interface as specchio
+import pyspecchio.specchio_fake_client as fakeclient
+from pyspecchio.ancil_snapshot import AncilSnapshot, dataframe_cells
+
+
+class testAncilSnapshot(unittest.TestCase):
+
+    COLUMNS = ('Fertiliser_level', 'Height1', 'Height2')
+
+    def setUp(self):
+        self.snapshot = AncilSnapshot(':memory:')
+        self.df = pd.DataFrame({
+            'Plot': ['Lee1', 'Lee2'],
+            'Fertiliser_level': pd.Categorical([2, 3]),
+            'Height1': [0.33, 0.3],
+            'Height2': [0.41, np.nan],
+            'Notes': ['a', 'b']})
+        self.snapshot.record_dataframe('C', 'ES_F1_20170420_Height', self.df,
+                                       self.COLUMNS)
+
+    def diff(self, df):
+        return self.snapshot.diff_dataframe('C', 'ES_F1_20170420_Height', df,
+                                            self.COLUMNS)
+
+    def test_unchanged_data_has_no_changes(self):
+        self.assertEqual(len(self.diff(self.df.copy())), 0)
+        # e.g. the column is read as floats once a new row has no level
+        df = self.df.copy()
+        df['Fertiliser_level'] = pd.Categorical([2.0, 3.0])
+        self.assertEqual(len(self.diff(df)), 0)
+        # Another campaign has recorded nothing
+        changes = self.snapshot.diff_dataframe(
+            'Other', 'ES_F1_20170420_Height', self.df, self.COLUMNS)
+        self.assertEqual(sorted(set(changes['change'])), ['added'])
+
+    def test_cell_changes(self):
+        df = self.df.copy()
+        df.loc[1, 'Height1'] = 0.35
+        df.loc[0, 'Height2'] = np.nan
+        df.loc[1, 'Height2'] = 0.4
+        df.loc[0, 'Notes'] = 'not uploaded, so not compared'
+        changes = self.diff(df)
+        self.assertEqual(
+            [tuple(change) for change in changes[
+                ['plot', 'column', 'old', 'new', 'change']].itertuples(
+                    index=False)],
+            [('Lee1', 'Height2', 0.41, None, 'removed'),
+             ('Lee2', 'Height1', 0.3, 0.35, 'changed'),
+             ('Lee2', 'Height2', None, 0.4, 'added')])
+
+        self.snapshot.record_changes('C', changes)
+        self.assertEqual(len(self.diff(df)), 0)
+
+    def test_float32_cells_keep_their_digits(self):
+        df = self.df.copy()
+        df['Height1'] = df['Height1'].astype(np.float32)
+        cells = dataframe_cells(df, self.COLUMNS)
+        self.assertEqual(
+            list(cells[cells['column'] == 'Height1']['value']),
+            ['0.33', '0.3'])
+        self.assertEqual(len(self.diff(df)), 0)
+
+    def test_new_and_removed_rows(self):
+        df = pd.concat([self.df.iloc[1:], pd.DataFrame({
+            'Plot': ['Lee3'], 'Fertiliser_level': [1], 'Height1': [0.2],
+            'Height2': [0.25]})], ignore_index=True)
+        changes = self.diff(df)
+        self.assertEqual(set(changes[changes['plot'] == 'Lee3']['change']),
+                         {'added'})
+        self.assertEqual(set(changes[changes['plot'] == 'Lee1']['change']),
+                         {'removed'})
+        self.assertNotIn('Lee2', set(changes['plot']))
+
+
+@unittest.skipIf(openpyxl is None, "openpyxl is not installed")
+class testUpdateAncilMetadata(unittest.TestCase):
+
+    HEIGHT_DIR = os.path.join('ES', 'field_scale', 'ES_F1_2017',
+                              'plot_scale_data', 'Height')
+    HEIGHT_FILE = '20170420_Height.xlsx'
+    # Other categories measured on the same date, so with the same dummy
+    # spectrum names
+    OTHER_FILES = (os.path.join('GS', '20170420_GS.xlsx'),
+                   os.path.join('SPAD', '20170420_SPAD.xlsx'))
+
+    def setUp(self):
+        metrics.reset()
+        self.cwd = os.getcwd()
+        self.tmpdir = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.tmpdir, self.HEIGHT_DIR))
+        self.workbook = os.path.join(self.tmpdir, self.HEIGHT_DIR,
+                                     self.HEIGHT_FILE)
+        # The plot height formulas as values, as openpyxl does not keep
+        # their results
+        self.edit_workbook(lambda sheet: [
+            sheet.cell(row, 8, np.mean([sheet.cell(row, column).value
+                                        for column in range(3, 8)]))
+            for row in range(3, sheet.max_row + 1)])
+        for other_file in self.OTHER_FILES:
+            target = os.path.join(self.tmpdir,
+                                  os.path.dirname(self.HEIGHT_DIR),
+                                  other_file)
+            os.makedirs(os.path.dirname(target))
+            shutil.copy(os.path.join('test', 'DATA',
+                                     os.path.dirname(self.HEIGHT_DIR),
+                                     other_file), target)
+        self.ancildir = os.path.join(self.tmpdir, '')
+        # The upload writes its dummy .pico files in the working directory
+        os.chdir(self.tmpdir)
+
+        self.client = fakeclient.FakeSPECCHIOClient(latency=0)
+        self.db = specchio.specchioDBinterface(
+            "Delta", client=self.client,
+            ancil_snapshot=AncilSnapshot(':memory:'))
+        ancilparser.dataframes.clear()
+        self.db.specchio_upload_ancil_with_dummy_spectra(self.ancildir)
+        self.ids = self.spectrum_ids('ES_F1_20170420_Height')
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmpdir)
+
+    def edit_workbook(self, edit):
+        source = self.workbook if os.path.exists(self.workbook) else \
+            os.path.join('test', 'DATA', self.HEIGHT_DIR, self.HEIGHT_FILE)
+        workbook = openpyxl.load_workbook(source)
+        edit(workbook.active)
+        workbook.save(self.workbook)
+
+    def spectrum_ids(self, df_key):
+        return dict((plot, self.db.ancil_snapshot.spectrum_ids(
+            'Delta', df_key, plot)) for plot in ('Lee1', 'Lee2'))
+
+    def metadata_value(self, plot, attribute_name, ids=None):
+        ids = self.ids if ids is None else ids
+        mp = self.client.spectra[ids[plot][0]][2].get_entry(attribute_name)
+        return None if mp is None else mp.getValue()
+
+    def test_upload_inserts_dummy_spectra(self):
+        inserted = self.client.call_counts['insertSpectralFile']
+        self.assertGreater(inserted, 0)
+        self.assertEqual([len(ids) for ids in self.ids.values()], [1, 1])
+        self.assertEqual(self.metadata_value('Lee1', 'Height1'), 0.33)
+        # Everything uploaded was recorded, so nothing has changed
+        summary = self.db.update_ancil_metadata(self.ancildir)
+        self.assertEqual(summary['eav_updates'], 0)
+        self.assertEqual(summary['rows_without_spectra'], 0)
+
+    def test_only_changed_cells_are_sent(self):
+        inserted = self.client.call_counts['insertSpectralFile']
+
+        def correct(sheet):
+            sheet.cell(4, 3, 0.35)   # Lee2 Height1
+            sheet.cell(3, 7).value = None   # Lee1 Height5
+            new_row = sheet.max_row + 1   # a plot never uploaded
+            sheet.cell(new_row, 1, 'New1')
+            sheet.cell(new_row, 3, 0.5)
+        self.edit_workbook(correct)
+
+        summary = self.db.update_ancil_metadata(self.ancildir)
+        self.assertEqual(summary, {
+            'changed': 1, 'added': 0, 'removed': 1, 'rows_updated': 2,
+            'rows_without_spectra': 1, 'eav_updates': 2})
+        # As read from the float32 column, not widened
+        self.assertEqual(self.metadata_value('Lee2', 'Height1'), 0.35)
+        self.assertIsNone(self.metadata_value('Lee1', 'Height5'))
+        self.assertEqual(self.metadata_value('Lee1', 'Height1'), 0.33)
+        self.assertEqual(self.client.call_counts['updateEavMetadata'], 1)
+        self.assertEqual(self.client.call_counts['removeEavMetadata'], 1)
+        self.assertEqual(self.client.call_counts['insertSpectralFile'],
+                         inserted)
+
+        # Only the row that could not be updated is found again
+        summary = self.db.update_ancil_metadata(self.ancildir)
+        self.assertEqual(summary['rows_without_spectra'], 1)
+        self.assertEqual(summary['eav_updates'], 0)
+
+    def test_whole_values_are_sent_as_doubles(self):
+        self.edit_workbook(lambda sheet: sheet.cell(3, 3, 12))
+        self.db.update_ancil_metadata(self.ancildir)
+        value = self.metadata_value('Lee1', 'Height1')
+        self.assertEqual(value, 12.0)
+        self.assertIsInstance(value, float)
+
+    def test_categories_on_the_same_date_are_kept_apart(self):
+        other_ids = [self.spectrum_ids('ES_F1_20170420_' + category)
+                     for category in ('GS', 'SPAD')]
+        # All three share the dummy spectrum name of each plot and date
+        self.assertEqual(
+            len(self.db.ancil_spectrum_ids(self.db.ancil_dummy_name(
+                'ES_F1_20170420_Height', 'Lee1'))), 3)
+        for ids in other_ids:
+            self.assertEqual(len(ids['Lee1']), 1)
+            self.assertNotEqual(ids['Lee1'], self.ids['Lee1'])
+
+        self.edit_workbook(lambda sheet: sheet.cell(3, 3, 0.34))
+        summary = self.db.update_ancil_metadata(self.ancildir)
+        self.assertEqual(summary['changed'], 1)
+        self.assertEqual(summary['eav_updates'], 1)
+        self.assertAlmostEqual(self.metadata_value('Lee1', 'Height1'), 0.34)
+        for ids in other_ids:
+            self.assertIsNone(self.metadata_value('Lee1', 'Height1', ids))
+
+    def test_needs_snapshot(self):
+        db = specchio.specchioDBinterface("Delta", client=self.client)
+        self.assertRaises(ValueError, db.update_ancil_metadata,
+                          self.ancildir)
+
+
+if __name__ == '__main__':
+    unittest.main()
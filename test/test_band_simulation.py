@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the satellite band simulation and the spectra stacking it uses
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+import pyspecchio.band_simulation as bandsim
+from pyspecchio.spectra_parser import SpectraFile, stack_spectra
+
+
+class testStackSpectra(unittest.TestCase):
+
+    PICO_DIR = os.path.join(os.path.abspath("test/PICO_testdata/"), '')
+
+    def test_stacks_by_wavelength_grid(self):
+        stacks = stack_spectra([
+            SpectraFile("QEP1USB1_b000000_s000002_light.pico", self.PICO_DIR),
+            SpectraFile("QEPs2_b000000_s000002_light.pico", self.PICO_DIR)])
+        self.assertEqual(sum(len(stack) for stack in stacks), 8)
+        for stack in stacks:
+            self.assertEqual(stack.spectra.shape,
+                             (len(stack), len(stack.wavelengths)))
+        # 1044 and 2048 pixel detectors are never stacked together
+        self.assertEqual(
+            sorted(set(len(stack.wavelengths) for stack in stacks)),
+            [1044, 2048])
+
+    def test_wavelengths_from_calibration(self):
+        sf = SpectraFile("QEPs2_b000000_s000002_light.pico", self.PICO_DIR)
+        wavelengths = sf.get_spectra_wavelengths(0)
+        self.assertEqual(len(wavelengths), 1044)
+        self.assertAlmostEqual(wavelengths[0], 397.8655700683594)
+        self.assertTrue(np.all(np.diff(wavelengths) > 0))
+
+
+class testBandSimulator(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.simulator = bandsim.BandSimulator(cache_dir=self.cache_dir)
+        self.wavelengths = np.linspace(400.0, 1000.0, 1044)
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def test_flat_spectrum_gives_flat_bands(self):
+        spectra = np.full((3, 1044), 5.0)
+        bands = self.simulator.simulate(spectra, self.wavelengths,
+                                        'Sentinel-2A')
+        names = bandsim.SENSORS['Sentinel-2A'].band_names
+        b4 = names.index('B4')
+        b11 = names.index('B11')
+        self.assertAlmostEqual(bands[0, b4], 5.0)
+        # SWIR bands are outside the instrument's range
+        self.assertTrue(np.isnan(bands[0, b11]))
+
+    def test_matches_per_spectrum_weighting(self):
+        spectra = np.random.RandomState(1).rand(10, 1044)
+        bands = self.simulator.simulate(spectra, self.wavelengths,
+                                        'Landsat-8')
+        weights, valid = bandsim.compute_weights(
+            self.wavelengths, bandsim.SENSORS['Landsat-8'])
+        expected = np.array([weights.dot(spectrum) for spectrum in spectra])
+        np.testing.assert_allclose(bands[:, valid], expected[:, valid])
+
+    def test_weights_cached_on_disk(self):
+        self.simulator.get_weights(self.wavelengths, 'Sentinel-2A')
+        self.assertEqual(len(os.listdir(self.cache_dir)), 1)
+        other = bandsim.BandSimulator(cache_dir=self.cache_dir)
+        weights, _ = other.get_weights(self.wavelengths, 'Sentinel-2A')
+        self.assertEqual(weights.shape, (13, 1044))
+
+    def test_unknown_sensor(self):
+        with self.assertRaises(ValueError):
+            self.simulator.simulate(np.ones(1044), self.wavelengths, 'MODIS')
+
+
+if __name__ == '__main__':
+    unittest.main()
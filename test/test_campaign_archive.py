@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the HDF5/Zarr campaign archive export
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import pandas as pd
+
+import pyspecchio.campaign_archive as archive
+from pyspecchio.spectra_parser import SpectraFile
+
+
+class ArchiveTests(object):
+    """Run for each archive format by the subclasses below"""
+
+    PICO_DIR = os.path.join(os.path.abspath("test/PICO_testdata/"), '')
+    EXTENSION = None
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.store = os.path.join(self.tmpdir, 'campaign' + self.EXTENSION)
+        self.files = [
+            SpectraFile("QEP1USB1_b000000_s000002_light.pico",
+                        self.PICO_DIR),
+            SpectraFile("QEPs2_b000000_s000002_light.pico", self.PICO_DIR)]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_round_trip_by_day(self):
+        ancil = {'ES_F1_20171219_GS': pd.DataFrame(
+            {'Plot': ['Lee1', 'Lee2'], 'Fv/Fm': [0.8, np.nan]})}
+        self.assertEqual(archive.export_campaign(
+            self.store, self.files[:1], ancil, chunk_rows=2), 4)
+        self.assertEqual(archive.export_campaign(
+            self.store, self.files[1:], chunk_rows=2), 4)
+        self.assertEqual(archive.list_days(self.store),
+                         ['20171219', '20180107'])
+
+        grids = archive.read_spectra(self.store, '20171219')
+        self.assertEqual(sorted(len(w) for w, _, _ in grids), [1044, 2048])
+        original = self.files[0].read_json()['Spectra']
+        for wavelengths, spectra, metadata in grids:
+            for row, number in enumerate(metadata['spectra_number']):
+                np.testing.assert_array_equal(
+                    spectra[row], original[number]['Pixels'])
+                self.assertEqual(metadata['IntegrationTime'][row],
+                                 original[number]['Metadata']
+                                 ['IntegrationTime'])
+
+        tables = archive.read_ancillary(self.store, '20171219')
+        self.assertEqual(list(tables['ES_F1_20171219_GS'].columns),
+                         ['Plot', 'Fv/Fm'])
+        self.assertEqual(list(tables['ES_F1_20171219_GS']['Plot']),
+                         ['Lee1', 'Lee2'])
+
+    def test_reexport_skips_archived_spectra(self):
+        archive.export_campaign(self.store, self.files)
+        self.assertEqual(archive.export_campaign(self.store, self.files), 0)
+        grids = archive.read_spectra(self.store, '20180107')
+        self.assertEqual(sum(len(spectra) for _, spectra, _ in grids), 4)
+
+    def test_same_named_files_in_other_folders(self):
+        # PICO file names repeat in every batch folder
+        root = os.path.join(self.tmpdir, 'pico')
+        for folder in ('b1', 'b2'):
+            os.makedirs(os.path.join(root, folder))
+            shutil.copy(self.files[0].spath + self.files[0].sfile,
+                        os.path.join(root, folder))
+        files = [SpectraFile(self.files[0].sfile,
+                             os.path.join(root, folder, ''))
+                 for folder in ('b1', 'b2')]
+        self.assertEqual(archive.export_campaign(self.store, files[:1],
+                                                 root=root), 4)
+        self.assertEqual(archive.export_campaign(self.store, files,
+                                                 root=root), 4)
+        paths = set(path for _, _, metadata in archive.read_spectra(
+            self.store, '20171219') for path in metadata['file'])
+        self.assertEqual(paths, {'b1/' + files[0].sfile,
+                                 'b2/' + files[0].sfile})
+
+
+@unittest.skipIf(archive.h5py is None, "h5py is not installed")
+class testHDF5Archive(ArchiveTests, unittest.TestCase):
+    EXTENSION = '.h5'
+
+
+@unittest.skipIf(archive.zarr is None, "zarr is not installed")
+class testZarrArchive(ArchiveTests, unittest.TestCase):
+    EXTENSION = '.zarr'
+
+    def test_parallel_export(self):
+        self.assertEqual(archive.export_campaign(
+            self.store, self.files, workers=2), 8)
+        self.assertEqual(archive.list_days(self.store),
+                         ['20171219', '20180107'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for running campaign data loaders with progress callbacks
+"""
+
+import asyncio
+import os
+import threading
+import unittest
+
+# Must be set before the db interface is imported
+os.environ['SPECCHIO_CLIENT_BACKEND'] = 'fake'
+
+import pyspecchio.campaign_loader as campaign_loader
+import pyspecchio.metrics as metrics
+import pyspecchio.specchio_fake_client as fakeclient
+
+
+class testCampaignLoader(unittest.TestCase):
+
+    def setUp(self):
+        metrics.reset()
+        self.clients = []
+        for name in ('Campaign A', 'Campaign B'):
+            client = fakeclient.FakeSPECCHIOClient(latency=0.01)
+            campaign = fakeclient.SpecchioCampaign()
+            campaign.setName(name)
+            client.insertCampaign(campaign)
+            self.clients.append(client)
+        self.reports = []
+        self.lock = threading.Lock()
+
+    def progress(self, campaign_name, parsed, inserted):
+        with self.lock:
+            self.reports.append((campaign_name, parsed, inserted))
+
+    def test_load_campaigns_concurrently(self):
+        results = campaign_loader.load_campaigns(
+            [1, 1], progress=self.progress, clients=self.clients,
+            poll_seconds=0.01)
+        self.assertEqual([result['campaign'] for result in results],
+                         ['Campaign A', 'Campaign B'])
+        for result, client in zip(results, self.clients):
+            self.assertEqual(result['parsed'], 5)
+            self.assertEqual(result['inserted'], 5)
+            self.assertEqual(client.call_counts['loadCampaignFile'], 5)
+        # Progress is only reported when it changes, ending with the totals
+        for name in ('Campaign A', 'Campaign B'):
+            reports = [report for report in self.reports if report[0] == name]
+            self.assertEqual(reports[-1], (name, 5, 5))
+            self.assertEqual(len(reports), len(set(reports)))
+        self.assertEqual(metrics.as_dict()['counters']
+                         ['campaign_load.files_inserted'], 10)
+
+    def test_load_campaigns_async(self):
+        results = asyncio.run(campaign_loader.load_campaigns_async(
+            [1, 1], progress=self.progress, clients=self.clients,
+            poll_seconds=0.01))
+        self.assertEqual([result['inserted'] for result in results], [5, 5])
+        self.assertIn(('Campaign B', 5, 5), self.reports)
+
+    def test_a_client_is_needed_per_campaign(self):
+        self.assertRaises(ValueError, campaign_loader.load_campaigns,
+                          [1, 1, 1], clients=self.clients)
+        self.assertRaises(ValueError, asyncio.run,
+                          campaign_loader.load_campaigns_async(
+                              [1], clients=self.clients))
+        self.assertEqual(self.clients[0].call_counts['loadCampaignFile'], 0)
+
+    def test_loader_failure_is_raised(self):
+        class BrokenLoader(fakeclient.SpecchioCampaignDataLoader):
+            def getParsed_file_counter(self):
+                raise fakeclient.JavaException("server went away")
+        broken = campaign_loader.CampaignLoad(
+            BrokenLoader(self.clients[1]), 'Campaign B', poll_seconds=0.01)
+        self.assertRaises(fakeclient.JavaException, broken.start().wait, 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
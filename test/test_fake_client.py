@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the offline stand-in SPECCHIO client, and the uploader driven
+through it.
+"""
+
+import os
+import unittest
+
+# Must be set before the db interface is imported
+os.environ['SPECCHIO_CLIENT_BACKEND'] = 'fake'
+
+import pyspecchio.specchio_db_interface as specchio
+import pyspecchio.specchio_fake_client as fakeclient
+from pyspecchio.spectra_parser import SpectraFile
+
+
+class testFakeClient(unittest.TestCase):
+
+    def setUp(self):
+        self.client = fakeclient.FakeSPECCHIOClient(latency=0)
+
+    def test_campaign_ids_increment(self):
+        campaign = fakeclient.SpecchioCampaign()
+        campaign.setName("Test")
+        self.assertEqual(self.client.insertCampaign(campaign), 1)
+        self.assertEqual(self.client.insertCampaign(campaign), 2)
+        self.assertEqual(self.client.call_counts['insertCampaign'], 2)
+
+    def test_sub_hierarchy_id_is_stable(self):
+        campaign = fakeclient.SpecchioCampaign()
+        campaign.setId(1)
+        first = self.client.getSubHierarchyId(campaign, "PlotData", 0)
+        again = self.client.getSubHierarchyId(campaign, "PlotData", 0)
+        other = self.client.getSubHierarchyId(campaign, "Other", 0)
+        self.assertEqual(first, again)
+        self.assertNotEqual(first, other)
+
+    def test_null_attribute_raises(self):
+        with self.assertRaises(fakeclient.JavaException):
+            fakeclient.MetaParameter.newInstance(None)
+
+    def test_query_and_load_space(self):
+        hash_ = self.client.getAttributesNameHash()
+        sfile = fakeclient.SpectralFile()
+        for altitude in (40.0, 52.0):
+            smd = fakeclient.Metadata()
+            mp = fakeclient.MetaParameter.newInstance(hash_.get('Altitude'))
+            mp.setValue(altitude)
+            smd.addEntry(mp)
+            sfile.addEavMetadata(smd)
+            sfile.addWvls([400.0, 500.0])
+        sfile.setMeasurements([[1.0, 2.0], [3.0, 4.0]])
+        self.client.insertSpectralFile(sfile)
+
+        query = fakeclient.Query()
+        cond = fakeclient.EAVQueryConditionObject(hash_.get('Altitude'))
+        cond.setValue('50.0')
+        cond.setOperator('>=')
+        query.add_condition(cond)
+        ids = self.client.getSpectrumIdsMatchingQuery(query)
+        self.assertEqual(ids.size(), 1)
+
+        space = self.client.loadSpace(self.client.getSpaces(ids, '')[0])
+        self.assertEqual(space.getVectorsAsArray(), [[3.0, 4.0]])
+
+
+class testUploadWithFakeClient(unittest.TestCase):
+
+    PICO_DIR = os.path.join(os.path.abspath("test/PICO_testdata/"), '')
+
+    def test_upload_pico_spectra(self):
+        db_interface = specchio.specchioDBinterface("Test Campaign")
+        for pico_name in ("QEP1USB1_b000000_s000002_light.pico",
+                          "QEPs2_b000000_s000002_light.pico"):
+            db_interface.specchio_upload_pico_spectra(
+                SpectraFile(pico_name, self.PICO_DIR))
+        client = db_interface.specchio_client
+        self.assertEqual(client.call_counts['insertSpectralFile'], 2)
+        self.assertEqual(len(client.spectra), 8)
+        # The hierarchy is only looked up on the server for the first file
+        self.assertEqual(client.call_counts['getSubHierarchyId'], 1)
+
+
+class testCampaignsAndHierarchies(unittest.TestCase):
+
+    def setUp(self):
+        self.db_interface = specchio.specchioDBinterface("Test Campaign")
+        self.client = self.db_interface.specchio_client
+
+    def test_existing_campaign_is_reused(self):
+        campaign = fakeclient.SpecchioCampaign()
+        campaign.setName("Test Campaign")
+        self.assertEqual(
+            self.db_interface.get_or_create_campaign_id(campaign),
+            self.db_interface.c_id)
+        self.assertEqual(self.client.call_counts['insertCampaign'], 1)
+
+    def test_new_campaign_is_created(self):
+        campaign = fakeclient.SpecchioCampaign()
+        campaign.setName("Another Campaign")
+        self.assertNotEqual(
+            self.db_interface.get_or_create_campaign_id(campaign),
+            self.db_interface.c_id)
+        self.assertEqual(self.client.call_counts['insertCampaign'], 2)
+
+    def test_nested_hierarchy_ids_are_cached(self):
+        path = "PlotData/ES_F1/20170420"
+        hierarchy_id = self.db_interface.get_hierarchy_id(path)
+        self.assertEqual(self.db_interface.get_hierarchy_id(path),
+                         hierarchy_id)
+        self.assertEqual(self.client.call_counts['getSubHierarchyId'], 3)
+        # Sibling date reuses the cached parent levels
+        self.db_interface.get_hierarchy_id("PlotData/ES_F1/20170516")
+        self.assertEqual(self.client.call_counts['getSubHierarchyId'], 4)
+        parent_id = self.db_interface.get_hierarchy_id("PlotData/ES_F1")
+        self.assertIn(
+            (self.db_interface.c_id, "20170516", parent_id),
+            self.client.hierarchies)
+
+
+if __name__ == '__main__':
+    unittest.main()
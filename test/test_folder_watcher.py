@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the watch-folder ingestion (debouncing, batching, polling)
+"""
+
+import os
+import shutil
+import signal
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+try:
+    import openpyxl
+except ImportError:
+    openpyxl = None
+
+import pyspecchio.folder_watcher as fw
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class ListSource(object):
+    """Reports the files queued in it on the next poll"""
+
+    def __init__(self):
+        self.queued = set()
+
+    def poll(self, timeout):
+        changed, self.queued = self.queued, set()
+        return changed
+
+
+class testFolderWatcher(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.clock = FakeClock()
+        self.source = ListSource()
+        self.batches = []
+        self.watcher = fw.FolderWatcher(
+            [self.tmpdir], self.batches.append, quiet_seconds=5,
+            max_batch_files=3, max_batch_seconds=30, source=self.source,
+            clock=self.clock)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, name, text='{}'):
+        path = os.path.join(self.tmpdir, name)
+        with open(path, 'a') as f:
+            f.write(text)
+        self.source.queued.add(path)
+        return path
+
+    def test_growing_file_is_debounced(self):
+        path = self.write('a.pico')
+        self.watcher.step()
+        self.clock.now += 4
+        self.write('a.pico', 'more')
+        self.watcher.step()
+        self.clock.now += 4
+        self.watcher.step()
+        # Changed 4 s ago: not settled yet
+        self.assertEqual(self.watcher.debouncer.pending.keys(), {path})
+        self.clock.now += 2
+        self.watcher.step()
+        self.assertEqual(self.watcher.batcher.files, [path])
+
+    def test_batches_are_bounded_by_size_and_time(self):
+        paths = [self.write('s{}.pico'.format(i)) for i in range(4)]
+        self.write('~$lock.xlsx')
+        self.watcher.step()
+        self.watcher.step()
+        self.clock.now += 5
+        self.watcher.step()
+        # Four files ready, at most three per batch
+        self.assertEqual(self.batches, [paths[:3]])
+        self.clock.now += 10
+        self.watcher.step()
+        self.assertEqual(len(self.batches), 1)
+        self.clock.now += 20
+        self.watcher.step()
+        self.assertEqual(self.batches, [paths[:3], paths[3:]])
+
+    def test_finish_hands_over_settled_files(self):
+        for name in ('a.pico', 'b.pico', 'c.pico', 'd.pico'):
+            self.write(name)
+        self.watcher.step()
+        self.clock.now += 1
+        self.write('d.pico', 'still being written')
+        # Ctrl-C before the files are quiet
+        changing = self.watcher.finish()
+        self.assertEqual([len(batch) for batch in self.batches], [3])
+        self.assertEqual(changing, [os.path.join(self.tmpdir, 'd.pico')])
+        self.assertEqual(self.watcher.debouncer.pending, {})
+
+    def test_failed_batch_does_not_stop_the_watcher(self):
+        def upload(batch):
+            if any(path.endswith('bad.pico') for path in batch):
+                raise IOError("server went away")
+            self.batches.append(batch)
+        self.watcher.handle_batch = upload
+        self.watcher.batcher.max_files = 1
+        bad = self.write('bad.pico')
+        good = self.write('good.pico')
+        self.watcher.step()
+        self.clock.now += 5
+        self.watcher.step()
+        self.watcher.step()
+        self.assertEqual(self.batches, [[good]])
+        self.assertEqual(self.watcher.failed, [bad])
+
+    def test_only_data_files_are_watched(self):
+        self.assertTrue(fw.is_watched_file('/x/ES_F1_20170530_LAI.PRN'))
+        self.assertTrue(fw.is_watched_file('/x/b0_s2_light.pico'))
+        self.assertFalse(fw.is_watched_file('/x/~$Height.xlsx'))
+        self.assertFalse(fw.is_watched_file('/x/notes.txt'))
+
+
+class testPollingSource(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.tmpdir, 'site', 'day1'))
+        with open(os.path.join(self.tmpdir, 'old.pico'), 'w') as f:
+            f.write('{}')
+        self.source = fw.PollingSource([self.tmpdir], interval=0)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_reports_only_new_files(self):
+        self.assertEqual(self.source.poll(0), set())
+        new = os.path.join(self.tmpdir, 'site', 'day1', 'new.pico')
+        with open(new, 'w') as f:
+            f.write('{}')
+        newdir = os.path.join(self.tmpdir, 'site', 'day2')
+        os.makedirs(newdir)
+        newer = os.path.join(newdir, 'newer.pico')
+        with open(newer, 'w') as f:
+            f.write('{}')
+        self.assertEqual(self.source.poll(0), {new, newer})
+        self.assertEqual(self.source.poll(0), set())
+
+
+
+@unittest.skipIf(openpyxl is None, "openpyxl is not installed")
+class testWatchedAncilUpload(unittest.TestCase):
+    """specchio_main --watch on a data path, with the offline client"""
+
+    MAIN = os.path.join(os.path.dirname(os.path.dirname(
+        os.path.abspath(__file__))), 'pyspecchio', 'specchio_main.py')
+    PLOT_DIR = os.path.join('ES', 'field_scale', 'ES_F1_2017',
+                            'plot_scale_data')
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.datadir = os.path.join(self.tmpdir, 'data')
+        for category in ('Height', 'LAI', 'SPAD'):
+            os.makedirs(os.path.join(self.datadir, self.PLOT_DIR, category))
+        # Already there when the watcher starts
+        self.copy_data(os.path.join('Height', '20170420_Height.xlsx'))
+        self.snapshot = os.path.join(self.tmpdir, 'snapshot.sqlite')
+        env = dict(os.environ, SPECCHIO_CLIENT_BACKEND='fake',
+                   SPECCHIO_FAKE_LATENCY='0',
+                   PYSPECCHIO_CACHE_DIR=os.path.join(self.tmpdir, 'cache'))
+        self.process = subprocess.Popen(
+            [sys.executable, '-u', self.MAIN, '--watch', '--data-path',
+             self.datadir, '--campaign-name', 'Watched', '--ancil-snapshot',
+             self.snapshot, '--watch-quiet', '0', '--batch-seconds', '0'],
+            cwd=self.tmpdir, env=env, stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT, universal_newlines=True)
+        self.lines = []
+        reader = threading.Thread(target=lambda: self.lines.extend(
+            self.process.stdout))
+        reader.daemon = True
+        reader.start()
+
+    def tearDown(self):
+        if self.process.poll() is None:
+            self.process.kill()
+        self.process.wait()
+        shutil.rmtree(self.tmpdir)
+
+    def copy_data(self, name):
+        shutil.copy(os.path.join('test', 'DATA', self.PLOT_DIR, name),
+                    os.path.join(self.datadir, self.PLOT_DIR, name))
+
+    def wait_for(self, text, timeout=60):
+        deadline = time.time() + timeout
+        while time.time() < deadline and self.process.poll() is None:
+            if any(text in line for line in self.lines):
+                return
+            time.sleep(0.1)
+        self.fail("No '" + text + "' in the output:\n" + ''.join(self.lines))
+
+    def test_new_files_are_uploaded_under_their_names(self):
+        self.wait_for('Watching')
+        # The PRN file comes first in the batch
+        self.copy_data(os.path.join('LAI', '20170420_LAI.PRN'))
+        self.copy_data(os.path.join('SPAD', '20170420_SPAD.xlsx'))
+        self.wait_for('Uploaded')
+        self.process.send_signal(signal.SIGINT)
+        self.process.wait(60)
+
+        connection = sqlite3.connect(self.snapshot)
+        recorded = [df_key for (df_key,) in connection.execute(
+            "SELECT DISTINCT df_key FROM ancil_spectrum"
+            " WHERE campaign = 'Watched'")]
+        connection.close()
+        # Not the file already there, nor the PRN file
+        self.assertEqual(recorded, ['ES_F1_20170420_SPAD'])
+        self.assertTrue(any('20170420_LAI.PRN' in line
+                            for line in self.lines))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the JVM options and Java memory monitoring
+"""
+
+import unittest
+
+import pyspecchio.metrics as metrics
+from pyspecchio.jvm import JavaMemorySampler, jvm_options
+
+
+class testJvmOptions(unittest.TestCase):
+
+    def test_default_options(self):
+        self.assertEqual(
+            jvm_options({'SPECCHIO_JAVA_CLIENT': '/opt/specchio-client.jar'}),
+            ['-ea', '-Djava.class.path=/opt/specchio-client.jar'])
+
+    def test_heap_gc_and_extra_options(self):
+        options = jvm_options({
+            'SPECCHIO_JAVA_CLIENT': 'client.jar',
+            'SPECCHIO_JVM_MAX_HEAP': '4g',
+            'SPECCHIO_JVM_INITIAL_HEAP': '1g',
+            'SPECCHIO_JVM_GC': 'G1',
+            'SPECCHIO_JVM_OPTIONS': '-XX:MaxGCPauseMillis=200 -Dfoo="a b"'})
+        self.assertEqual(options[2:], [
+            '-Xms1g', '-Xmx4g', '-XX:+UseG1GC', '-XX:MaxGCPauseMillis=200',
+            '-Dfoo=a b'])
+
+    def test_bad_configuration(self):
+        self.assertRaises(KeyError, jvm_options, {})
+        self.assertRaises(ValueError, jvm_options, {
+            'SPECCHIO_JAVA_CLIENT': 'client.jar', 'SPECCHIO_JVM_GC': 'cms'})
+
+
+class testJavaMemorySampler(unittest.TestCase):
+
+    def setUp(self):
+        metrics.reset()
+        self.samples = [
+            {'heap_used': 100, 'heap_committed': 200, 'heap_max': 1000,
+             'gc_ms': 50, 'gc_collections': 3},
+            {'heap_used': 700, 'heap_committed': 800, 'heap_max': 1000,
+             'gc_ms': 80, 'gc_collections': 5},
+            {'heap_used': 300, 'heap_committed': 800, 'heap_max': 1000,
+             'gc_ms': 95, 'gc_collections': 6}]
+        self.taken = 0
+
+    def sample(self):
+        # The last sample is repeated once they run out
+        sample = self.samples[min(self.taken, len(self.samples) - 1)]
+        self.taken += 1
+        return sample
+
+    def test_records_peak_heap_and_gc_during_run(self):
+        # A long interval, so only the start and stop samples are taken
+        sampler = JavaMemorySampler(interval=60, sample=self.sample)
+        with sampler:
+            pass
+        summary = metrics.as_dict()
+        self.assertEqual(summary['counters']['jvm.gc_ms'], 30)
+        self.assertEqual(summary['counters']['jvm.gc_collections'], 2)
+        self.assertEqual(summary['counters']['jvm.heap_samples'], 2)
+        self.assertEqual(summary['gauges']['jvm.heap_used_peak_bytes'], 700)
+        self.assertEqual(summary['gauges']['jvm.heap_max_bytes'], 1000)
+        self.assertIn('Gauge (highest)', metrics.report())
+
+    def test_samples_in_background(self):
+        sampler = JavaMemorySampler(interval=0.01, sample=self.sample)
+        sampler.start()
+        while metrics.as_dict()['counters']['jvm.heap_samples'] < 2:
+            pass
+        sampler.stop()
+        self.assertEqual(metrics.as_dict()['counters']['jvm.gc_ms'], 45)
+        self.assertEqual(metrics.as_dict()['gauges']
+                         ['jvm.heap_used_peak_bytes'], 700)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the memory-budgeted chunked processing
+"""
+
+import os
+import unittest
+
+import pyspecchio.ancildata_parser as adp
+import pyspecchio.memory_budget as membudget
+from pyspecchio.metrics import RunMetrics, peak_rss
+
+
+class testChunking(unittest.TestCase):
+
+    def test_parse_size(self):
+        self.assertEqual(membudget.parse_size('512M'), 512 * 2**20)
+        self.assertEqual(membudget.parse_size('1.5GB'), 3 * 2**29)
+        self.assertEqual(membudget.parse_size('2gib'), 2 * 2**30)
+        self.assertEqual(membudget.parse_size('1000'), 1000)
+        with self.assertRaises(ValueError):
+            membudget.parse_size('lots')
+
+    def test_chunks_fit_the_budget(self):
+        sizes = [4, 3, 3, 12, 1, 9]
+        chunks = list(membudget.chunk_by_size(sizes, lambda x: x, 10))
+        # The oversized item gets a chunk of its own
+        self.assertEqual(chunks, [[4, 3, 3], [12], [1, 9]])
+
+
+class testAncilChunks(unittest.TestCase):
+
+    DATADIR = os.path.join(os.path.abspath("test/DATA/"), '')
+
+    def test_chunks_cover_every_file(self):
+        whole = dict(adp.extract_dataframes(self.DATADIR))
+        adp.dataframes.clear()
+        budget = max(membudget.dataframe_bytes(df)
+                     for df in whole.values()) * 2
+        chunks = list(adp.iter_dataframe_chunks(self.DATADIR, budget))
+        self.assertGreater(len(chunks), 1)
+        for chunk in chunks:
+            self.assertLessEqual(sum(membudget.dataframe_bytes(df)
+                                     for df in chunk.values()), budget)
+        names = [name for chunk in chunks for name in chunk]
+        self.assertEqual(sorted(names), sorted(whole))
+        # Nothing is kept in the module's dict
+        self.assertEqual(adp.dataframes, {})
+
+
+class testPeakRSS(unittest.TestCase):
+
+    @unittest.skipIf(peak_rss() is None, "no RSS measurement here")
+    def test_stage_peaks_are_recorded(self):
+        run_metrics = RunMetrics()
+        run_metrics.track_memory()
+        with run_metrics.timer('outer'):
+            with run_metrics.timer('allocate'):
+                block = bytearray(64 * 2**20)
+            del block
+        peaks = run_metrics.as_dict()['stages']
+        self.assertGreaterEqual(peaks['allocate']['peak_rss_bytes'],
+                                64 * 2**20)
+        self.assertGreaterEqual(peaks['outer']['peak_rss_bytes'],
+                                peaks['allocate']['peak_rss_bytes'])
+        self.assertIn('Peak RSS MB', run_metrics.report())
+
+
+if __name__ == '__main__':
+    unittest.main()
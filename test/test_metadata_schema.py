@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the metadata type schema read from edit_mysql_db.sql
+"""
+
+import os
+import unittest
+
+os.environ['SPECCHIO_CLIENT_BACKEND'] = 'fake'
+
+import pyspecchio.metadata_schema as metaschema
+import pyspecchio.specchio_db_interface as specchio
+from pyspecchio.spectra_parser import SpectraFile
+
+
+class testSqlStorageFields(unittest.TestCase):
+
+    def test_split_sql_values_keeps_subselects(self):
+        values, _ = metaschema.split_sql_values(
+            "('Dark', (select id from c where name ='General'),"
+            " 'string_val', 'Level (GS)');")
+        self.assertEqual(values[0], 'Dark')
+        self.assertTrue(values[1].startswith('(select'))
+        self.assertEqual(values[2:], ['string_val', 'Level (GS)'])
+
+    def test_storage_fields_from_sql(self):
+        fields = metaschema.read_attribute_storage_fields()
+        self.assertEqual(fields['Saturation Level'], 'double_val')
+        self.assertEqual(fields['Wavelength Calibration Coefficients'],
+                         'string_val')
+        self.assertEqual(fields['SPAD10'], 'double_val')
+
+    def test_standard_fields_included(self):
+        fields = metaschema.get_storage_fields()
+        self.assertEqual(fields['Integration Time'], 'int_val')
+
+
+class testMetadataSchema(unittest.TestCase):
+
+    def setUp(self):
+        self.schema = metaschema.MetadataSchema(
+            specchio.specchioDBinterface.MAP_PICO_METADATA_SPECCHIONAME)
+
+    def test_list_to_comma_separated_string(self):
+        self.assertEqual(self.schema.convert('OpticalPixelRange', [10, 1033]),
+                         '10, 1033')
+
+    def test_numeric_conversions(self):
+        self.assertEqual(self.schema.convert('SaturationLevel', 200000),
+                         200000.0)
+        self.assertIsInstance(
+            self.schema.convert('SaturationLevel', 200000), float)
+        self.assertEqual(self.schema.convert('IntegrationTime', 5600.0), 5600)
+        self.assertEqual(self.schema.convert('Dark', False), 'False')
+
+    def test_null_is_skipped(self):
+        self.assertIsNone(self.schema.convert('TemperatureHeatsink', None))
+
+    def test_boxing(self):
+        schema = metaschema.MetadataSchema(
+            {'SaturationLevel': 'Saturation Level'},
+            boxing={'double_val': lambda value: ('Double', value)})
+        self.assertEqual(schema.convert('SaturationLevel', 1),
+                         ('Double', 1.0))
+
+
+class testPicoMetadataUpload(unittest.TestCase):
+
+    PICO_DIR = os.path.join(os.path.abspath("test/PICO_testdata/"), '')
+
+    def test_metadata_types(self):
+        db_interface = specchio.specchioDBinterface("Schema Campaign")
+        db_interface.specchio_upload_pico_spectra(SpectraFile(
+            "QEPs2_b000000_s000002_light.pico", self.PICO_DIR))
+        client = db_interface.specchio_client
+        smd = client.spectra[min(client.spectra)][2]
+        values = dict((mp.getAttributeName(), mp.getValue())
+                      for mp in smd.getEntries())
+        self.assertEqual(values['Optical Pixel Range'], '10, 1033')
+        self.assertIsInstance(values['Saturation Level'], float)
+        self.assertNotIn('Temperature Detector Heatsink', values)
+        self.assertEqual(client.call_counts['getAttributesNameHash'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the run metrics instrumentation.
+"""
+
+import json
+import os
+import tempfile
+import threading
+import unittest
+
+import pyspecchio.metrics as metrics
+from pyspecchio.metrics import RunMetrics, InstrumentedClient
+
+
+class dummyClient(object):
+
+    name = "dummy"
+
+    def insertCampaign(self, campaign):
+        return 7
+
+
+class testRunMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.metrics = RunMetrics()
+        # Count the peak RSS resets and reads
+        self.memory_calls = {'reset': 0, 'read': 0}
+        reset_peak_rss, peak_rss = metrics.reset_peak_rss, metrics.peak_rss
+
+        def counted(name, function):
+            def call():
+                self.memory_calls[name] += 1
+                return function()
+            return call
+        metrics.reset_peak_rss = counted('reset', reset_peak_rss)
+        metrics.peak_rss = counted('read', peak_rss)
+        self.addCleanup(setattr, metrics, 'reset_peak_rss', reset_peak_rss)
+        self.addCleanup(setattr, metrics, 'peak_rss', peak_rss)
+
+    def test_timer_accumulates_calls(self):
+        for _ in range(3):
+            with self.metrics.timer('stage'):
+                pass
+        stages = self.metrics.as_dict()['stages']
+        self.assertEqual(stages['stage']['calls'], 3)
+        self.assertGreaterEqual(stages['stage']['seconds'], 0.0)
+
+    def test_timer_records_on_exception(self):
+        with self.assertRaises(ValueError):
+            with self.metrics.timer('failing'):
+                raise ValueError
+        self.assertEqual(self.metrics.stage_calls['failing'], 1)
+
+    def test_counters(self):
+        self.metrics.count('rows', 10)
+        self.metrics.count('rows', 5)
+        self.assertEqual(self.metrics.as_dict()['counters']['rows'], 15)
+
+    def test_threads(self):
+        self.metrics.track_memory()
+        started = threading.Barrier(4)
+
+        def work():
+            with self.metrics.timer('outer'):
+                # All the threads have 'outer' open at once
+                started.wait()
+                for _ in range(1000):
+                    with self.metrics.timer('inner'):
+                        self.metrics.count('rows')
+        threads = [threading.Thread(target=work) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # Only the first 'outer' reset the peak, which the others share
+        self.assertEqual(self.memory_calls['reset'], 1)
+        summary = self.metrics.as_dict()
+        self.assertEqual(summary['counters']['rows'], 4000)
+        self.assertEqual(summary['stages']['inner']['calls'], 4000)
+        self.assertEqual(summary['stages']['outer']['calls'], 4)
+        self.assertIn('peak_rss_bytes', summary['stages']['outer'])
+
+    def test_leaf_stages_leave_memory_alone(self):
+        self.metrics.track_memory()
+        client = InstrumentedClient(dummyClient(), self.metrics)
+        with self.metrics.timer('upload'):
+            for _ in range(10):
+                client.insertCampaign(None)
+                with self.metrics.timer('convert', memory=False):
+                    pass
+        self.assertEqual(self.memory_calls, {'reset': 1, 'read': 1})
+        stages = self.metrics.as_dict()['stages']
+        self.assertIn('peak_rss_bytes', stages['upload'])
+        self.assertNotIn('peak_rss_bytes', stages['convert'])
+        self.assertNotIn('peak_rss_bytes', stages['jvm.insertCampaign'])
+
+    def test_write_json(self):
+        self.metrics.count('spectra', 4)
+        fd, filename = tempfile.mkstemp(suffix='.json')
+        os.close(fd)
+        try:
+            self.metrics.write_json(filename)
+            with open(filename) as f:
+                self.assertEqual(json.load(f)['counters']['spectra'], 4)
+        finally:
+            os.remove(filename)
+
+    def test_instrumented_client_counts_calls(self):
+        client = InstrumentedClient(dummyClient(), self.metrics)
+        self.assertEqual(client.insertCampaign(None), 7)
+        self.assertEqual(client.name, "dummy")
+        self.assertEqual(
+            self.metrics.counters['jvm_calls.insertCampaign'], 1)
+        self.assertIn('jvm.insertCampaign', self.metrics.report())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the per-plot orthomosaic statistics, on a small synthetic GeoTIFF
+"""
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+try:
+    import rasterio
+    from rasterio.transform import from_origin
+    import pyspecchio.ortho_zonal_stats as ozs
+except ImportError:
+    rasterio = None
+
+import pyspecchio.ancildata_parser as adp
+
+
+def square(x0, y0, size):
+    return {'type': 'Polygon',
+            'coordinates': [[[x0, y0], [x0 + size, y0],
+                             [x0 + size, y0 + size], [x0, y0 + size],
+                             [x0, y0]]]}
+
+
+@unittest.skipIf(rasterio is None, "rasterio is not installed")
+class testZonalStatistics(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.uav_dir = os.path.join(
+            self.tmpdir, 'ES', 'field_scale', 'ES_F1_2017', 'plot_scale_data',
+            'UAV')
+        os.makedirs(self.uav_dir)
+        self.ortho_file = os.path.join(self.uav_dir, '20170530_UAV.tif')
+        # 100 x 100 pixels of 1 unit, origin (0, 100); band 2 = 2 * band 1
+        band1 = np.tile(np.arange(100, dtype='float32'), (100, 1))
+        data = np.stack([band1, band1 * 2])
+        with rasterio.open(
+                self.ortho_file, 'w', driver='GTiff', width=100, height=100,
+                count=2, dtype='float32', nodata=-1,
+                transform=from_origin(0, 100, 1, 1)) as dst:
+            dst.write(data)
+        self.plots = {'P1': square(10, 10, 10), 'P2': square(60, 50, 20)}
+        self.plots_file = os.path.join(self.tmpdir, 'plots.geojson')
+        with open(self.plots_file, 'w') as f:
+            json.dump({'type': 'FeatureCollection', 'features': [
+                {'type': 'Feature', 'properties': {'Plot': plot_id},
+                 'geometry': geometry}
+                for plot_id, geometry in sorted(self.plots.items())]}, f)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+        adp.dataframes.clear()
+
+    def test_tiles_only_cover_plots(self):
+        with rasterio.open(self.ortho_file) as dataset:
+            tiles = ozs.plan_tiles(dataset, self.plots, tile_size=25)
+        # P1 is in one tile, P2 spans two
+        self.assertEqual(len(tiles), 3)
+
+    def test_statistics_match_whole_raster(self):
+        plots = ozs.read_plot_polygons(self.plots_file)
+        stats = ozs.zonal_statistics(self.ortho_file, plots, tile_size=16,
+                                     workers=4).set_index('Plot')
+        # Columns 60..79 have values 60..79
+        self.assertAlmostEqual(stats.loc['P2', 'Band1_mean'], 69.5)
+        self.assertAlmostEqual(stats.loc['P2', 'Band1_median'], 69.5)
+        self.assertAlmostEqual(stats.loc['P2', 'Band2_mean'], 139.0)
+        self.assertAlmostEqual(stats.loc['P1', 'Band1_std'],
+                               np.std(np.arange(10, 20)))
+
+    def test_feeds_ancillary_dataframes(self):
+        dfs = adp.extract_dataframes(
+            os.path.join(self.tmpdir, ''), plots_file=self.plots_file)
+        self.assertIn('ES_F1_20170530_UAV', dfs)
+        self.assertEqual(
+            adp.get_category_from_df_key('ES_F1_20170530_UAV'), 'UAV')
+        self.assertEqual(list(dfs['ES_F1_20170530_UAV']['Plot']),
+                         ['P1', 'P2'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -9,6 +9,9 @@ Test suite for the parser modules in pySPECCHIO
 """
 
 import unittest
+
+import pandas as pd
+
 import pyspecchio.ancildata_parser as adp
 from pyspecchio.spectra_parser import SpectraFile
 
@@ -87,6 +90,65 @@ class testAncilParser(unittest.TestCase):
         date = adp.get_date_from_df_key(list(dfs.keys())[1])
         self.assertIsNotNone(re.match(pattern, date))
 
+    def test_declared_dtypes_applied(self):
+        dfs = adp.extract_dataframes(self.DATADIR)
+        height = dfs['ES_F1_20170420_Height']
+        self.assertEqual(height['Fertiliser_level'].dtype.name, 'category')
+        self.assertEqual(height['Plot_(variety_and_plot_number)'].dtype.name,
+                         'category')
+        self.assertEqual(height['Height1'].dtype, 'float32')
+        self.assertEqual(adp.python_value(height['Height1'].iloc[0]), 0.33)
+
+    def test_excel_typed_as_read(self):
+        import warnings
+        filefullname = self.DATADIR + \
+            "ES/field_scale/ES_F1_2017/plot_scale_data/Height/" \
+            "20170420_Height.xlsx"
+        adp.dataframes.pop("ES_F1_20170420_Height", None)
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter("always")
+            adp.extract_excel_format(filefullname, "ES_F1_20170420_Height")
+        height = adp.dataframes.pop("ES_F1_20170420_Height")
+        self.assertFalse(any(issubclass(w.category, UserWarning)
+                             for w in caught))
+        # Before apply_dtypes, including the column with a padded name
+        self.assertEqual(height[' Height1 '].dtype, 'float32')
+        self.assertEqual(height['Fertiliser_level'].dtype.name, 'category')
+
+    def test_measurement_not_a_number(self):
+        import os
+        import shutil
+        import tempfile
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        filefullname = os.path.join(directory, "20170420_Height.xlsx")
+        pd.DataFrame([['Height', None], ['Plot', 'Height1'], ['A1', 0.5],
+                      ['B2', 'n/a']]).to_excel(filefullname, header=False,
+                                               index=False)
+        adp.extract_excel_format(filefullname, "ES_F1_20170420_Height")
+        height = adp.apply_dtypes(
+            adp.dataframes.pop("ES_F1_20170420_Height"),
+            "ES_F1_20170420_Height")
+        self.assertEqual(height['Plot'].dtype.name, 'category')
+        self.assertEqual(height['Height1'].dtype, 'float32')
+        self.assertTrue(pd.isnull(height['Height1'].iloc[1]))
+
+    def test_PRN_columns_typed(self):
+        filefullname = self.TEST_PRN_DIR + "20170714_LAI.PRN"
+        adp.extract_PRN_format(filefullname, "ES_F1_20170714_LAI")
+        lai = adp.dataframes.pop("ES_F1_20170714_LAI")
+        self.assertEqual(lai['LAI'].dtype, 'float32')
+        self.assertEqual(lai['Sample'].dtype, 'int16')
+        self.assertEqual(lai['Time'].iloc[0].date().isoformat(),
+                         '2017-07-14')
+
+    def test_PRN_without_date_keeps_times(self):
+        filefullname = self.TEST_PRN_DIR + "20170714_LAI.PRN"
+        adp.extract_PRN_format(filefullname, "UNDATED_PRN")
+        lai = adp.dataframes.pop("UNDATED_PRN")
+        self.assertEqual(lai['LAI'].dtype, 'float32')
+        self.assertTrue(pd.api.types.is_timedelta64_dtype(lai['Time']))
+
     def get_category_from_df_category(self):
         """Test the Category stripper"""
         string =  'ES_F1_20170627_NitrateAmmonia'
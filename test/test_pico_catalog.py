@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the PICO metadata catalog
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import pyspecchio.metrics as metrics
+from pyspecchio.pico_catalog import PicoCatalog, scan_file
+
+
+class testPicoCatalog(unittest.TestCase):
+
+    PICO_DIR = os.path.join(os.path.abspath("test/PICO_testdata/"), '')
+    PICO_FILES = ("QEP1USB1_b000000_s000002_light.pico",
+                  "QEPs2_b000000_s000002_light.pico")
+
+    def setUp(self):
+        metrics.reset()
+        self.tmpdir = tempfile.mkdtemp()
+        self.top = os.path.join(self.tmpdir, 'pico')
+        os.makedirs(os.path.join(self.top, 'day2'))
+        shutil.copy(os.path.join(self.PICO_DIR, self.PICO_FILES[0]),
+                    self.top)
+        shutil.copy(os.path.join(self.PICO_DIR, self.PICO_FILES[1]),
+                    os.path.join(self.top, 'day2'))
+        self.catalog = PicoCatalog(os.path.join(self.tmpdir, 'cat.sqlite'))
+
+    def tearDown(self):
+        self.catalog.close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_scan_file(self):
+        path, _, size, rows = scan_file(
+            os.path.join(self.PICO_DIR, self.PICO_FILES[0]))
+        self.assertEqual(len(rows), 4)
+        self.assertEqual(rows[0][4], 'QEP01651')
+        self.assertEqual(rows[0][6], 'Upwelling')
+        self.assertEqual(rows[0][9], 5600.0)
+        self.assertEqual(sorted(set(row[10] for row in rows)), [1044, 2048])
+
+    def test_incremental_update(self):
+        changes = self.catalog.update([self.top])
+        self.assertEqual(changes, {'added': 2, 'changed': 0, 'removed': 0,
+                                   'unchanged': 0})
+        self.assertEqual(len(self.catalog.select()), 8)
+
+        # Nothing is parsed again until a file changes or goes
+        changes = self.catalog.update([self.top])
+        self.assertEqual(changes['unchanged'], 2)
+        self.assertEqual(metrics.as_dict()['counters']
+                         ['catalog.files_scanned'], 2)
+        changed = os.path.join(self.top, self.PICO_FILES[0])
+        os.utime(changed, (1e9, 1e9))
+        os.remove(os.path.join(self.top, 'day2', self.PICO_FILES[1]))
+        changes = self.catalog.update([self.top])
+        self.assertEqual(changes, {'added': 0, 'changed': 1, 'removed': 1,
+                                   'unchanged': 0})
+        selection = self.catalog.select()
+        self.assertEqual(list(selection['path'].unique()), [changed])
+        self.assertEqual(selection['mtime'].iloc[0], 1e9)
+
+    def test_parallel_scan(self):
+        self.catalog.update([self.top], workers=2)
+        self.assertEqual(len(self.catalog.select()), 8)
+
+    def test_select_and_upload_groups(self):
+        self.catalog.update([self.top])
+        selection = self.catalog.select(
+            "serial = ? AND direction = 'Upwelling'"
+            " AND integration_time_ms > 300 AND datetime >= '2018-01'",
+            ('QEP01651',))
+        self.assertEqual(len(selection), 1)
+        self.assertEqual(selection['integration_time_ms'].iloc[0], 310.0)
+
+        upwelling = self.catalog.select("direction = 'Upwelling'")
+        groups = PicoCatalog.spectra_to_upload(upwelling)
+        self.assertEqual([spectrafile.sfile for spectrafile, _ in groups],
+                         list(self.PICO_FILES))
+        self.assertEqual([numbers for _, numbers in groups], [[0, 1], [0, 1]])
+        self.assertEqual(groups[1][0].spath,
+                         os.path.join(self.top, 'day2', ''))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the query builder compiled to EAV query conditions
+"""
+
+import os
+import unittest
+
+# Must be set before the db interface is imported
+os.environ['SPECCHIO_CLIENT_BACKEND'] = 'fake'
+
+import pyspecchio.specchio_db_interface as specchio
+import pyspecchio.specchio_fake_client as fakeclient
+from pyspecchio.query_builder import SpectraQuery
+from pyspecchio.spectra_parser import SpectraFile
+
+
+class testSpectraQuery(unittest.TestCase):
+
+    PICO_DIR = os.path.join(os.path.abspath("test/PICO_testdata/"), '')
+
+    def setUp(self):
+        self.client = fakeclient.FakeSPECCHIOClient(latency=0)
+        self.db = specchio.specchioDBinterface("Query Campaign",
+                                               client=self.client)
+        for name in ("QEP1USB1_b000000_s000002_light.pico",
+                     "QEPs2_b000000_s000002_light.pico"):
+            self.db.specchio_upload_pico_spectra(
+                SpectraFile(name, self.PICO_DIR))
+
+    def test_conditions_are_run_in_one_query(self):
+        upwelling = SpectraQuery(self.db).where('Direction', '==',
+                                                'Upwelling')
+        self.assertEqual(upwelling.ids(), [1, 2, 5, 6])
+        qep = upwelling.where('Instrument Serial Number', '!=',
+                              'USB2+H16355').where(
+                                  'Integration Time', '>', 1000)
+        self.assertEqual(qep.ids(), [1, 6])
+        self.assertEqual(
+            self.client.call_counts['getSpectrumIdsMatchingQuery'], 2)
+        # where() leaves the query it extends unchanged
+        self.assertEqual(len(upwelling.conditions), 1)
+
+    def test_between(self):
+        query = SpectraQuery(self.db).where('Integration Time', 'between',
+                                            (1000, 3000))
+        self.assertEqual(query.ids(), [2, 4, 6, 7])
+        self.assertEqual(query.conditions[0][1:], ('>=', '1000'))
+
+    def test_unknown_attribute_and_operator(self):
+        self.db.attributes = {'Direction': fakeclient.Attribute(
+            1, 'Direction')}
+        with self.assertRaisesRegex(KeyError, "Did you mean: Direction"):
+            SpectraQuery(self.db).where('Directon', '==', 'Upwelling')
+        with self.assertRaises(ValueError):
+            SpectraQuery(self.db).where('Direction', 'in', ['Upwelling'])
+        with self.assertRaises(ValueError):
+            SpectraQuery(self.db).ids()
+
+    def test_to_dataframe(self):
+        wide = SpectraQuery(self.db).where(
+            'Direction', '==', 'Downwelling').to_dataframe(
+                ['Instrument Serial Number'], clients=[self.client],
+                progress=None)
+        self.assertEqual(list(wide.index), [3, 4, 7, 8])
+        self.assertEqual(list(wide['Instrument Serial Number']),
+                         ['QEP01651', 'USB2+H16355', 'QEP01651',
+                          'QEP01652'])
+
+
+if __name__ == '__main__':
+    unittest.main()
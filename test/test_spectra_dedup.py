@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the content-hash deduplication of uploaded spectra
+"""
+
+import os
+import unittest
+
+# Must be set before the db interface is imported
+os.environ['SPECCHIO_CLIENT_BACKEND'] = 'fake'
+
+import pyspecchio.metrics as metrics
+import pyspecchio.spectra_dedup as dedup
+import pyspecchio.specchio_db_interface as specchio
+import pyspecchio.specchio_fake_client as fakeclient
+from pyspecchio.spectra_parser import SpectraFile
+
+
+class testSpectrumHash(unittest.TestCase):
+
+    def test_hash_depends_on_pixels_and_key_metadata(self):
+        metadata = {'SerialNumber': 'QEP01651', 'Direction': 'Upwelling',
+                    'Datetime': '2017-05-30T12:00:00', 'Batch': 0}
+        base = dedup.spectrum_hash([1.0, 2.0], metadata)
+        self.assertEqual(base, dedup.spectrum_hash([1.0, 2.0],
+                                                   dict(metadata)))
+        self.assertNotEqual(base, dedup.spectrum_hash([1.0, 2.5], metadata))
+        self.assertNotEqual(base, dedup.spectrum_hash(
+            [1.0, 2.0], dict(metadata, Direction='Downwelling')))
+        # Other metadata is not part of the identity
+        self.assertEqual(base, dedup.spectrum_hash(
+            [1.0, 2.0], dict(metadata, Batch=1)))
+
+    def test_index_is_per_campaign(self):
+        index = dedup.HashIndex(':memory:')
+        index.add('A', ['abc'])
+        self.assertTrue(index.contains('A', 'abc'))
+        self.assertFalse(index.contains('B', 'abc'))
+
+
+class testDedupUpload(unittest.TestCase):
+
+    PICO_DIR = os.path.join(os.path.abspath("test/PICO_testdata/"), '')
+
+    def setUp(self):
+        metrics.reset()
+        self.client = fakeclient.FakeSPECCHIOClient(latency=0)
+        self.spectrafile = SpectraFile("QEPs2_b000000_s000002_light.pico",
+                                       self.PICO_DIR)
+
+    def test_second_upload_is_skipped(self):
+        db = specchio.specchioDBinterface(
+            "Dedup Campaign", client=self.client,
+            deduplicator=dedup.Deduplicator(dedup.HashIndex(':memory:')))
+        db.specchio_upload_pico_spectra(self.spectrafile)
+        db.specchio_upload_pico_spectra(self.spectrafile)
+        self.assertEqual(len(self.client.spectra), 4)
+        self.assertEqual(self.client.call_counts['insertSpectralFile'], 1)
+        counters = metrics.as_dict()['counters']
+        self.assertEqual(counters['dedup.spectra_skipped'], 4)
+        self.assertEqual(counters['dedup.inserts_saved'], 1)
+        self.assertEqual(counters['dedup.bytes_saved'], 4 * 4 * 1044)
+
+    def test_server_check_finds_spectra_from_elsewhere(self):
+        first = specchio.specchioDBinterface(
+            "Dedup Campaign", client=self.client,
+            deduplicator=dedup.Deduplicator(dedup.HashIndex(':memory:')))
+        first.specchio_upload_pico_spectra(self.spectrafile)
+        # Another machine, with an empty local index
+        second = specchio.specchioDBinterface(
+            "Dedup Campaign", client=self.client,
+            deduplicator=dedup.Deduplicator(dedup.HashIndex(':memory:'),
+                                            check_server=True))
+        second.specchio_upload_pico_spectra(self.spectrafile)
+        self.assertEqual(len(self.client.spectra), 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
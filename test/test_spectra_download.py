@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the parallel bulk download of spectra into pandas
+"""
+
+import os
+import unittest
+
+import numpy as np
+
+# Must be set before the db interface is imported
+os.environ['SPECCHIO_CLIENT_BACKEND'] = 'fake'
+
+import pyspecchio.specchio_db_interface as specchio
+import pyspecchio.specchio_fake_client as fakeclient
+import pyspecchio.spectra_download as download
+from pyspecchio.spectra_parser import SpectraFile
+
+
+class testSpectraDownload(unittest.TestCase):
+
+    PICO_DIR = os.path.join(os.path.abspath("test/PICO_testdata/"), '')
+    PICO_FILES = ("QEP1USB1_b000000_s000002_light.pico",
+                  "QEPs2_b000000_s000002_light.pico")
+
+    def setUp(self):
+        self.client = fakeclient.FakeSPECCHIOClient(latency=0)
+        db = specchio.specchioDBinterface("Download Campaign",
+                                          client=self.client)
+        self.files = [SpectraFile(name, self.PICO_DIR)
+                      for name in self.PICO_FILES]
+        for spectrafile in self.files:
+            db.specchio_upload_pico_spectra(spectrafile)
+
+    def test_paginate(self):
+        self.assertEqual(download.paginate([5, 3, 5, 1, 2], 2),
+                         [[5, 3], [1, 2]])
+
+    def test_wide_dataframe_of_spectra_and_attributes(self):
+        progress = []
+        ids = [8, 7, 6, 5, 4, 3, 2, 1]
+        wide = download.SpectraDownloader(
+            [self.client] * 3, page_size=3,
+            progress=lambda *report: progress.append(report)).download(
+                ids, ['Direction', 'Instrument Serial Number'])
+
+        self.assertEqual(list(wide.index), ids)
+        self.assertEqual(list(wide.columns[:2]),
+                         ['Direction', 'Instrument Serial Number'])
+        self.assertEqual(wide.shape, (8, 2 + 2048))
+        self.assertEqual(self.client.call_counts['loadSpace'], 3)
+        self.assertEqual(self.client.call_counts['getMetaparameterValues'],
+                         6)
+        self.assertEqual(sorted(progress)[-1], (8, 8))
+
+        # Spectrum 7 is the third spectrum of the second file
+        self.assertEqual(wide.loc[7, 'Direction'], 'Downwelling')
+        pixels = self.files[1].get_spectra_pixels(2)
+        np.testing.assert_allclose(
+            wide.loc[7].iloc[2:2 + len(pixels)].astype(float), pixels,
+            rtol=1e-6)
+
+    def test_no_ids(self):
+        wide = download.download([], ['Direction'], clients=[self.client],
+                                 progress=None)
+        self.assertEqual(len(wide), 0)
+        self.assertEqual(list(wide.columns), ['Direction'])
+
+
+if __name__ == '__main__':
+    unittest.main()
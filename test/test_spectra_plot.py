@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for plotting large collections of spectra
+"""
+
+import unittest
+
+import numpy as np
+
+import pyspecchio.spectra_plot as spectra_plot
+
+
+class testSpectraPlot(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.wavelengths = np.linspace(400, 900, 2048)
+        self.spectra = rng.uniform(0.2, 0.4, (30, 2048))
+        # A one pixel spike, which decimation must keep
+        self.spectra[3, 1001] = 5.0
+
+    def test_minmax_decimate_keeps_extremes(self):
+        x, y = spectra_plot.minmax_decimate(self.wavelengths, self.spectra,
+                                            columns=100)
+        self.assertEqual(x.shape, y.shape)
+        self.assertLessEqual(y.shape[1], 2 * 103)
+        np.testing.assert_array_equal(y.max(axis=1), self.spectra.max(axis=1))
+        np.testing.assert_array_equal(y.min(axis=1), self.spectra.min(axis=1))
+        self.assertIn(self.wavelengths[1001], x[3])
+        # Points stay in wavelength order
+        self.assertTrue((np.diff(x, axis=1) >= 0).all())
+
+    def test_minmax_decimate_small_and_nan(self):
+        x, y = spectra_plot.minmax_decimate(self.wavelengths[:50],
+                                            self.spectra[:, :50])
+        np.testing.assert_array_equal(y, self.spectra[:, :50])
+        spectra = self.spectra.copy()
+        spectra[0, :40] = np.nan
+        _, y = spectra_plot.minmax_decimate(self.wavelengths, spectra, 100)
+        self.assertEqual(np.nanmax(y[0]), np.nanmax(spectra[0]))
+
+    def test_density_image(self):
+        image, extent = spectra_plot.density_image(
+            self.wavelengths, self.spectra, shape=(50, 200),
+            value_range=(0, 1))
+        self.assertEqual(image.shape, (50, 200))
+        # Every value but the spike falls in the image
+        self.assertEqual(image.sum(), self.spectra.size - 1)
+        self.assertEqual(image[:10].sum(), 0)
+        self.assertEqual(extent, (400.0, 900.0, 0.0, 1.0))
+
+    def test_percentile_envelopes(self):
+        groups = ['plot1'] * 10 + ['plot2'] * 20
+        envelopes = spectra_plot.percentile_envelopes(
+            self.spectra, groups, percentiles=(0, 50, 100))
+        self.assertEqual(sorted(envelopes), ['plot1', 'plot2'])
+        np.testing.assert_array_equal(envelopes['plot1'][2],
+                                      self.spectra[:10].max(axis=0))
+        everything = spectra_plot.percentile_envelopes(self.spectra)
+        self.assertEqual(everything[None].shape, (5, 2048))
+
+    @unittest.skipIf(spectra_plot.plt is None, "matplotlib not installed")
+    def test_plot_spectra(self):
+        import matplotlib
+        matplotlib.use('Agg')
+        figure, axes = spectra_plot.plt.subplots()
+        lines = spectra_plot.plot_spectra(self.wavelengths, self.spectra,
+                                          axes)
+        self.assertEqual(len(lines.get_segments()), 30)
+        spectra_plot.plot_spectra(self.wavelengths, self.spectra, axes,
+                                  method='density')
+        spectra_plot.plot_envelopes(
+            self.wavelengths,
+            spectra_plot.percentile_envelopes(self.spectra), axes)
+        spectra_plot.plt.close(figure)
+
+
+if __name__ == '__main__':
+    unittest.main()
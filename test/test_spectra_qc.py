@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the QC screening of spectra before upload
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+# Must be set before the db interface is imported
+os.environ['SPECCHIO_CLIENT_BACKEND'] = 'fake'
+
+import pyspecchio.spectra_qc as qc
+import pyspecchio.specchio_db_interface as specchio
+import pyspecchio.specchio_fake_client as fakeclient
+from pyspecchio.spectra_parser import SpectraFile, SpectraStack
+
+
+def make_stack(spectra, **metadata):
+    stack = SpectraStack(np.arange(spectra.shape[1], dtype='float64'))
+    base = {'SaturationLevel': 1000, 'OpticalPixelRange': [1, 8],
+            'IntegrationTime': 100.0, 'TemperatureDetectorActual': -10.0,
+            'TemperatureDetectorSet': -10.0}
+    base.update(metadata)
+    for i, pixels in enumerate(spectra):
+        stack.add(list(pixels), dict(base), ('test.pico', i))
+    return stack.finish()
+
+
+class testScreenStack(unittest.TestCase):
+
+    def test_saturation_only_counts_optical_pixels(self):
+        spectra = np.full((3, 10), 500.0)
+        spectra[0, 0] = 1000.0   # outside the optical range
+        spectra[1, 4] = 1000.0
+        values, failed = qc.screen_stack(make_stack(spectra),
+                                         qc.QCCriteria())
+        self.assertEqual(list(values['saturated_pixels']), [0, 1, 0])
+        self.assertEqual(list(failed['saturated']), [False, True, False])
+
+    def test_dark_and_temperature(self):
+        spectra = np.full((2, 10), 500.0)
+        spectra[1] = 5.0
+        values, failed = qc.screen_stack(
+            make_stack(spectra, TemperatureDetectorActual=-5.0),
+            qc.QCCriteria())
+        self.assertEqual(list(failed['dark']), [False, True])
+        self.assertTrue(failed['detector_temperature'].all())
+
+    def test_missing_temperatures_are_not_flagged(self):
+        values, failed = qc.screen_stack(
+            make_stack(np.full((1, 10), 500.0),
+                       TemperatureDetectorActual=None),
+            qc.QCCriteria())
+        self.assertFalse(failed['detector_temperature'].any())
+
+
+class testQCUpload(unittest.TestCase):
+
+    PICO_DIR = os.path.join(os.path.abspath("test/PICO_testdata/"), '')
+
+    def test_only_clean_spectra_uploaded(self):
+        spectrafile = SpectraFile("QEP1USB1_b000000_s000002_light.pico",
+                                  self.PICO_DIR)
+        report = qc.screen([spectrafile])
+        # The USB2000+ spectra in the sample file are saturated
+        self.assertEqual(list(report['rejected']),
+                         [False, True, False, True])
+        self.assertEqual(report['flags'].iloc[1], 'saturated')
+        clean = qc.clean_spectra(report)
+        path = spectrafile.spath + spectrafile.sfile
+        self.assertEqual(clean[path], [0, 2])
+
+        client = fakeclient.FakeSPECCHIOClient(latency=0)
+        db = specchio.specchioDBinterface("QC Campaign", client=client)
+        db.specchio_upload_pico_spectra(
+            spectrafile, spectra_numbers=clean[path])
+        serials = [smd.get_entry('Instrument Serial Number').getValue()
+                   for _, _, smd, _ in client.spectra.values()]
+        self.assertEqual(serials, ['QEP01651', 'QEP01651'])
+
+    def test_same_named_files_kept_apart(self):
+        # PICO file names repeat in every batch folder
+        tmpdir = tempfile.mkdtemp()
+        try:
+            spectrafiles = []
+            for folder, pico_name in (
+                    ('b1', "QEP1USB1_b000000_s000002_light.pico"),
+                    ('b2', "QEPs2_b000000_s000002_light.pico")):
+                os.mkdir(os.path.join(tmpdir, folder))
+                shutil.copy(os.path.join(self.PICO_DIR, pico_name),
+                            os.path.join(tmpdir, folder, 'same.pico'))
+                spectrafiles.append(SpectraFile(
+                    'same.pico', os.path.join(tmpdir, folder, '')))
+            clean = qc.clean_spectra(qc.screen(spectrafiles))
+            first, second = (spectrafile.spath + spectrafile.sfile
+                             for spectrafile in spectrafiles)
+            self.assertEqual(clean[first], [0, 2])
+            self.assertEqual(len(clean), 2)
+            self.assertNotEqual(clean[second], clean[first])
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for resampling spectra onto a common wavelength grid
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+# Must be set before the db interface is imported
+os.environ['SPECCHIO_CLIENT_BACKEND'] = 'fake'
+
+import pyspecchio.metrics as metrics
+import pyspecchio.specchio_db_interface as specchio
+import pyspecchio.specchio_fake_client as fakeclient
+from pyspecchio.spectra_parser import SpectraFile, stack_spectra
+from pyspecchio.spectra_resample import (
+    Resampler, parse_grid, resampling_matrix)
+
+
+class testSpectraResample(unittest.TestCase):
+
+    PICO_DIR = os.path.join(os.path.abspath("test/PICO_testdata/"), '')
+    PICO_FILES = ("QEP1USB1_b000000_s000002_light.pico",
+                  "QEPs2_b000000_s000002_light.pico")
+
+    def setUp(self):
+        metrics.reset()
+        self.cache_dir = tempfile.mkdtemp()
+        self.target = np.arange(400.0, 1000.0 + 1e-9, 1.0)
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def test_parse_grid(self):
+        np.testing.assert_array_equal(parse_grid('400:410:5'),
+                                      [400.0, 405.0, 410.0])
+        self.assertRaises(ValueError, parse_grid, '400:410')
+        self.assertRaises(ValueError, parse_grid, '410:400:1')
+
+    def test_methods_reproduce_linear_spectrum(self):
+        source = np.linspace(350.0, 1050.0, 2048)
+        # Averaging treats each pixel as constant over its bin, so is only
+        # exact to within a small part of a pixel's width
+        for method, tolerance in (('linear', 1e-6), ('average', 0.05)):
+            matrix, valid = resampling_matrix(source, self.target, method)
+            self.assertTrue(valid.all())
+            np.testing.assert_allclose(matrix.dot(2 * source + 1),
+                                       2 * self.target + 1, atol=tolerance)
+        self.assertRaises(ValueError, resampling_matrix, source,
+                          self.target, 'cubic')
+
+    def test_outside_source_range_is_nan(self):
+        source = np.linspace(639.0, 806.0, 1044)
+        resampler = Resampler(self.target, cache_dir=False)
+        resampled = resampler.resample(np.ones((3, 1044)), source)
+        self.assertEqual(resampled.shape, (3, len(self.target)))
+        inside = (self.target >= 639.0) & (self.target <= 806.0)
+        np.testing.assert_allclose(resampled[:, inside], 1.0)
+        self.assertTrue(np.isnan(resampled[:, ~inside]).all())
+
+    def test_matrices_are_cached_on_disk(self):
+        source = np.linspace(350.0, 1050.0, 2048)
+        spectra = np.random.RandomState(0).rand(5, 2048)
+        first = Resampler(self.target, 'average', self.cache_dir)
+        expected = first.resample(spectra, source)
+        first.resample(spectra, source)
+        self.assertEqual(metrics.as_dict()['stages']
+                         ['resample.compute_matrix']['calls'], 1)
+        self.assertEqual(len(os.listdir(self.cache_dir)), 1)
+
+        second = Resampler(self.target, 'average', self.cache_dir)
+        np.testing.assert_allclose(second.resample(spectra, source),
+                                   expected)
+        self.assertEqual(metrics.as_dict()['counters']
+                         ['resample.matrices_loaded'], 1)
+
+    def test_harmonise_mixed_instruments(self):
+        files = [SpectraFile(name, self.PICO_DIR) for name in self.PICO_FILES]
+        stacks = stack_spectra(files)
+        # Three instruments: two QEPs and a USB2000+
+        self.assertEqual(len(stacks), 3)
+        resampler = Resampler(self.target, cache_dir=False)
+        common = resampler.harmonise_stacks(stacks)
+        self.assertEqual(common.spectra.shape, (8, len(self.target)))
+        self.assertEqual(len(common.sources), 8)
+        np.testing.assert_array_equal(common.wavelengths, self.target)
+        # QEP01651 covers 400-1000 nm entirely
+        qep = [row for row, metadata in enumerate(common.metadata)
+               if metadata['SerialNumber'] == 'QEP01651']
+        self.assertFalse(np.isnan(common.spectra[qep]).any())
+
+    def test_upload_on_common_grid(self):
+        client = fakeclient.FakeSPECCHIOClient(latency=0)
+        db = specchio.specchioDBinterface(
+            "Resampled", client=client,
+            resampler=Resampler(self.target, cache_dir=False))
+        db.specchio_upload_pico_spectra(
+            SpectraFile(self.PICO_FILES[0], self.PICO_DIR))
+        self.assertEqual(len(client.spectra), 4)
+        for vector, wavelengths, _, _ in client.spectra.values():
+            self.assertEqual(len(vector), len(self.target))
+            np.testing.assert_allclose(
+                [float(w) for w in wavelengths], self.target)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the nearest-neighbour spectral similarity index
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+# Must be set before the db interface is imported
+os.environ['SPECCHIO_CLIENT_BACKEND'] = 'fake'
+
+import pyspecchio.metrics as metrics
+import pyspecchio.specchio_db_interface as specchio
+import pyspecchio.specchio_fake_client as fakeclient
+from pyspecchio.spectral_index import SpectralIndex
+from pyspecchio.spectra_parser import SpectraFile
+
+
+def synthetic_spectra(n, wavelengths, seed=0):
+    """Smooth, random 'vegetation-like' spectra"""
+    rng = np.random.RandomState(seed)
+    edges = rng.uniform(680, 740, (n, 1))
+    return rng.uniform(0.5, 2.0, (n, 1)) * (
+        0.05 + 0.5 / (1 + np.exp(-(wavelengths - edges) / 10.0)))
+
+
+class testSpectralIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.wavelengths = np.linspace(350, 1000, 600)
+        self.spectra = synthetic_spectra(50, self.wavelengths)
+        self.keys = ['s{}'.format(i) for i in range(50)]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_spectrum_is_its_own_nearest_neighbour(self):
+        index = SpectralIndex()
+        index.add(self.spectra, self.wavelengths, self.keys)
+        # Brightness does not matter
+        keys, distances = index.query(self.spectra[[3, 7]] * 5,
+                                      self.wavelengths, k=3)
+        self.assertEqual(list(keys[:, 0]), ['s3', 's7'])
+        np.testing.assert_allclose(distances[:, 0], 0, atol=1e-6)
+        self.assertTrue(np.all(np.diff(distances, axis=1) >= 0))
+
+    def test_sam_ranks_like_cosine(self):
+        cosine = SpectralIndex()
+        sam = SpectralIndex(metric='sam')
+        for index in (cosine, sam):
+            index.add(self.spectra, self.wavelengths, self.keys)
+        query = synthetic_spectra(4, self.wavelengths, seed=1)
+        cosine_keys, cosine_distances = cosine.query(
+            query, self.wavelengths)
+        sam_keys, sam_distances = sam.query(query, self.wavelengths)
+        np.testing.assert_array_equal(cosine_keys, sam_keys)
+        np.testing.assert_allclose(np.cos(sam_distances),
+                                   1 - cosine_distances, atol=1e-6)
+
+    def test_pca_keeps_the_neighbours(self):
+        index = SpectralIndex(n_components=8)
+        index.add(self.spectra, self.wavelengths, self.keys)
+        keys, _ = index.query(self.spectra[:5], self.wavelengths, k=1)
+        # Fitted by the query, to the spectra held so far
+        self.assertEqual(index.components.shape, (8, 251))
+        self.assertEqual(list(keys[:, 0]), self.keys[:5])
+
+    def test_components_wait_for_enough_spectra(self):
+        path = os.path.join(self.tmpdir, 'index')
+        index = SpectralIndex.open(path, n_components=8, fit_spectra=40)
+        # e.g. one uploaded file at a time, fewer than the components
+        for start in range(0, 36, 4):
+            index.add(self.spectra[start:start + 4], self.wavelengths,
+                      self.keys[start:start + 4])
+        self.assertIsNone(index.components)
+        self.assertEqual(len(index), 36)
+        # The spectra held are saved, and carried on with when loaded
+        index.save()
+        index = SpectralIndex.open(path)
+        self.assertEqual(len(index), 36)
+        index.add(self.spectra[36:], self.wavelengths, self.keys[36:])
+        self.assertEqual(index.components.shape, (8, 251))
+        self.assertEqual(len(index), 50)
+        index.save()
+        self.assertNotIn('unfitted.npz', os.listdir(path))
+        keys, _ = SpectralIndex.open(path).query(
+            self.spectra[[2, 45]], self.wavelengths, k=1)
+        self.assertEqual(list(keys[:, 0]), ['s2', 's45'])
+
+    def test_too_few_spectra_for_the_components(self):
+        index = SpectralIndex(n_components=8)
+        index.add(self.spectra[:4], self.wavelengths, self.keys[:4])
+        self.assertRaises(ValueError, index.query, self.spectra[:1],
+                          self.wavelengths)
+
+    def test_spectra_not_covering_the_grid_are_left_out(self):
+        index = SpectralIndex()
+        narrow = np.linspace(640, 820, 100)
+        self.assertEqual(index.add(np.ones((2, 100)), narrow, ['a', 'b']),
+                         0)
+        self.assertEqual(len(index), 0)
+        self.assertIsNone(index.query(np.ones(100), narrow))
+
+    def test_saves_are_incremental(self):
+        path = os.path.join(self.tmpdir, 'index')
+        index = SpectralIndex.open(path, n_components=4, fit_spectra=30)
+        index.add(self.spectra[:30], self.wavelengths, self.keys[:30])
+        index.save()
+        index.add(self.spectra[30:], self.wavelengths, self.keys[30:])
+        index.save()
+        index.save()
+        self.assertEqual(sorted(os.listdir(path)), [
+            'components.npy', 'index.json', 'segment_000000.npz',
+            'segment_000001.npz', 'wavelengths.npy'])
+
+        loaded = SpectralIndex.open(path)
+        self.assertEqual(len(loaded), 50)
+        self.assertEqual(loaded.n_components, 4)
+        keys, _ = loaded.query(self.spectra[[40]], self.wavelengths, k=1)
+        self.assertEqual(keys[0, 0], 's40')
+
+
+class testUploadAddsToIndex(unittest.TestCase):
+
+    PICO_DIR = os.path.join(os.path.abspath("test/PICO_testdata/"), '')
+
+    def setUp(self):
+        metrics.reset()
+        self.tmpdir = tempfile.mkdtemp()
+        self.client = fakeclient.FakeSPECCHIOClient(latency=0)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_uploaded_spectra_are_indexed(self):
+        index = SpectralIndex(path=self.tmpdir)
+        db = specchio.specchioDBinterface(
+            "Similarity Campaign", client=self.client,
+            similarity_index=index)
+        spectrafile = SpectraFile("QEPs2_b000000_s000002_light.pico",
+                                  self.PICO_DIR)
+        db.specchio_upload_pico_spectra(spectrafile)
+        db.flush()
+        # Only the full-range spectrometer covers 400-900 nm
+        counters = metrics.as_dict()['counters']
+        self.assertEqual(counters['similarity.added'], 2)
+        self.assertEqual(counters['similarity.not_covered'], 2)
+
+        loaded = SpectralIndex.load(self.tmpdir)
+        keys, distances = loaded.query(
+            spectrafile.get_spectra_pixels(2),
+            spectrafile.get_spectra_wavelengths(2), k=1)
+        self.assertEqual(self.client.spectra[int(keys[0, 0])][2]
+                         .get_entry('Direction').getValue(), 'Downwelling')
+        self.assertAlmostEqual(distances[0, 0], 0, places=5)
+
+    def test_components_are_fitted_across_files(self):
+        # A file has too few spectra to fit the PCA components
+        index = SpectralIndex(n_components=3, fit_spectra=4)
+        db = specchio.specchioDBinterface(
+            "Similarity Campaign", client=self.client,
+            similarity_index=index)
+        spectrafile = SpectraFile("QEPs2_b000000_s000002_light.pico",
+                                  self.PICO_DIR)
+        db.specchio_upload_pico_spectra(spectrafile)
+        self.assertEqual(len(index), 2)
+        self.assertIsNone(index.components)
+        db.specchio_upload_pico_spectra(spectrafile)
+        self.assertEqual(len(index), 4)
+        self.assertEqual(index.components.shape[0], 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the bulk SQL backend, against an in-memory SQLite stand-in of the
+SPECCHIO schema.
+"""
+
+import os
+import sqlite3
+import unittest
+
+os.environ['SPECCHIO_CLIENT_BACKEND'] = 'fake'
+
+import pyspecchio.spectra_dedup as dedup
+import pyspecchio.specchio_db_interface as specchio
+import pyspecchio.specchio_sql_client as sqlclient
+from pyspecchio.spectra_parser import SpectraFile
+
+
+class testBulkSQLClient(unittest.TestCase):
+
+    PICO_DIR = os.path.join(os.path.abspath("test/PICO_testdata/"), '')
+    PICO_FILES = ("QEP1USB1_b000000_s000002_light.pico",
+                  "QEPs2_b000000_s000002_light.pico")
+
+    def setUp(self):
+        self.connection = sqlite3.connect(':memory:')
+        sqlclient.create_standin_schema(self.connection)
+        self.client = sqlclient.BulkSQLClient(self.connection, batch_size=6)
+
+    def tearDown(self):
+        self.connection.close()
+
+    def count_rows(self, table):
+        return self.connection.execute(
+            "SELECT COUNT(*) FROM " + table).fetchone()[0]
+
+    def upload(self, campaign_name="SQL Campaign", deduplicator=None):
+        db_interface = specchio.specchioDBinterface(
+            campaign_name, client=self.client, deduplicator=deduplicator)
+        for pico_name in self.PICO_FILES:
+            db_interface.specchio_upload_pico_spectra(
+                SpectraFile(pico_name, self.PICO_DIR))
+        return db_interface
+
+    def test_spectra_written_in_batches(self):
+        db_interface = self.upload()
+        # First file (4 spectra) stays buffered, second makes 8 >= 6
+        self.assertEqual(self.count_rows('spectrum'), 8)
+        self.assertEqual(self.client.pending_spectra, 0)
+        db_interface.flush()
+        self.assertEqual(self.count_rows('spectrum'), 8)
+
+    def test_partial_batch_needs_flush(self):
+        self.client.batch_size = 100
+        db_interface = self.upload()
+        self.assertEqual(self.count_rows('spectrum'), 0)
+        db_interface.flush()
+        self.assertEqual(self.count_rows('spectrum'), 8)
+        self.assertEqual(self.count_rows('eav'),
+                         self.count_rows('spectrum_x_eav'))
+
+    def test_hashes_are_indexed_once_written(self):
+        self.client.batch_size = 100
+        index = dedup.HashIndex(':memory:')
+        db_interface = self.upload(deduplicator=dedup.Deduplicator(index))
+        self.assertEqual(index.hashes["SQL Campaign"], set())
+        # Still found as duplicates while they are buffered
+        db_interface.specchio_upload_pico_spectra(
+            SpectraFile(self.PICO_FILES[0], self.PICO_DIR))
+        self.assertEqual(self.client.pending_spectra, 8)
+        db_interface.flush()
+        self.assertEqual(len(index.hashes["SQL Campaign"]), 8)
+
+    def test_hashes_of_a_failed_flush_are_not_indexed(self):
+        self.client.batch_size = 100
+        index = dedup.HashIndex(':memory:')
+        db_interface = self.upload(deduplicator=dedup.Deduplicator(index))
+        self.connection.execute("DROP TABLE spectrum_x_eav")
+        self.assertRaises(sqlite3.Error, db_interface.flush)
+        self.assertEqual(self.count_rows('spectrum'), 0)
+        self.assertFalse(index.connection.execute(
+            "SELECT COUNT(*) FROM spectrum_hash").fetchone()[0])
+
+    def test_eav_storage_fields(self):
+        self.upload().flush()
+        row = self.connection.execute(
+            "SELECT e.double_val, e.string_val FROM eav e"
+            " JOIN attribute a ON a.attribute_id = e.attribute_id"
+            " WHERE a.name = 'Saturation Level'").fetchone()
+        self.assertEqual(row, (200000.0, None))
+        pixel_range = self.connection.execute(
+            "SELECT e.string_val FROM eav e"
+            " JOIN attribute a ON a.attribute_id = e.attribute_id"
+            " WHERE a.name = 'Optical Pixel Range'").fetchone()
+        self.assertEqual(pixel_range[0], '10, 1033')
+
+    def test_measurement_round_trip(self):
+        self.upload().flush()
+        blob, channels = self.connection.execute(
+            "SELECT measurement, number_of_channels FROM spectrum"
+            " ORDER BY spectrum_id LIMIT 1").fetchone()
+        vector = sqlclient.blob_to_measurement(blob)
+        self.assertEqual(len(vector), channels)
+        pixels = SpectraFile(self.PICO_FILES[0],
+                             self.PICO_DIR).get_spectra_pixels(0)
+        self.assertAlmostEqual(float(vector[5]), float(pixels[5]), places=0)
+
+    def test_campaign_and_hierarchy_reused(self):
+        self.upload().flush()
+        self.upload().flush()
+        self.assertEqual(self.count_rows('campaign'), 1)
+        self.assertEqual(self.count_rows('hierarchy_level'), 1)
+        self.assertEqual(self.count_rows('spectrum'), 16)
+
+    def test_file_names_are_metadata(self):
+        db_interface = self.upload()
+        ids = db_interface.ancil_spectrum_ids(self.PICO_FILES[1] + '2')
+        self.assertEqual(self.client.pending_spectra, 0)
+        self.assertEqual(len(ids), 1)
+        self.assertEqual(self.connection.execute(
+            "SELECT e.string_val FROM eav e"
+            " JOIN spectrum_x_eav x ON x.eav_id = e.eav_id"
+            " JOIN attribute a ON a.attribute_id = e.attribute_id"
+            " WHERE a.name = 'File Name' AND x.spectrum_id = ?",
+            (ids[0],)).fetchone()[0], self.PICO_FILES[1] + '2')
+
+    def test_query_conditions(self):
+        db_interface = self.upload()
+        query = specchio.spquery.Query()
+        for attribute_name, operator, value in (
+                ('Saturation Level', '>=', '200000'),
+                ('File Name', 'like', 'QEPs2')):
+            cond = specchio.spquery.EAVQueryConditionObject(
+                db_interface.get_attribute(attribute_name))
+            cond.setValue(value)
+            cond.setOperator(operator)
+            query.add_condition(cond)
+        ids = self.client.getSpectrumIdsMatchingQuery(query)
+        self.assertEqual(len(ids), 4)
+        self.assertEqual(list(ids), sorted(ids))
+
+    def test_update_and_remove_metadata(self):
+        db_interface = self.upload()
+        ids = db_interface.ancil_spectrum_ids(self.PICO_FILES[0] + '0') + \
+            db_interface.ancil_spectrum_ids(self.PICO_FILES[0] + '1')
+        mp = specchio.metaparam.newInstance(
+            db_interface.get_attribute('Height1'))
+        for value in (0.3, 0.35):
+            mp.setValue(value)
+            self.client.updateEavMetadata(mp, ids)
+        heights = "SELECT x.spectrum_id, e.double_val FROM eav e" \
+            " JOIN spectrum_x_eav x ON x.eav_id = e.eav_id" \
+            " JOIN attribute a ON a.attribute_id = e.attribute_id" \
+            " WHERE a.name = 'Height1' ORDER BY x.spectrum_id"
+        self.assertEqual(self.connection.execute(heights).fetchall(),
+                         [(ids[0], 0.35), (ids[1], 0.35)])
+
+        self.client.removeEavMetadata(mp, ids[:1])
+        self.assertEqual(self.connection.execute(heights).fetchall(),
+                         [(ids[1], 0.35)])
+        self.assertEqual(self.count_rows('eav'),
+                         len(set(row[0] for row in self.connection.execute(
+                             "SELECT eav_id FROM spectrum_x_eav"))))
+
+
+if __name__ == '__main__':
+    unittest.main()
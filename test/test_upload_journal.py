@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the upload journal and resuming interrupted uploads
+"""
+
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+# Must be set before the db interface is imported
+os.environ['SPECCHIO_CLIENT_BACKEND'] = 'fake'
+
+import pyspecchio.metrics as metrics
+import pyspecchio.specchio_db_interface as specchio
+import pyspecchio.specchio_fake_client as fakeclient
+import pyspecchio.specchio_sql_client as sqlclient
+from pyspecchio.spectra_parser import SpectraFile
+from pyspecchio.upload_journal import UploadJournal
+
+
+class testUploadJournal(unittest.TestCase):
+
+    PICO_DIR = os.path.join(os.path.abspath("test/PICO_testdata/"), '')
+    PICO_FILES = ("QEP1USB1_b000000_s000002_light.pico",
+                  "QEPs2_b000000_s000002_light.pico")
+
+    def setUp(self):
+        metrics.reset()
+        self.tmpdir = tempfile.mkdtemp()
+        for pico_name in self.PICO_FILES:
+            shutil.copy(os.path.join(self.PICO_DIR, pico_name), self.tmpdir)
+        self.files = [SpectraFile(pico_name, os.path.join(self.tmpdir, ''))
+                      for pico_name in self.PICO_FILES]
+        self.journal_file = os.path.join(self.tmpdir, 'journal.sqlite')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def upload(self, client, spectrafiles, resume=False):
+        journal = UploadJournal(self.journal_file, resume)
+        db = specchio.specchioDBinterface("Journal Campaign", client=client,
+                                          journal=journal)
+        for spectrafile in journal.unfinished(db.campaign_name,
+                                              spectrafiles):
+            db.specchio_upload_pico_spectra(spectrafile)
+        return db
+
+    def test_resume_skips_uploaded_files(self):
+        client = fakeclient.FakeSPECCHIOClient(latency=0)
+        # Interrupted after the first file
+        db = self.upload(client, self.files[:1])
+        entry = db.journal.entry(db.campaign_name, self.files[0])
+        self.assertEqual(entry['status'], 'done')
+        self.assertEqual(entry['spectra'], [0, 1, 2, 3])
+        self.assertEqual(entry['spectrum_ids'], [1, 2, 3, 4])
+
+        self.upload(client, self.files, resume=True)
+        self.assertEqual(client.call_counts['insertSpectralFile'], 2)
+        self.assertEqual(metrics.as_dict()['counters']
+                         ['journal.files_skipped'], 1)
+
+    def test_partial_upload_is_not_done(self):
+        client = fakeclient.FakeSPECCHIOClient(latency=0)
+        journal = UploadJournal(self.journal_file, resume=True)
+        db = specchio.specchioDBinterface("Journal Campaign", client=client,
+                                          journal=journal)
+        # e.g. --select of one spectrum
+        db.specchio_upload_pico_spectra(self.files[0], spectra_numbers=[0])
+        self.assertTrue(journal.is_done(db.campaign_name, self.files[0], [0]))
+        self.assertFalse(journal.is_done(db.campaign_name, self.files[0]))
+        self.assertEqual(len(journal.unfinished(db.campaign_name,
+                                                self.files[:1])), 1)
+
+        # A wider selection only uploads the spectra not yet stored
+        db.specchio_upload_pico_spectra(self.files[0],
+                                        spectra_numbers=[0, 1, 2, 3])
+        self.assertEqual(len(client.spectra), 4)
+        self.assertTrue(journal.is_done(db.campaign_name, self.files[0]))
+        self.assertEqual(journal.unfinished(db.campaign_name,
+                                            self.files[:1]), [])
+
+    def test_changed_file_is_uploaded_again(self):
+        client = fakeclient.FakeSPECCHIOClient(latency=0)
+        self.upload(client, self.files[:1])
+        path = self.files[0].spath + self.files[0].sfile
+        os.utime(path, (0, 0))
+        self.upload(client, self.files[:1], resume=True)
+        self.assertEqual(client.call_counts['insertSpectralFile'], 2)
+
+    def test_buffered_inserts_are_not_done_until_flushed(self):
+        connection = sqlite3.connect(':memory:')
+        sqlclient.create_standin_schema(connection)
+        client = sqlclient.BulkSQLClient(connection, batch_size=100)
+        db = self.upload(client, self.files)
+        self.assertEqual(db.journal.summary(db.campaign_name),
+                         {'inserted': 2})
+        # A crash now would replay both files
+        self.assertEqual(len(UploadJournal(self.journal_file, True)
+                             .unfinished(db.campaign_name, self.files)), 2)
+        db.flush()
+        self.assertEqual(db.journal.summary(db.campaign_name), {'done': 2})
+        connection.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
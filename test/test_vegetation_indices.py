@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the vectorised vegetation index engine
+"""
+
+import os
+import unittest
+
+import numpy as np
+
+# Must be set before the db interface is imported
+os.environ['SPECCHIO_CLIENT_BACKEND'] = 'fake'
+
+import pyspecchio.metrics as metrics
+import pyspecchio.specchio_db_interface as specchio
+import pyspecchio.specchio_fake_client as fakeclient
+import pyspecchio.vegetation_indices as vi
+from pyspecchio.spectra_parser import SpectraFile, stack_spectra
+
+
+class testIndexEngine(unittest.TestCase):
+
+    PICO_DIR = os.path.join(os.path.abspath("test/PICO_testdata/"), '')
+
+    def setUp(self):
+        self.engine = vi.IndexEngine()
+        self.wavelengths = np.linspace(400.0, 1000.0, 1044)
+
+    def test_step_spectrum(self):
+        # Reflectance of 0.1 below 700 nm and 0.5 above
+        spectrum = np.where(self.wavelengths < 700.0, 0.1, 0.5)
+        values = self.engine.evaluate(spectrum, self.wavelengths)
+        self.assertAlmostEqual(values['NDVI'][0], 0.4 / 0.6)
+        self.assertAlmostEqual(values['SR'][0], 5.0)
+        self.assertAlmostEqual(values['PRI'][0], 0.0)
+
+    def test_matches_per_spectrum_loop(self):
+        spectra = np.random.RandomState(0).uniform(0.1, 1.0, (5, 1044))
+        ndvi = self.engine.evaluate(spectra, self.wavelengths)['NDVI']
+        nir = (self.wavelengths >= 795) & (self.wavelengths <= 805)
+        red = (self.wavelengths >= 665) & (self.wavelengths <= 675)
+        for i, spectrum in enumerate(spectra):
+            expected = (spectrum[nir].mean() - spectrum[red].mean()) / \
+                (spectrum[nir].mean() + spectrum[red].mean())
+            self.assertAlmostEqual(ndvi[i], expected)
+
+    def test_window_outside_grid_is_nan(self):
+        wavelengths = np.linspace(640.0, 820.0, 1044)
+        values = self.engine.evaluate(np.ones(1044), wavelengths)
+        self.assertTrue(np.isnan(values['PRI'][0]))
+        self.assertFalse(np.isnan(values['NDVI'][0]))
+
+    def test_window_matrix_is_cached(self):
+        first = self.engine.window_matrix(self.wavelengths)
+        self.assertIs(self.engine.window_matrix(self.wavelengths.copy()),
+                      first)
+
+    def test_reflectance_pairs_each_spectrometer(self):
+        stacks = stack_spectra([
+            SpectraFile("QEP1USB1_b000000_s000002_light.pico",
+                        self.PICO_DIR)])
+        table = self.engine.evaluate_reflectance(stacks)
+        # Two spectrometers, each with an upwelling/downwelling pair
+        self.assertEqual(len(table), 2)
+        self.assertEqual(
+            sorted((up, down) for _, up, down in table.index),
+            [(0, 2), (1, 3)])
+        self.assertEqual(list(table.columns), list(vi.INDEX_DEFINITIONS))
+
+
+class testUploadIndices(unittest.TestCase):
+
+    PICO_DIR = os.path.join(os.path.abspath("test/PICO_testdata/"), '')
+
+    def test_indices_uploaded_as_metadata(self):
+        client = fakeclient.FakeSPECCHIOClient(latency=0)
+        db = specchio.specchioDBinterface("Index Campaign", client=client)
+        spectrafile = SpectraFile("QEP1USB1_b000000_s000002_light.pico",
+                                  self.PICO_DIR)
+        db.specchio_upload_pico_spectra(spectrafile, vi.IndexEngine())
+        ndvi = [smd.get_entry('NDVI') for _, _, smd, _ in
+                client.spectra.values()]
+        self.assertEqual(len(ndvi), 4)
+        self.assertTrue(all(mp is not None for mp in ndvi))
+        # The upwelling and downwelling spectra of a pair share a value
+        self.assertEqual(ndvi[0].getValue(), ndvi[2].getValue())
+
+    def test_uploaded_file_is_not_read_again(self):
+        spectrafile = SpectraFile("QEP1USB1_b000000_s000002_light.pico",
+                                  self.PICO_DIR)
+        reads = []
+        for index_engine in (None, vi.IndexEngine()):
+            metrics.reset()
+            db = specchio.specchioDBinterface(
+                "Index Campaign", client=fakeclient.FakeSPECCHIOClient(
+                    latency=0))
+            db.specchio_upload_pico_spectra(spectrafile, index_engine)
+            reads.append(metrics.as_dict()['counters']['spectra.json_reads'])
+        self.assertEqual(reads[0], reads[1])
+        # The same indices as from reading the file
+        engine = vi.IndexEngine()
+        self.assertEqual(
+            engine.indices_for_file(
+                spectrafile, db.get_all_pico_spectra(spectrafile),
+                db.get_all_pico_metadata(spectrafile)),
+            engine.indices_for_file(spectrafile))
+
+
+if __name__ == '__main__':
+    unittest.main()